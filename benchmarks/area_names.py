@@ -0,0 +1,34 @@
+"""
+Count the Elasticsearch round trips made by `crud.get_postcodes`
+
+Runs against an in-memory stub, so the numbers show how many requests are
+made rather than how long a real cluster takes to answer them.
+
+    python -m benchmarks.area_names
+"""
+
+import time
+
+from benchmarks.stubs import stub_postcodes
+from findthatpostcode import cache, crud, settings
+
+
+def main():
+    print("{:>8} {:>12} {:>12} {:>10}".format("n", "round trips", "area codes", "ms"))
+    for n in [1, 10, 100, 1000, 10000]:
+        cache.area_names.clear()
+        db = stub_postcodes(n)
+        postcodes = list(db.documents[settings.ES_INDICES["postcode"]].keys())
+        start = time.perf_counter()
+        crud.get_postcodes(db, postcodes)
+        elapsed = (time.perf_counter() - start) * 1000
+        area_codes = sum(c[2] for c in db.calls if c[1] == settings.ES_INDICES["area"])
+        print(
+            "{:>8} {:>12} {:>12} {:>10.1f}".format(
+                n, len(db.calls), area_codes, elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
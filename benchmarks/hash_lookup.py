@@ -0,0 +1,84 @@
+"""
+Time hash prefix lookups with thousands of hashes per request
+
+Compares the old `bool/should` of `prefix` queries against the `terms` query
+on the `hashN` keyword fields used by `crud.get_postcode_by_hash`. By default
+it runs against an in-memory stub, which shows how many requests are made and
+how many postcodes are returned. Pass `--es-url` to time a real cluster that
+has been imported with the `hashN` fields.
+
+    python -m benchmarks.hash_lookup
+    python -m benchmarks.hash_lookup --es-url http://localhost:9200
+"""
+
+import argparse
+import random
+import time
+
+from elasticsearch import Elasticsearch
+from elasticsearch_dsl import Q
+
+from benchmarks.stubs import stub_postcodes
+from findthatpostcode import cache, crud, settings
+from findthatpostcode.documents import Postcode
+
+
+def random_hashes(n: int, length: int):
+    return ["".join(random.choices("0123456789abcdef", k=length)) for _ in range(n)]
+
+
+def prefix_lookup(db, hashes):
+    # the query used before the hashN fields were added
+    results = (
+        Postcode.search(using=db)
+        .query("bool", should=[Q("prefix", hash=h) for h in hashes])
+        .execute()
+    )
+    return len(results), results.hits.total.value
+
+
+def terms_lookup(db, hashes):
+    results = list(crud.get_postcode_by_hash(db, hashes, fields=["pcds"]))
+    return len(results), len(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--es-url", default=None)
+    parser.add_argument("--length", type=int, default=4)
+    parser.add_argument("--postcodes", type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.es_url:
+        db = Elasticsearch(args.es_url, timeout=settings.ES_BULK_TIMEOUT)
+    else:
+        db = stub_postcodes(args.postcodes)
+
+    print(
+        "{:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            "hashes", "query", "requests", "returned", "matched", "ms"
+        )
+    )
+    for n in [100, 1000, 5000]:
+        hashes = random_hashes(n, args.length)
+        for label, lookup in [("prefix", prefix_lookup), ("terms", terms_lookup)]:
+            cache.area_names.clear()
+            if hasattr(db, "calls"):
+                db.calls = []
+            start = time.perf_counter()
+            try:
+                returned, matched = lookup(db, hashes)
+            except Exception as e:
+                print("{:>8} {:>8} failed: {}".format(n, label, e))
+                continue
+            elapsed = (time.perf_counter() - start) * 1000
+            requests = len(db.calls) if hasattr(db, "calls") else "-"
+            print(
+                "{:>8} {:>8} {:>10} {:>10} {:>10} {:>10.1f}".format(
+                    n, label, requests, returned, matched, elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Measure requests/second for the postcode API endpoint
+
+By default this runs the app in-process against a stub Elasticsearch that
+sleeps for `--latency` seconds on each request, once with the blocking calls
+made directly on the event loop ("before") and once through the database
+thread pool ("after"). Pass `--url` to load test a running server instead.
+
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --url http://localhost:8000 --postcode "SW1A 1AA"
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from benchmarks.stubs import stub_postcodes
+from findthatpostcode import api, cache
+from findthatpostcode.db import get_db, run_db
+from findthatpostcode.main import app
+
+
+def slow_stub(latency: float):
+    db = stub_postcodes(100)
+    mget = db.mget
+
+    def slow_mget(*args, **kwargs):
+        time.sleep(latency)
+        return mget(*args, **kwargs)
+
+    db.mget = slow_mget
+    return db
+
+
+async def run_blocking(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+async def load(client: httpx.AsyncClient, path: str, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch():
+        async with semaphore:
+            response = await client.get(path)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[fetch() for _ in range(requests)])
+    return requests / (time.perf_counter() - start)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--postcode", default="AB10 0CD")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.01)
+    args = parser.parse_args()
+    path = "/api/v1/postcodes/{}.json".format(args.postcode)
+
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url) as client:
+            rps = await load(client, path, args.requests, args.concurrency)
+        print("{:>12}: {:,.1f} requests/sec".format(args.url, rps))
+        return
+
+    db = slow_stub(args.latency)
+    app.dependency_overrides[get_db] = lambda: db
+    cache.area_names.maxsize = 0
+    transport = httpx.ASGITransport(app=app)
+    for label, runner in [("before", run_blocking), ("after", run_db)]:
+        cache.area_names.clear()
+        api.run_db = runner
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            rps = await load(client, path, args.requests, args.concurrency)
+        print("{:>12}: {:,.1f} requests/sec".format(label, rps))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+"""
+Compare rows/sec for converting postcode CSV rows into documents
+
+Times `Postcode.from_csv(record).to_dict()` against `PostcodeConverter` on
+the NSPL test fixture (or any NSPL/ONSPD zip passed with `--file`), and
+checks that both give the same result.
+
+    python -m benchmarks.row_converter
+    python -m benchmarks.row_converter --file NSPL_FEB_2024_UK.zip --rows 500000
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import os
+import time
+import zipfile
+
+from findthatpostcode.documents.postcode import Postcode, PostcodeConverter
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "findthatpostcode",
+    "tests",
+    "fixtures",
+    "nspl21.zip",
+)
+
+
+def read_rows(file: str, rows: int):
+    z = zipfile.ZipFile(file)
+    header = None
+    data = []
+    for filename in z.namelist():
+        if not filename.endswith(".csv") or "/multi_csv/" not in filename:
+            continue
+        with z.open(filename) as f:
+            reader = csv.reader(io.TextIOWrapper(f))
+            header = next(reader)
+            data.extend(itertools.islice(reader, rows - len(data)))
+        if len(data) >= rows:
+            break
+    return header, data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", default=FIXTURE)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    header, rows = read_rows(args.file, args.rows)
+
+    start = time.perf_counter()
+    expected = [Postcode.from_csv(dict(zip(header, row))).to_dict() for row in rows]
+    from_csv_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    convert = PostcodeConverter(header)
+    result = [convert(row) for row in rows]
+    converter_time = time.perf_counter() - start
+
+    assert result == expected, "converter output differs from Postcode.from_csv"
+    print("{:,.0f} rows".format(len(rows)))
+    print("{:>20}: {:>10,.0f} rows/sec".format("from_csv", len(rows) / from_csv_time))
+    print(
+        "{:>20}: {:>10,.0f} rows/sec".format(
+            "PostcodeConverter", len(rows) / converter_time
+        )
+    )
+    print("{:>20}: {:>10.1f}x".format("speed up", from_csv_time / converter_time))
+
+
+if __name__ == "__main__":
+    main()
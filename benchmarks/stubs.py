@@ -0,0 +1,268 @@
+"""
+In-memory stand-ins for Elasticsearch, used by the benchmarks and tests
+
+`StubES` records every request made, so round trips can be counted, and
+`stub_postcodes` fills one with postcodes and local authorities.
+"""
+
+import hashlib
+from fnmatch import fnmatch
+
+from elasticsearch import NotFoundError
+
+from findthatpostcode import settings
+from findthatpostcode.documents.postcode import HASH_PREFIX_LENGTHS
+
+LAUA_COUNT = 25
+
+
+class StubES:
+    """
+    Minimal stand-in for the parts of the Elasticsearch client used by crud,
+    which records every request made so round trips can be counted
+    """
+
+    def __init__(self, documents=None):
+        # documents are stored as {index_name: {id: source}}
+        self.documents = documents or {}
+        self.calls = []
+        self.transport = StubTransport(self)
+        self.indices = StubIndices(self)
+
+    def mget(self, body, index=None, **kwargs):
+        self.calls.append(("mget", index, len(body["docs"])))
+        index_docs = self.documents.get(index, {})
+        return {
+            "docs": [
+                {
+                    "_index": index,
+                    "_id": str(doc["_id"]),
+                    "found": True,
+                    "_source": index_docs[str(doc["_id"])],
+                }
+                if str(doc["_id"]) in index_docs
+                else {"_index": index, "_id": str(doc["_id"]), "found": False}
+                for doc in body["docs"]
+            ]
+        }
+
+    def get(self, index, id, **kwargs):
+        self.calls.append(("get", index, 1))
+        index_docs = self.documents.get(index, {})
+        if str(id) not in index_docs:
+            raise NotFoundError(404, "not_found", {"_id": str(id), "found": False})
+        return {
+            "_index": index,
+            "_id": str(id),
+            "found": True,
+            "_source": index_docs[str(id)],
+        }
+
+    def index(self, index, body, id=None, **kwargs):
+        self.calls.append(("index", index, 1))
+        self.documents.setdefault(index, {})[str(id)] = body
+        return {"_index": index, "_id": str(id), "result": "created"}
+
+    def exists(self, index, id, **kwargs):
+        self.calls.append(("exists", index, 1))
+        return str(id) in self.documents.get(index, {})
+
+    def delete_by_query(self, index, body, **kwargs):
+        if isinstance(index, (list, tuple)):
+            index = ",".join(index)
+        self.calls.append(("delete_by_query", index, body))
+        deleted = 0
+        for i in index.split(","):
+            index_docs = self.documents.get(i, {})
+            for id_, source in list(index_docs.items()):
+                if self._matches(body.get("query", {"match_all": {}}), source):
+                    del index_docs[id_]
+                    deleted += 1
+        return {"deleted": deleted}
+
+    def search(self, index=None, body=None, **kwargs):
+        if isinstance(index, (list, tuple)):
+            index = ",".join(index)
+        body = body or {}
+        if "pit" in body:
+            # point in time ids are the name of the index they were opened on
+            index = body["pit"]["id"]
+        self.calls.append(("search", index, body))
+        docs = [
+            {"_index": i, "_id": id_, "_source": source}
+            for i in (index or "").split(",")
+            for id_, source in self.documents.get(i, {}).items()
+            if self._matches(body.get("query", {"match_all": {}}), source)
+        ]
+        sort_fields = [
+            list(s.keys())[0] if isinstance(s, dict) else s
+            for s in body.get("sort", [])
+        ]
+        for doc in docs:
+            doc["sort"] = [doc["_source"].get(f, doc["_id"]) for f in sort_fields]
+        if sort_fields:
+            docs = sorted(docs, key=lambda doc: doc["sort"])
+        if body.get("search_after"):
+            docs = [doc for doc in docs if doc["sort"] > body["search_after"]]
+        size = body.get("size", kwargs.get("size", 10))
+        response = {
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(docs), "relation": "eq"},
+                "hits": docs[:size],
+            },
+        }
+        if "pit" in body:
+            response["pit_id"] = index
+        return response
+
+    def _matches(self, query, source):
+        query_type, params = list(query.items())[0]
+        if query_type == "match_all":
+            return True
+        if query_type == "bool":
+            should = params.get("should", [])
+            return (
+                all(self._matches(q, source) for q in params.get("must", []))
+                and all(self._matches(q, source) for q in params.get("filter", []))
+                and not any(
+                    self._matches(q, source) for q in params.get("must_not", [])
+                )
+                and (not should or any(self._matches(q, source) for q in should))
+            )
+        field, value = list(params.items())[0]
+        if isinstance(value, dict):
+            value = value["value"]
+        if query_type == "term":
+            return source.get(field) == value
+        if query_type == "terms":
+            return source.get(field) in value
+        if query_type == "prefix":
+            return str(source.get(field, "")).startswith(value)
+        raise NotImplementedError(query_type)
+
+    def count_calls(self, method, index=None):
+        return len(
+            [c for c in self.calls if c[0] == method and (not index or c[1] == index)]
+        )
+
+
+class StubIndices:
+    """
+    Index and alias management for `StubES`, with settings and aliases kept
+    in memory
+    """
+
+    def __init__(self, es):
+        self.es = es
+        self.settings = {}
+        self.aliases = {}
+
+    def _names(self, index):
+        return [i for i in self.es.documents if fnmatch(i, index)]
+
+    def create(self, index, body=None, **kwargs):
+        self.es.calls.append(("indices.create", index, body))
+        self.es.documents.setdefault(index, {})
+        self.settings[index] = dict((body or {}).get("settings", {}))
+
+    def exists(self, index, **kwargs):
+        return bool(self._names(index)) or index in self.aliases
+
+    def exists_alias(self, name, **kwargs):
+        return name in self.aliases
+
+    def get_alias(self, name, **kwargs):
+        return {index: {"aliases": {name: {}}} for index in self.aliases[name]}
+
+    def get(self, index, **kwargs):
+        return {i: {"settings": self.settings.get(i, {})} for i in self._names(index)}
+
+    def put_settings(self, index, body, **kwargs):
+        self.es.calls.append(("indices.put_settings", index, body))
+        self.settings[index].update(body["index"])
+
+    def refresh(self, index, **kwargs):
+        self.es.calls.append(("indices.refresh", index, None))
+
+    def forcemerge(self, index, **kwargs):
+        self.es.calls.append(("indices.forcemerge", index, kwargs))
+
+    def update_aliases(self, body, **kwargs):
+        self.es.calls.append(("indices.update_aliases", None, body))
+        for action in body["actions"]:
+            (action_type, params), *_ = action.items()
+            if action_type == "add":
+                self.aliases.setdefault(params["alias"], set()).add(params["index"])
+            elif action_type == "remove":
+                self.aliases[params["alias"]].discard(params["index"])
+            elif action_type == "remove_index":
+                self.delete(params["index"])
+
+    def delete(self, index, **kwargs):
+        self.es.calls.append(("indices.delete", index, None))
+        for i in self._names(index):
+            del self.es.documents[i]
+            self.settings.pop(i, None)
+
+
+class StubTransport:
+    """
+    Handles the point in time requests made with `transport.perform_request`
+    """
+
+    def __init__(self, es):
+        self.es = es
+        self.open_pits = set()
+
+    def perform_request(self, method, url, params=None, body=None, **kwargs):
+        self.es.calls.append((method, url, body))
+        if method == "POST" and url.endswith("/_pit"):
+            index = url.strip("/").split("/")[0]
+            self.open_pits.add(index)
+            return {"id": index}
+        if method == "DELETE" and url == "/_pit":
+            self.open_pits.discard(body["id"])
+            return {"succeeded": True, "num_freed": 1}
+        raise NotImplementedError(url)
+
+
+def stub_postcodes(n: int) -> StubES:
+    """
+    A `StubES` holding `n` postcodes spread across `LAUA_COUNT` local
+    authorities in England
+    """
+    postcodes = {}
+    for i in range(n):
+        pcds = "AB{} {}CD".format(10 + (i // 10), i % 10)
+        hash_ = hashlib.md5(pcds.lower().replace(" ", "").encode()).hexdigest()
+        postcodes[pcds] = {
+            "pcds": pcds,
+            "laua": "E0700{:04d}".format(i % LAUA_COUNT),
+            "ctry": "E92000001",
+            "hash": hash_,
+            **{"hash{}".format(n): hash_[0:n] for n in HASH_PREFIX_LENGTHS},
+        }
+    areas = {
+        "E0700{:04d}".format(i): {
+            "code": "E0700{:04d}".format(i),
+            "name": "Local authority {}".format(i),
+            "type": "laua",
+            "active": True,
+        }
+        for i in range(LAUA_COUNT)
+    }
+    areas["E92000001"] = {
+        "code": "E92000001",
+        "name": "England",
+        "type": "ctry",
+        "active": True,
+    }
+    return StubES(
+        {
+            settings.ES_INDICES["postcode"]: postcodes,
+            settings.ES_INDICES["area"]: areas,
+        }
+    )
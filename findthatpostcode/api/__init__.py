@@ -1,19 +1,38 @@
+import dataclasses
 import logging
+import math
+from typing import Literal, Optional
 
+import ijson
 from elasticsearch import Elasticsearch
-from fastapi import APIRouter, Depends, Form, HTTPException, Query, status
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, status
+from fastapi.responses import Response, StreamingResponse
 from mypy_boto3_s3.client import S3Client
 from pydantic_geojson import FeatureModel
+from starlette.concurrency import run_in_threadpool
 
-from findthatpostcode import crud
-from findthatpostcode.db import get_db, get_s3_client
+from findthatpostcode import crud, settings
+from findthatpostcode.cache import BoundariesUnavailable
+from findthatpostcode.db import get_db, get_s3_client, run_db
 from findthatpostcode.schemas import (
     Area,
     HTTPNotFoundError,
     NearestPoint,
+    PointAreas,
     Postcode,
     PostcodeHashResults,
 )
+from findthatpostcode.spatial import TILE_MEDIA_TYPE, tile_is_valid
+from findthatpostcode.utils import (
+    RequestStreamingResponse,
+    accepted_encodings,
+    iterate_from_thread,
+    records_to_csv,
+    records_to_json,
+    records_to_ndjson,
+    request_json_strings,
+    request_lines,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -36,7 +55,7 @@ router = APIRouter(
 )
 async def read_postcode(postcode: str, db: Elasticsearch = Depends(get_db)):
     logger.info(postcode)
-    postcode_item = crud.get_postcode(db, postcode)
+    postcode_item = await run_db(crud.get_postcode, db, postcode)
     if not postcode_item:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -45,6 +64,66 @@ async def read_postcode(postcode: str, db: Elasticsearch = Depends(get_db)):
     return postcode_item
 
 
+@router.post(
+    "/postcodes",
+    tags=["Get postcode"],
+    description=(
+        "Look up many postcodes at once. Send a JSON array of postcodes or "
+        "newline-delimited text. Results are streamed back in the same order "
+        "as newline-delimited JSON or CSV."
+    ),
+    response_class=StreamingResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"type": "array", "items": {"type": "string"}}
+                },
+                "text/plain": {"schema": {"type": "string"}},
+            },
+        }
+    },
+)
+async def read_postcodes(
+    request: Request,
+    fields: list[str] = Query([]),
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    db: Elasticsearch = Depends(get_db),
+):
+    # postcodes are read from the request as they are looked up, so large
+    # requests aren't held in memory - only the first is checked up front
+    if request.headers.get("content-type", "").startswith("application/json"):
+        values = request_json_strings(request.stream())
+    else:
+        values = request_lines(request.stream())
+    try:
+        first = [await values.__anext__()]
+    except StopAsyncIteration:
+        first = []
+    except (ValueError, ijson.JSONError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Request body must be a JSON array of postcodes",
+        )
+    postcodes = iterate_from_thread(values, first)
+
+    if fields:
+        # always include the postcode so results can be matched up
+        fields = ["pcds"] + [f for f in fields if f != "pcds"]
+    chunks = crud.iter_postcodes(db, postcodes, fields=fields)
+    if format == "csv":
+        csv_fields = fields or [
+            f.name for f in dataclasses.fields(Postcode) if f.name != "location"
+        ]
+        return RequestStreamingResponse(
+            records_to_csv(chunks, csv_fields), media_type="text/csv"
+        )
+    return RequestStreamingResponse(
+        records_to_ndjson(chunks, fields), media_type="application/x-ndjson"
+    )
+
+
 @router.get(
     "/hash/{hash}",
     tags=["Postcode hash"],
@@ -60,9 +139,13 @@ async def read_postcode(postcode: str, db: Elasticsearch = Depends(get_db)):
 async def single_hash(
     hash: str, fields: list[str] = Query([]), db: Elasticsearch = Depends(get_db)
 ):
-    postcode_items = crud.get_postcode_by_hash(db, [hash], fields=fields)
-    print(postcode_items)
-    return {"data": list(postcode_items)}
+    try:
+        postcode_items = await run_db(
+            lambda: list(crud.get_postcode_by_hash(db, [hash], fields=fields))
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"data": postcode_items}
 
 
 @router.post(
@@ -77,8 +160,13 @@ async def multiple_hash(
     properties: list[str] = Form([]),
     db: Elasticsearch = Depends(get_db),
 ):
-    postcode_items = crud.get_postcode_by_hash(db, hash, fields=properties)
-    return {"data": list(postcode_items)}
+    try:
+        postcode_items = await run_db(
+            lambda: list(crud.get_postcode_by_hash(db, hash, fields=properties))
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"data": postcode_items}
 
 
 @router.get(
@@ -90,7 +178,7 @@ async def multiple_hash(
 async def find_nearest_point(
     lat: float, long: float, db: Elasticsearch = Depends(get_db)
 ):
-    postcode_item = crud.get_nearest_postcode(db, lat, long)
+    postcode_item = await run_db(crud.get_nearest_postcode, db, lat, long)
     if not postcode_item:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -99,6 +187,43 @@ async def find_nearest_point(
     return postcode_item
 
 
+@router.get(
+    "/points/{lat},{long}/areas",
+    response_model=PointAreas,
+    tags=["Get a point"],
+    description=(
+        "Get the live areas whose boundaries contain a Lat, Long. By default "
+        "the key area types are checked, or pick them with `areatype`. Returns "
+        "a 503 error while the boundaries are loading, or if they can't be "
+        "loaded."
+    ),
+)
+async def find_point_areas(
+    lat: float,
+    long: float,
+    areatype: list[str] = Query([]),
+    db: Elasticsearch = Depends(get_db),
+    client: S3Client = Depends(get_s3_client),
+):
+    areatypes = areatype or settings.POINT_AREA_TYPES
+    unknown = [a for a in areatypes if a not in settings.AREA_TYPES]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unknown area types: {}".format(", ".join(unknown)),
+        )
+    # the boundaries are held in memory, so this doesn't use a database thread
+    try:
+        point_areas = await run_in_threadpool(
+            crud.get_point_areas, db, client, lat, long, areatypes
+        )
+    except BoundariesUnavailable as e:
+        raise boundaries_unavailable(str(e), e.retry_after)
+    if point_areas is None:
+        raise boundaries_loading()
+    return point_areas
+
+
 @router.get(
     "/areas/{areacode}.json",
     response_model=Area,
@@ -106,7 +231,7 @@ async def find_nearest_point(
     description="Get data about an area",
 )
 async def get_area(areacode: str, db: Elasticsearch = Depends(get_db)):
-    area = crud.get_area(db, areacode)
+    area = await run_db(crud.get_area, db, areacode)
     if not area:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -117,22 +242,85 @@ async def get_area(areacode: str, db: Elasticsearch = Depends(get_db)):
 
 @router.get(
     "/areas/{areacode}.geojson",
-    response_model=FeatureModel,
     tags=["Areas"],
-    description="Get an area's boundary as a geojson file",
+    description=(
+        "Get an area's boundary as a geojson file. Simplified versions of the "
+        "boundary are available using the `resolution` parameter."
+    ),
+    response_class=Response,
+    responses={status.HTTP_200_OK: {"model": FeatureModel}},
 )
 async def get_area_boundary(
     areacode: str,
-    db: Elasticsearch = Depends(get_db),
+    request: Request,
+    resolution: Literal["full", "high", "medium", "low"] = Query("full"),
     client: S3Client = Depends(get_s3_client),
 ):
-    area = crud.get_area_boundary(db, client, areacode)
-    if not area:
+    # the stored GeoJSON is sent as it is, without being parsed, using a
+    # version compressed on import if the client accepts one
+    for encoding in accepted_encodings(request.headers.get("accept-encoding")):
+        boundary = await run_db(
+            crud.get_area_boundary, client, areacode, resolution, encoding
+        )
+        if boundary:
+            break
+    if not boundary:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No area found for {}".format(areacode),
         )
-    return area
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=boundary, media_type="application/json", headers=headers)
+
+
+@router.get(
+    "/areas/{areacode}/postcodes",
+    tags=["Areas"],
+    description=(
+        "Get every postcode in an area. Results are streamed as a JSON array, "
+        "newline-delimited JSON or CSV."
+    ),
+    response_class=StreamingResponse,
+)
+async def get_area_postcodes(
+    areacode: str,
+    fields: list[str] = Query([]),
+    format: Literal["json", "ndjson", "csv"] = Query("json"),
+    db: Elasticsearch = Depends(get_db),
+):
+    if not crud.area_postcode_fields(areacode) or not await run_db(
+        crud.area_exists, db, areacode
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No area found for {}".format(areacode),
+        )
+
+    if fields:
+        fields = ["pcds"] + [f for f in fields if f != "pcds"]
+    chunks = crud.iter_area_postcodes(db, areacode, fields=fields)
+    if format == "csv":
+        csv_fields = fields or [
+            f.name for f in dataclasses.fields(Postcode) if f.name != "location"
+        ]
+        return StreamingResponse(
+            records_to_csv(chunks, csv_fields),
+            media_type="text/csv",
+            headers={
+                "Content-Disposition": 'attachment; filename="{}-postcodes.csv"'.format(
+                    areacode
+                )
+            },
+        )
+    if format == "ndjson":
+        return StreamingResponse(
+            records_to_ndjson(chunks, fields), media_type="application/x-ndjson"
+        )
+    return StreamingResponse(
+        records_to_json(chunks, fields), media_type="application/json"
+    )
 
 
 @router.get(
@@ -142,10 +330,65 @@ async def get_area_boundary(
     description="Search areas",
 )
 async def search_areas(areacode: str, db: Elasticsearch = Depends(get_db)):
-    area = crud.get_area(db, areacode)
+    area = await run_db(crud.get_area, db, areacode)
     if not area:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No area found for {}".format(areacode),
         )
     return area
+
+
+@router.get(
+    "/tiles/{areatype}/{z}/{x}/{y}.mvt",
+    tags=["Areas"],
+    description=(
+        "Get the boundaries of every area of a type as a Mapbox vector tile. "
+        "Each feature has the area's `code` and `name`, and only live areas "
+        "are included. Area types with many small areas, such as output "
+        "areas, only have tiles at higher zoom levels. Returns a 503 error "
+        "while the boundaries are loading, or if they can't be loaded."
+    ),
+    response_class=Response,
+)
+async def get_boundary_tile(
+    areatype: str,
+    z: int,
+    x: int,
+    y: int,
+    db: Elasticsearch = Depends(get_db),
+    client: S3Client = Depends(get_s3_client),
+):
+    if areatype not in settings.AREA_TYPES or not tile_is_valid(
+        z, x, y, settings.TILE_MAX_ZOOM, settings.TILE_MIN_ZOOM.get(areatype, 0)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No tile found for {}/{}/{}/{}".format(areatype, z, x, y),
+        )
+    try:
+        tile = await run_in_threadpool(
+            crud.get_boundary_tile, db, client, areatype, z, x, y
+        )
+    except BoundariesUnavailable as e:
+        raise boundaries_unavailable(str(e), e.retry_after)
+    if tile is None:
+        raise boundaries_loading()
+    return Response(content=tile, media_type=TILE_MEDIA_TYPE)
+
+
+def boundaries_loading() -> HTTPException:
+    return boundaries_unavailable(
+        "Boundaries are loading, please try again shortly",
+        settings.BOUNDARY_LOAD_RETRY_AFTER,
+    )
+
+
+def boundaries_unavailable(
+    detail: str, retry_after: Optional[float] = None
+) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=detail,
+        headers={"Retry-After": str(math.ceil(retry_after))} if retry_after else None,
+    )
@@ -0,0 +1,626 @@
+"""
+In-process caches for data that rarely changes between imports
+"""
+
+import bisect
+import datetime
+import hashlib
+import logging
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+
+from findthatpostcode import settings
+from findthatpostcode.documents import Release
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+# area codes (with an optional resolution and encoding) and tile names that
+# are safe to use as a file name
+SAFE_NAME_REGEX = re.compile(r"^[A-Za-z0-9]+(\.[A-Za-z0-9]+)*$")
+
+
+class LRUCache:
+    """
+    A size-bounded least-recently-used cache with an optional time to live
+
+    Safe to share between threads. Keeps count of hits and misses so the
+    effectiveness of the cache can be checked. If `max_bytes` is given the
+    total length of any `bytes` or `str` values (or the `nbytes` of other
+    values that have it) is kept under it too.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, Tuple[Optional[float], Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, MISSING, count=False) is not MISSING
+
+    def _get(self, key: Hashable, now: float) -> Any:
+        item = self._data.get(key, None)
+        if item is None:
+            return MISSING
+        expires, value = item
+        if expires is not None and expires < now:
+            self._remove(key)
+            return MISSING
+        self._data.move_to_end(key)
+        return value
+
+    @staticmethod
+    def _sizeof(value: Any) -> int:
+        if isinstance(value, (bytes, str)):
+            return len(value)
+        return getattr(value, "nbytes", 0)
+
+    def _remove(self, key: Hashable) -> None:
+        _, value = self._data.pop(key)
+        self.bytes -= self._sizeof(value)
+
+    def _set(self, key: Hashable, value: Any, now: float) -> None:
+        size = self._sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        expires = now + self.ttl if self.ttl else None
+        self._data[key] = (expires, value)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._data)))
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        with self._lock:
+            value = self._get(key, time.monotonic())
+            if count:
+                if value is MISSING:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return default if value is MISSING else value
+
+    def get_many(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, Any], List]:
+        """
+        Return a tuple of the cached values found and a list of missing keys
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                value = self._get(key, now)
+                if value is MISSING:
+                    missing.append(key)
+                else:
+                    found[key] = value
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._set(key, value, time.monotonic())
+
+    def set_many(self, values: Dict[Hashable, Any]) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for key, value in values.items():
+                self._set(key, value, now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+class BoundariesUnavailable(Exception):
+    """
+    Raised for spatial indexes that can't be built at the moment, with the
+    number of seconds until they will be tried again (if they will be)
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AreaBoundaryIndexes:
+    """
+    Spatial indexes of every boundary of an area type, built in the background
+
+    Building an index means fetching every boundary of an area type, so it is
+    never done while a request waits. `get` returns `None` for an index that
+    isn't loaded yet and queues it to be built by a single background thread,
+    one at a time. Built indexes are kept in an LRU cache limited by their
+    estimated size.
+
+    An index is built at most once every `retry_interval` seconds, so one
+    that fails to load, or is pushed out of the cache by others, isn't built
+    again on every request - `get` raises `BoundariesUnavailable` instead. An
+    index too big for the cache is never built again (until the cache is
+    cleared for a new data version).
+    """
+
+    def __init__(
+        self, maxsize: int, max_bytes: Optional[int] = None, retry_interval: float = 0
+    ):
+        self.memory = LRUCache(maxsize=maxsize, max_bytes=max_bytes)
+        self.retry_interval = retry_interval
+        self._queue: queue.Queue = queue.Queue()
+        self._pending: set = set()
+        # key -> (time last built, reason it isn't available if it's missing)
+        self._built: Dict[Hashable, Tuple[float, str]] = {}
+        self._too_big: set = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        """
+        Return the index for a key, or `None` after queueing `load` to build it
+        """
+        index = self.memory.get(key)
+        if index is not None:
+            return index
+        with self._lock:
+            if key in self._too_big:
+                raise BoundariesUnavailable(
+                    "These boundaries are too big to be held in memory"
+                )
+            if key not in self._pending:
+                built_at, reason = self._built.get(key, (None, ""))
+                if built_at is not None:
+                    retry_after = built_at + self.retry_interval - time.monotonic()
+                    if retry_after > 0:
+                        raise BoundariesUnavailable(reason, retry_after)
+                self._pending.add(key)
+                self._queue.put((key, load))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="area-boundaries-load", daemon=True
+                )
+                self._thread.start()
+        return None
+
+    def _run(self) -> None:
+        while True:
+            key, load = self._queue.get()
+            reason = "These boundaries could not be loaded"
+            try:
+                self.memory.set(key, load())
+                if key in self.memory:
+                    reason = "These boundaries were removed from memory for others"
+                else:
+                    logger.warning("The index for %s is too big to be kept", key)
+                    with self._lock:
+                        self._too_big.add(key)
+            except Exception:
+                logger.exception("Could not load the boundaries for %s", key)
+            finally:
+                with self._lock:
+                    self._built[key] = (time.monotonic(), reason)
+                    self._pending.discard(key)
+                self._queue.task_done()
+
+    def wait(self) -> None:
+        """
+        Block until every queued index has been built
+        """
+        self._queue.join()
+
+    def clear(self) -> None:
+        self.memory.clear()
+        with self._lock:
+            self._built.clear()
+            self._too_big.clear()
+
+
+class AreaNameTable:
+    """
+    A compact, read-only table of area code -> (name, name_welsh, type)
+
+    Codes are held in a sorted list and looked up with a binary search, with
+    the names in parallel lists and the area types stored as indexes into a
+    short list of type names. All strings are interned. Once loaded the table
+    answers `get_area_names` lookups without any network calls.
+    """
+
+    def __init__(self):
+        # (codes, names, welsh names, type indexes, type names)
+        self._data: Tuple[List[str], List, List, array, List] = (
+            [],
+            [],
+            [],
+            array("H"),
+            [],
+        )
+        self.loaded_at: Optional[float] = None
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._data[0])
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def load(self, db: Elasticsearch, index: str = settings.ES_INDICES["area"]):
+        """
+        Stream every area from the index and replace the contents of the table
+        """
+        start = time.monotonic()
+        rows = []
+        type_index: Dict[Optional[str], int] = {}
+        for hit in scan(
+            db,
+            index=index,
+            query={"_source": ["code", "name", "name_welsh", "type"]},
+            size=settings.AREA_NAMES_PRELOAD_PAGE_SIZE,
+        ):
+            source = hit["_source"]
+            area_type = source.get("type")
+            if area_type not in type_index:
+                type_index[area_type] = len(type_index)
+            rows.append(
+                (
+                    sys.intern(source.get("code") or hit["_id"]),
+                    sys.intern(source["name"]) if source.get("name") else None,
+                    sys.intern(source["name_welsh"])
+                    if source.get("name_welsh")
+                    else None,
+                    type_index[area_type],
+                )
+            )
+        rows.sort(key=lambda row: row[0])
+
+        # swap the new contents in one go so readers never see a partial table
+        self._data = (
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+            [row[2] for row in rows],
+            array("H", [row[3] for row in rows]),
+            list(type_index.keys()),
+        )
+        self.loaded_at = time.time()
+        logger.info(
+            "Loaded %s areas into the area name table in %.1f seconds (%s)",
+            len(rows),
+            time.monotonic() - start,
+            "{:,.0f} bytes".format(self.memory_report()["total_bytes"]),
+        )
+
+    def get(self, code: str) -> Optional[Tuple[Optional[str], Optional[str], str]]:
+        codes, names, names_welsh, types, type_names = self._data
+        i = bisect.bisect_left(codes, code)
+        if i == len(codes) or codes[i] != code:
+            return None
+        return (names[i], names_welsh[i], type_names[types[i]])
+
+    def get_names(self, area_codes: Iterable[str]) -> Dict[str, Tuple[str, str]]:
+        """
+        Return lookups in the same format as `crud.get_area_names`
+        """
+        names = {}
+        for code in area_codes:
+            area = self.get(code)
+            if area and (area[0] or area[1]):
+                names[code] = (area[0], area[2])
+        return names
+
+    def start_refresh(self, get_db: Callable[[], Elasticsearch], interval: float):
+        """
+        Reload the table in a background thread every `interval` seconds
+        """
+
+        def refresh():
+            while not self._stop.wait(interval):
+                try:
+                    self.load(get_db())
+                except Exception:
+                    logger.exception("Failed to refresh the area name table")
+
+        self._stop.clear()
+        self._refresh_thread = threading.Thread(
+            target=refresh, name="area-name-refresh", daemon=True
+        )
+        self._refresh_thread.start()
+
+    def stop_refresh(self):
+        self._stop.set()
+
+    def memory_report(self) -> Dict[str, int]:
+        """
+        Approximate memory used by the table, in bytes
+        """
+        seen: set = set()
+
+        def strings_size(values: Iterable[Optional[str]]) -> int:
+            size = 0
+            for value in values:
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+            return size
+
+        codes, names, names_welsh, types, type_names = self._data
+        report = {
+            "areas": len(codes),
+            "containers_bytes": sum(sys.getsizeof(c) for c in self._data),
+            "codes_bytes": strings_size(codes),
+            "names_bytes": strings_size(names)
+            + strings_size(names_welsh)
+            + strings_size(type_names),
+        }
+        report["total_bytes"] = (
+            report["containers_bytes"] + report["codes_bytes"] + report["names_bytes"]
+        )
+        return report
+
+
+class ReleaseVersion:
+    """
+    The combined version of every dataset imported, used as an HTTP ETag
+
+    The versions are read from the release index at most once every `ttl`
+    seconds, so checking whether a response has changed does not normally
+    need a call to the database. When the version changes the area name cache
+    is cleared, as it may hold names from the previous release.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[datetime.datetime] = None
+        self.checked_at: Optional[float] = None
+
+    @property
+    def stale(self) -> bool:
+        return self.checked_at is None or (
+            time.monotonic() - self.checked_at > self.ttl
+        )
+
+    def refresh(self, db: Elasticsearch) -> None:
+        # mark as checked first so concurrent requests don't all refresh
+        self.checked_at = time.monotonic()
+        try:
+            releases = list(Release.search(using=db).extra(size=1000).execute())
+        except Exception:
+            logger.exception("Could not fetch the data release versions")
+            return
+        if not releases:
+            self.etag = self.last_modified = None
+            return
+
+        versions = sorted("{}:{}".format(r.dataset, r.version) for r in releases)
+        etag = hashlib.md5("|".join(versions).encode()).hexdigest()[0:16]
+        last_modified = max(r.imported_at for r in releases)
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+
+        if self.etag is not None and etag != self.etag:
+            logger.info("Data release changed from %s to %s", self.etag, etag)
+            area_names.clear()
+            boundaries.memory.clear()
+            tiles.memory.clear()
+            area_boundaries.clear()
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def clear(self) -> None:
+        self.etag = self.last_modified = self.checked_at = None
+
+
+class BoundaryCache:
+    """
+    Raw GeoJSON boundaries, held in memory and on disk
+
+    Boundaries are stored as the bytes fetched from storage, so they can be
+    sent on without being parsed. Entries are keyed by area code and the data
+    version, and areas without a boundary are remembered (in memory) as
+    `None` so storage is only asked once. Files on disk are kept in a
+    directory per version - directories for other versions are removed when
+    a new version is first seen, and the least recently used files are
+    removed once the directory grows past `disk_max_bytes`. Vector tiles of
+    boundaries are cached in the same way, with a different `suffix`.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 0,
+        maxsize: int = 100000,
+        suffix: str = ".json",
+    ):
+        self.memory = LRUCache(maxsize=maxsize, max_bytes=max_bytes)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.suffix = suffix
+        self._disk_version: Optional[str] = None
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self, areacode: str, version: str, load: Callable[[], Optional[bytes]]
+    ) -> Optional[bytes]:
+        """
+        Return the boundary for an area, calling `load` to fetch it on a miss
+        """
+        boundary = self.peek(areacode, version)
+        if boundary is not MISSING:
+            return boundary
+        boundary = load()
+        if boundary is not None:
+            self._write_disk(areacode, version, boundary)
+        self.memory.set((version, areacode), boundary)
+        return boundary
+
+    def peek(self, areacode: str, version: str) -> Any:
+        """
+        Return the boundary for an area if it is cached, otherwise `MISSING`
+        """
+        key = (version, areacode)
+        boundary = self.memory.get(key, MISSING)
+        if boundary is not MISSING:
+            return boundary
+        boundary = self._read_disk(areacode, version)
+        if boundary is None:
+            return MISSING
+        self.memory.set(key, boundary)
+        return boundary
+
+    def clear(self) -> None:
+        self.memory.clear()
+        with self._lock:
+            if self.disk_dir and os.path.isdir(self.disk_dir):
+                shutil.rmtree(self.disk_dir, ignore_errors=True)
+            self._disk_version = None
+            self._disk_bytes = 0
+
+    def _disk_path(self, areacode: str, version: str) -> Optional[str]:
+        if not self.disk_dir or self.disk_max_bytes <= 0:
+            return None
+        if not SAFE_NAME_REGEX.match(areacode):
+            return None
+        version_dir = re.sub(r"[^A-Za-z0-9_-]", "_", version) or "unversioned"
+        return os.path.join(self.disk_dir, version_dir, areacode + self.suffix)
+
+    def _read_disk(self, areacode: str, version: str) -> Optional[bytes]:
+        path = self._disk_path(areacode, version)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                boundary = f.read()
+            # the modified time is used to find the least recently used files
+            os.utime(path)
+            return boundary
+        except OSError:
+            return None
+
+    def _write_disk(self, areacode: str, version: str, boundary: bytes) -> None:
+        path = self._disk_path(areacode, version)
+        if path is None or len(boundary) > self.disk_max_bytes:
+            return
+        version_dir = os.path.dirname(path)
+        with self._lock:
+            try:
+                if self._disk_version != version_dir:
+                    self._start_disk_version(version_dir)
+                tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+                with open(tmp_path, "wb") as f:
+                    f.write(boundary)
+                os.replace(tmp_path, path)
+                self._disk_bytes += len(boundary)
+                if self._disk_bytes > self.disk_max_bytes:
+                    self._evict_disk(version_dir)
+            except OSError:
+                logger.exception("Could not write the boundary for %s", areacode)
+
+    def _start_disk_version(self, version_dir: str) -> None:
+        assert self.disk_dir
+        os.makedirs(version_dir, exist_ok=True)
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_dir() and entry.path != version_dir:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        self._disk_version = version_dir
+        self._disk_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(version_dir)
+        )
+
+    def _evict_disk(self, version_dir: str) -> None:
+        # remove the least recently used files until under 90% of the limit
+        files = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(version_dir)
+            if entry.name.endswith(self.suffix)
+        )
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in files:
+            if self._disk_bytes <= target:
+                break
+            os.remove(path)
+            self._disk_bytes -= size
+
+
+# area code -> (name, type) or None if the area has no name
+area_names = LRUCache(
+    maxsize=settings.AREA_NAMES_CACHE_SIZE,
+    ttl=settings.AREA_NAMES_CACHE_TTL,
+)
+
+# preloaded table of every area, used instead of the LRU cache when loaded
+area_table = AreaNameTable()
+
+# version of the imported data, checked every RELEASE_CHECK_INTERVAL seconds
+release = ReleaseVersion(ttl=settings.RELEASE_CHECK_INTERVAL)
+
+# raw GeoJSON boundaries by (data version, area code)
+boundaries = BoundaryCache(
+    max_bytes=settings.BOUNDARY_CACHE_MAX_BYTES,
+    disk_dir=settings.BOUNDARY_CACHE_DIR,
+    disk_max_bytes=settings.BOUNDARY_CACHE_DISK_BYTES,
+)
+
+# vector tiles by (data version, area type, z, x, y)
+tiles = BoundaryCache(
+    max_bytes=settings.TILE_CACHE_MAX_BYTES,
+    disk_dir=settings.TILE_CACHE_DIR,
+    disk_max_bytes=settings.TILE_CACHE_DISK_BYTES,
+    suffix=".mvt",
+)
+
+# spatial indexes of every boundary of an area type, by
+# (data version, area type, resolution)
+area_boundaries = AreaBoundaryIndexes(
+    maxsize=settings.AREA_BOUNDARIES_CACHE_SIZE,
+    max_bytes=settings.AREA_BOUNDARIES_CACHE_MAX_BYTES,
+    retry_interval=settings.BOUNDARY_LOAD_RETRY_INTERVAL,
+)
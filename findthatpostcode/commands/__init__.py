@@ -24,6 +24,7 @@ def import_group():
 
 
 import_group.add_command(postcodes.import_nspl)
+import_group.add_command(postcodes.import_postcodes)
 import_group.add_command(codes.import_rgc)
 import_group.add_command(codes.import_chd)
 import_group.add_command(codes.import_msoa_names)
@@ -39,6 +40,7 @@ def utils_group():
 
 
 utils_group.add_command(utils.sample_zip)
+utils_group.add_command(utils.area_table_report)
 
 
 cli.add_command(init_db_command)
@@ -1,29 +1,72 @@
 """
 Import commands for area boundaries
 """
+import codecs
+import contextlib
 import glob
+import gzip
 import io
+import itertools
 import json
-import os
-from typing import List, Optional
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
+import brotli
 import click
+import ijson
 import requests
 import requests_cache
+import shapely
 import tqdm
-from pydantic_geojson import FeatureCollectionModel, FeatureModel
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from pydantic import ValidationError
+from pydantic_geojson import FeatureModel
+from shapely.errors import GEOSException
+from shapely.geometry import mapping, shape
 
 from findthatpostcode import db, settings
-from findthatpostcode.documents import Area
+from findthatpostcode.documents import Area, Release
+from findthatpostcode.utils import BOUNDARY_ENCODING_SUFFIXES, boundary_key
 
 AREA_INDEX = Area.Index.name
 
+# boundaries are small objects uploaded from our own thread pool, so each one
+# is sent in a single request without boto3 starting threads of its own
+BOUNDARY_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=256 * 1024 * 1024,
+    use_threads=False,
+)
+
 
 @click.command("boundaries")
 @click.option("--es-index", default=AREA_INDEX)
 @click.option("--code-field", default=None)
 @click.option("--examine/--no-examine", default=False)
 @click.option("--remove/--no-remove", default=False)
+@click.option("--workers", default=settings.BOUNDARY_IMPORT_WORKERS, type=int)
+@click.option("--concurrency", default=settings.BOUNDARY_UPLOAD_CONCURRENCY, type=int)
+@click.option("--encoding", default="utf-8")
+@click.option("--simplify/--no-simplify", default=True)
+@click.option("--compress/--no-compress", default=True)
 @click.argument("urls", nargs=-1)
 def import_boundaries(
     urls: List[str],
@@ -31,6 +74,11 @@ def import_boundaries(
     code_field: Optional[str] = None,
     es_index: str = AREA_INDEX,
     remove: bool = False,
+    workers: int = settings.BOUNDARY_IMPORT_WORKERS,
+    concurrency: int = settings.BOUNDARY_UPLOAD_CONCURRENCY,
+    encoding: str = "utf-8",
+    simplify: bool = True,
+    compress: bool = True,
 ):
     es = db.get_db()
 
@@ -42,63 +90,332 @@ def import_boundaries(
                 "script": 'ctx._source.remove("boundary")',
                 "query": {"exists": {"field": "boundary"}},
             },
+            request_timeout=settings.ES_BULK_TIMEOUT,
         )
         return
 
     if settings.DEBUG:
         requests_cache.install_cache()
 
-    # initialise the boto3 session
-    client = db.get_s3_client()
-
+    sources = []
     for url in urls:
         if url.startswith("http"):
-            import_boundary(client, url, examine, code_field)
+            sources.append(url)
         else:
-            files = glob.glob(url, recursive=True)
-            for file in files:
-                import_boundary(client, file, examine, code_field)
-
-
-def import_boundary(client, url, examine=False, code_field=None):
-    boundary_data = {}
-    if url.startswith("http"):
-        r = requests.get(url, stream=True)
-        boundary_data = r.json()
-    elif os.path.isfile(url):
-        with open(url, mode="r", encoding="latin1") as f:
-            boundary_data = json.load(f)
-    boundaries = FeatureCollectionModel.parse_obj(boundary_data)
-    errors = []
+            sources.extend(glob.glob(url, recursive=True))
 
-    # find the code field for a boundary
-    if len(boundaries.features) == 0:
-        errors.append("[ERROR][%s] Features not found in file" % (url,))
-    if len(boundaries.features) > 0 and not code_field:
-        test_boundary = None
-        for k in boundaries.features:
-            if isinstance(k, FeatureModel):
-                test_boundary = k
-                break
-        if not test_boundary:
-            errors.append("[ERROR][%s] No valid features found in file" % (url,))
-        else:
-            code_fields = []
-            properties = getattr(test_boundary, "properties", None)
-            if properties:
-                for k in properties:
-                    if k.lower().endswith("cd"):
-                        code_fields.append(k)
-            if len(code_fields) == 1:
-                code_field = code_fields[0]
-            elif len(code_fields) == 0:
-                errors.append("[ERROR][%s] No code field found in file" % (url,))
-            else:
-                errors.append("[ERROR][%s] Too many code fields found in file" % (url,))
-                errors.append(
-                    "[ERROR][%s] Code fields: %s" % (url, "; ".join(code_fields))
+    start = time.monotonic()
+    summaries = []
+    if workers > 1 and len(sources) > 1 and not examine:
+        # each process creates its own S3 client, as they can't be shared
+        print(f"[boundaries] Importing {len(sources)} files with {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    import_boundary,
+                    None,
+                    source,
+                    examine,
+                    code_field,
+                    concurrency,
+                    encoding,
+                    simplify,
+                    compress,
+                )
+                for source in sources
+            ]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+    else:
+        # initialise the boto3 session
+        client = db.get_s3_client()
+        for source in sources:
+            summaries.append(
+                import_boundary(
+                    client,
+                    source,
+                    examine,
+                    code_field,
+                    concurrency,
+                    encoding,
+                    simplify,
+                    compress,
+                )
+            )
+
+    summaries = [s for s in summaries if s]
+    if summaries:
+        elapsed = max(time.monotonic() - start, 1e-9)
+        uploaded = sum(s["uploaded"] for s in summaries)
+        print(
+            "[boundaries] {:,.0f} files, {:,.0f} boundaries uploaded, "
+            "{:,.0f} failed, {:,.1f} MB in {:,.1f} seconds "
+            "({:,.0f} boundaries/sec, {:,.2f} MB/sec)".format(
+                len(summaries),
+                uploaded,
+                sum(s["failed"] for s in summaries),
+                sum(s["bytes"] for s in summaries) / 1024 / 1024,
+                elapsed,
+                uploaded / elapsed,
+                sum(s["bytes"] for s in summaries) / elapsed / 1024 / 1024,
+            )
+        )
+
+        # boundaries are cached by data version, so record a new one
+        Release.record(
+            es, "boundaries", time.strftime("%Y%m%d%H%M%S"), source=", ".join(urls)
+        )
+
+
+def upload_object(client, key: str, body: bytes) -> int:
+    """
+    Upload one object to S3, retrying with a backoff if it fails
+    """
+    for attempt in range(settings.BOUNDARY_UPLOAD_RETRIES + 1):
+        try:
+            client.upload_fileobj(
+                io.BytesIO(body),
+                settings.S3_BUCKET,
+                key,
+                Config=BOUNDARY_TRANSFER_CONFIG,
+            )
+            return len(body)
+        except (BotoCoreError, ClientError):
+            if attempt == settings.BOUNDARY_UPLOAD_RETRIES:
+                raise
+            time.sleep(settings.BOUNDARY_UPLOAD_BACKOFF * 2**attempt)
+    return 0
+
+
+def upload_boundary(
+    client,
+    area_code: str,
+    feature: Dict[str, Any],
+    simplify: bool = True,
+    compress: bool = True,
+) -> int:
+    """
+    Upload a boundary to S3, along with its simplified and compressed versions
+    """
+    return sum(
+        upload_object(client, key, body)
+        for key, body in boundary_objects(area_code, feature, simplify, compress)
+    )
+
+
+def upload_boundaries(
+    client,
+    boundaries: Iterable[Tuple[str, Dict[str, Any]]],
+    concurrency: int = settings.BOUNDARY_UPLOAD_CONCURRENCY,
+    simplify: bool = True,
+    compress: bool = True,
+) -> Dict[str, Any]:
+    """
+    Upload (area code, feature) pairs to S3 from a pool of threads
+
+    Only a couple of boundaries per thread are queued at once, so they aren't
+    all held in memory if uploading is slower than reading them. Boundaries
+    that still fail after retrying, or that can't be simplified, are reported
+    and counted.
+    """
+    summary: Dict[str, Any] = {"uploaded": 0, "failed": 0, "bytes": 0}
+    pending: Set[Future] = set()
+    area_codes: Dict[Future, str] = {}
+
+    def collect(done: Iterable[Future]) -> None:
+        for future in done:
+            area_code = area_codes.pop(future)
+            try:
+                summary["bytes"] += future.result()
+                summary["uploaded"] += 1
+            except (BotoCoreError, ClientError) as e:
+                print(f"[ERROR] Could not upload {area_code}: {e}")
+                summary["failed"] += 1
+            except GEOSException as e:
+                # the full boundary has been uploaded, but not the simplified ones
+                print(f"[ERROR] Could not simplify {area_code}: {e}")
+                summary["failed"] += 1
+            progress.update(1)
+
+    with ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as executor, tqdm.tqdm() as progress:
+        for area_code, feature in boundaries:
+            if len(pending) >= concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(
+                upload_boundary, client, area_code, feature, simplify, compress
+            )
+            area_codes[future] = area_code
+            pending.add(future)
+        collect(wait(pending).done)
+    return summary
+
+
+def simplify_geometry(geometry, tolerance: float, precision: int):
+    """
+    Simplify a shapely geometry and round its coordinates to `precision`
+    decimal places, keeping the original if it would disappear altogether
+
+    Invalid geometries (such as self-intersecting polygons) are made valid
+    first, as snapping them to the grid would fail.
+    """
+    if not geometry.is_valid:
+        geometry = shapely.make_valid(geometry)
+    simplified = geometry.simplify(tolerance, preserve_topology=True)
+    if simplified.is_empty:
+        simplified = geometry
+    # snap to the grid first so that the result is still a valid geometry
+    snapped = shapely.set_precision(simplified, 10**-precision)
+    if not snapped.is_empty:
+        simplified = snapped
+    return shapely.transform(simplified, lambda coords: coords.round(precision))
+
+
+def compress_boundary(body: bytes, encoding: str) -> bytes:
+    """
+    Compress a boundary for one of the `Content-Encoding`s it is stored in
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=settings.BOUNDARY_BROTLI_QUALITY)
+    if encoding == "gzip":
+        # a fixed mtime means the same boundary always compresses the same way
+        return gzip.compress(body, compresslevel=settings.BOUNDARY_GZIP_LEVEL, mtime=0)
+    raise ValueError("Unknown encoding: %s" % encoding)
+
+
+def boundary_objects(
+    area_code: str,
+    feature: Dict[str, Any],
+    simplify: bool = True,
+    compress: bool = True,
+) -> Generator[Tuple[str, bytes], None, None]:
+    """
+    The (key, body) pairs stored in S3 for a boundary - the feature as it was
+    imported, followed by a version at each of `settings.BOUNDARY_RESOLUTIONS`
+
+    Each one is also stored compressed with gzip and brotli, so the API can
+    send them on without compressing them for every request. The simplified
+    versions are made after the full boundary has been yielded, so if one
+    can't be made (raising `GEOSException`) the full boundary is still stored.
+    """
+
+    def encoded(resolution: str, body: bytes) -> Iterable[Tuple[str, bytes]]:
+        yield boundary_key(area_code, resolution), body
+        if compress:
+            for encoding in BOUNDARY_ENCODING_SUFFIXES:
+                yield (
+                    boundary_key(area_code, resolution, encoding),
+                    compress_boundary(body, encoding),
                 )
 
+    yield from encoded("full", json.dumps(feature).encode("utf-8"))
+    if not simplify or not feature.get("geometry"):
+        return
+    geometry = shape(feature["geometry"])
+    for resolution, (tolerance, precision) in settings.BOUNDARY_RESOLUTIONS.items():
+        simplified = {
+            **feature,
+            "geometry": mapping(simplify_geometry(geometry, tolerance, precision)),
+        }
+        yield from encoded(resolution, json.dumps(simplified).encode("utf-8"))
+
+
+class UTF8Reader:
+    """
+    Recode a binary file in another encoding to UTF-8 as it is read, as the
+    streaming JSON parser only reads UTF-8
+    """
+
+    def __init__(self, f: IO[bytes], encoding: str):
+        self.text = io.TextIOWrapper(f, encoding=encoding)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.text.read(size).encode("utf-8")
+
+
+def iter_features(
+    url: str, encoding: str = "utf-8"
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Yield the features of a GeoJSON FeatureCollection one at a time
+
+    The `features` array is parsed incrementally, so only one feature is held
+    in memory at once however large the file is.
+    """
+    with contextlib.ExitStack() as stack:
+        if url.startswith("http"):
+            r = stack.enter_context(requests.get(url, stream=True))
+            r.raise_for_status()
+            r.raw.decode_content = True
+            source = r.raw
+        else:
+            source = stack.enter_context(open(url, mode="rb"))
+        if codecs.lookup(encoding).name != "utf-8":
+            source = UTF8Reader(source, encoding)
+        yield from ijson.items(source, "features.item", use_float=True)
+
+
+def valid_features(
+    features: Iterable[Dict[str, Any]], url: str
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Validate features one at a time, skipping any that aren't valid GeoJSON
+    """
+    for k, feature in enumerate(features):
+        try:
+            FeatureModel.model_validate(feature)
+        except ValidationError as e:
+            print("[ERROR][%s] Feature %s is not valid: %s" % (url, k, e))
+            continue
+        yield feature
+
+
+def find_code_field(feature: Dict[str, Any], url: str) -> Tuple[Optional[str], List]:
+    """
+    Find the property of a feature holding the area code, returning it along
+    with any errors
+    """
+    code_fields = [
+        k for k in (feature.get("properties") or {}) if k.lower().endswith("cd")
+    ]
+    if len(code_fields) == 1:
+        return code_fields[0], []
+    if len(code_fields) == 0:
+        return None, ["[ERROR][%s] No code field found in file" % (url,)]
+    return None, [
+        "[ERROR][%s] Too many code fields found in file" % (url,),
+        "[ERROR][%s] Code fields: %s" % (url, "; ".join(code_fields)),
+    ]
+
+
+def import_boundary(
+    client,
+    url,
+    examine=False,
+    code_field=None,
+    concurrency=settings.BOUNDARY_UPLOAD_CONCURRENCY,
+    encoding="utf-8",
+    simplify=True,
+    compress=True,
+) -> Optional[Dict[str, Any]]:
+    if client is None:
+        client = db.get_s3_client()
+    start = time.monotonic()
+    features = valid_features(iter_features(url, encoding), url)
+    errors = []
+
+    # find the code field from the first feature
+    first_feature = next(features, None)
+    if first_feature is None:
+        errors.append("[ERROR][%s] No valid features found in file" % (url,))
+    elif not code_field:
+        code_field, code_field_errors = find_code_field(first_feature, url)
+        errors.extend(code_field_errors)
+    if first_feature is not None:
+        features = itertools.chain([first_feature], features)
+
     if isinstance(code_field, str):
         code = code_field.lower().replace("cd", "")
     else:
@@ -115,47 +432,42 @@ def import_boundary(client, url, examine=False, code_field=None):
     if examine:
         print("[%s] Opened file: [%s]" % (code, url))
         print("[%s] Looking for code field: [%s]" % (code, code_field))
-        print("[%s] Geojson type: [%s]" % (code, boundaries.type))
-        print("[%s] Number of features [%s]" % (code, len(boundaries.features)))
-        for k, i in enumerate(boundaries.features[:5]):
-            print("[%s] Feature %s type %s" % (code, k, i.type))
-            if isinstance(i, FeatureModel):
-                properties = getattr(i, "properties", {})
-                print(
-                    "[%s] Feature %s properties %s" % (code, k, list(properties.keys()))
-                )
-                print("[%s] Feature %s geometry type %s" % (code, k, i.geometry.type))
-                print(
-                    "[%s] Feature %s geometry length %s"
-                    % (code, k, len(str(i.geometry.coordinates)))
-                )
-                if code_field in properties:
-                    print("[%s] Feature %s Code %s" % (code, k, properties[code_field]))
-                else:
-                    print(
-                        "[ERROR][%s] Feature %s Code field not found"
-                        % (
-                            code,
-                            k,
-                        )
-                    )
+        feature_count = 0
+        for k, feature in enumerate(features):
+            feature_count += 1
+            if k >= 5:
+                continue
+            properties = feature.get("properties") or {}
+            print("[%s] Feature %s type %s" % (code, k, feature["type"]))
+            print("[%s] Feature %s properties %s" % (code, k, list(properties.keys())))
+            print(
+                "[%s] Feature %s geometry type %s"
+                % (code, k, feature["geometry"]["type"])
+            )
+            print(
+                "[%s] Feature %s geometry length %s"
+                % (code, k, len(str(feature["geometry"]["coordinates"])))
+            )
+            if code_field in properties:
+                print("[%s] Feature %s Code %s" % (code, k, properties[code_field]))
+            else:
+                print("[ERROR][%s] Feature %s Code field not found" % (code, k))
+        print("[%s] Number of features [%s]" % (code, feature_count))
+        return None
 
-    else:
-        print("[%s] Opened file: [%s]" % (code, url))
-        print("[%s] %s features to import" % (code, len(boundaries.features)))
-        boundary_count = 0
-        errors = []
-        for k, i in tqdm.tqdm(
-            enumerate(boundaries.features), total=len(boundaries.features)
-        ):
-            if isinstance(i, FeatureModel):
-                properties = getattr(i, "properties", {})
-                area_code = properties[code_field]
-                prefix = area_code[0:3]
-                client.upload_fileobj(
-                    io.BytesIO(json.dumps(i).encode("utf-8")),
-                    settings.S3_BUCKET,
-                    "%s/%s.json" % (prefix, area_code),
-                )
-                boundary_count += 1
-        print("[%s] %s boundaries imported" % (code, boundary_count))
+    print("[%s] Opened file: [%s]" % (code, url))
+
+    summary = upload_boundaries(
+        client,
+        ((feature["properties"][code_field], feature) for feature in features),
+        concurrency,
+        simplify,
+        compress,
+    )
+    summary["url"] = url
+    summary["seconds"] = time.monotonic() - start
+    print(
+        "[%s] %s boundaries imported, %s failed"
+        % (code, summary["uploaded"], summary["failed"])
+    )
+    return summary
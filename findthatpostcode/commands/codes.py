@@ -1,20 +1,25 @@
 """
 Import commands for the register of geographic codes and code history database
 """
-import codecs
 import csv
 import io
 import zipfile
 from collections import defaultdict
 
 import click
-import requests
 import requests_cache
 import tqdm
 
-from findthatpostcode import db, settings
-from findthatpostcode.documents import Area, Entity
-from findthatpostcode.utils import BulkImporter, process_date, process_float
+from findthatpostcode import cache, db, settings
+from findthatpostcode.documents import Area, Entity, Release
+from findthatpostcode.utils import (
+    BulkImporter,
+    download_file,
+    file_hash,
+    process_date,
+    process_float,
+    zip_version,
+)
 
 ENTITY_INDEX = Entity.Index.name
 AREA_INDEX = Area.Index.name
@@ -31,17 +36,21 @@ EQUIVALENT_CODES = {
 @click.option("--url", default=settings.RGC_URL)
 @click.option("--es-index", default=ENTITY_INDEX)
 @click.option("--file", default=None)
-def import_rgc(url=settings.RGC_URL, es_index=ENTITY_INDEX, file=None):
+@click.option("--force/--no-force", default=False)
+def import_rgc(url=settings.RGC_URL, es_index=ENTITY_INDEX, file=None, force=False):
     if settings.DEBUG:
         requests_cache.install_cache()
 
     es = db.get_db()
 
-    if file:
-        z = zipfile.ZipFile(file)
-    else:
-        r = requests.get(url, stream=True)
-        z = zipfile.ZipFile(io.BytesIO(r.content))
+    source = file or url
+    file = file or download_file(url)
+    source_hash = file_hash(file)
+    if not force and Release.unchanged(es, "rgc", source_hash):
+        print(f"[rgc] {source} is unchanged since the last import, skipping")
+        return
+
+    z = zipfile.ZipFile(file)
 
     Entity.init(using=es)
 
@@ -61,29 +70,52 @@ def import_rgc(url=settings.RGC_URL, es_index=ENTITY_INDEX, file=None):
                     }
                 )
 
+    Release.record(
+        es,
+        "rgc",
+        zip_version(z),
+        source=source,
+        source_hash=source_hash,
+        index=es_index,
+    )
+
 
 @click.command("chd")
 @click.option("--url", default=settings.CHD_URL)
 @click.option("--es-index", default=AREA_INDEX)
 @click.option("--file", default=None)
 @click.option("--encoding", default=settings.DEFAULT_ENCODING)
+@click.option("--new-index/--no-new-index", default=False)
+@click.option("--force/--no-force", default=False)
 def import_chd(
     url=settings.CHD_URL,
     es_index=AREA_INDEX,
     file=None,
     encoding=settings.DEFAULT_ENCODING,
+    new_index=False,
+    force=False,
 ):
+    # the versioned index is always named after the area index
+    if new_index and es_index != AREA_INDEX:
+        raise click.UsageError("--es-index can't be used with --new-index")
     if settings.DEBUG:
         requests_cache.install_cache()
 
     es = db.get_db()
-    Area.init(using=es)
 
-    if file:
-        z = zipfile.ZipFile(file)
+    source = file or url
+    file = file or download_file(url)
+    source_hash = file_hash(file)
+    if not force and Release.unchanged(es, "chd", source_hash):
+        print(f"[chd] {source} is unchanged since the last import, skipping")
+        return
+
+    if new_index:
+        es_index = db.create_versioned_index(es, Area)
     else:
-        r = requests.get(url, stream=True)
-        z = zipfile.ZipFile(io.BytesIO(r.content))
+        Area.init(using=es)
+
+    z = zipfile.ZipFile(file)
 
     areas_cache = defaultdict(list)
     areas = {}
@@ -180,6 +212,16 @@ def import_chd(
 
     with BulkImporter(es, name="areas", limit=50000) as importer:
         for area_code, area in tqdm.tqdm(areas.items()):
+            if new_index:
+                importer.add(
+                    {
+                        "_index": es_index,
+                        "_op_type": "index",
+                        "_id": area_code,
+                        "_source": area,
+                    }
+                )
+                continue
             importer.add(
                 {
                     "_index": es_index,
@@ -190,28 +232,51 @@ def import_chd(
                 }
             )
 
+    if new_index:
+        db.promote_index(es, Area, es_index)
+
+    Release.record(
+        es,
+        "chd",
+        zip_version(z),
+        source=source,
+        source_hash=source_hash,
+        index=AREA_INDEX if new_index else es_index,
+    )
+
+    # area names may have changed
+    cache.area_names.clear()
+
 
 @click.command("msoanames")
 @click.option("--url", default=settings.MSOA_URL)
 @click.option("--es-index", default=AREA_INDEX)
 @click.option("--file", default=None)
 @click.option("--encoding", default="utf-8-sig")
+@click.option("--force/--no-force", default=False)
 def import_msoa_names(
-    url=settings.MSOA_URL, es_index=AREA_INDEX, file=None, encoding="utf-8-sig"
+    url=settings.MSOA_URL,
+    es_index=AREA_INDEX,
+    file=None,
+    encoding="utf-8-sig",
+    force=False,
 ):
     if settings.DEBUG:
         requests_cache.install_cache()
 
     es = db.get_db()
 
-    if file:
-        file = open(file, encoding=encoding)
-    else:
-        r = requests.get(url, stream=True)
-        file = codecs.iterdecode(r.iter_lines(), encoding=encoding)
+    source = file or url
+    file = file or download_file(url)
+    source_hash = file_hash(file)
+    if not force and Release.unchanged(es, "msoanames", source_hash):
+        print(f"[msoanames] {source} is unchanged since the last import, skipping")
+        return
 
-    reader = csv.DictReader(file)
-    with BulkImporter(es, name="msoa names", limit=50000) as importer:
+    with open(file, encoding=encoding) as f, BulkImporter(
+        es, name="msoa names", limit=50000
+    ) as importer:
+        reader = csv.DictReader(f)
         for k, area in tqdm.tqdm(enumerate(reader)):
             alt_names = [area["msoa11hclnm"]]
             if area["msoa11hclnmw"]:
@@ -231,3 +296,15 @@ def import_msoa_names(
                     },
                 }
             )
+
+    Release.record(
+        es,
+        "msoanames",
+        source_hash[0:12],
+        source=source,
+        source_hash=source_hash,
+        index=es_index,
+    )
+
+    # area names may have changed
+    cache.area_names.clear()
@@ -7,12 +7,11 @@ import zipfile
 from collections import defaultdict
 
 import click
-import requests
 import requests_cache
 
 from findthatpostcode import db, settings
-from findthatpostcode.documents import Placename
-from findthatpostcode.utils import BulkImporter
+from findthatpostcode.documents import Placename, Release
+from findthatpostcode.utils import BulkImporter, download_file, file_hash, zip_version
 
 PLACENAMES_INDEX = Placename.Index.name
 
@@ -69,19 +68,23 @@ AREA_LOOKUP = [
 @click.option("--es-index", default=PLACENAMES_INDEX)
 @click.option("--url", default=settings.PLACENAMES_URL)
 @click.option("--file", default=None)
+@click.option("--force/--no-force", default=False)
 def import_placenames(
-    url=settings.PLACENAMES_URL, es_index=PLACENAMES_INDEX, file=None
+    url=settings.PLACENAMES_URL, es_index=PLACENAMES_INDEX, file=None, force=False
 ):
     if settings.DEBUG:
         requests_cache.install_cache()
 
     es = db.get_db()
 
-    if file:
-        z = zipfile.ZipFile(file)
-    else:
-        r = requests.get(url, stream=True)
-        z = zipfile.ZipFile(io.BytesIO(r.content))
+    source = file or url
+    file = file or download_file(url)
+    source_hash = file_hash(file)
+    if not force and Release.unchanged(es, "placenames", source_hash):
+        print(f"[placenames] {source} is unchanged since the last import, skipping")
+        return
+
+    z = zipfile.ZipFile(file)
 
     Placename.init(using=es)
 
@@ -146,3 +149,12 @@ def import_placenames(
                             "doc": record,
                         }
                     )
+
+    Release.record(
+        es,
+        "placenames",
+        zip_version(z),
+        source=source,
+        source_hash=source_hash,
+        index=es_index,
+    )
@@ -2,33 +2,97 @@
 Import commands for the register of geographic codes and code history database
 """
 
+import contextlib
 import csv
+import hashlib
 import io
+import itertools
+import json
+import operator
+import os
+import pickle
+import sqlite3
+import tempfile
 import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import (
+    IO,
+    Any,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
 
 import click
-import requests
 import requests_cache
+from elasticsearch import Elasticsearch
 from tqdm import tqdm
 
 from findthatpostcode import db, settings
-from findthatpostcode.documents import Postcode, PostcodeSource
-from findthatpostcode.utils import BulkImporter
+from findthatpostcode.documents import Postcode, PostcodeSource, Release
+from findthatpostcode.documents.postcode import PostcodeConverter
+from findthatpostcode.utils import BulkImporter, download_file, file_hash, zip_version
 
 PC_INDEX = Postcode.Index.name
 
+# the columns used from the new parliamentary constituency lookup
+PCON_COLUMNS = {"pcd": "pcds", "pconcd": "pcon25"}
+
+# default download location of each source
+SOURCE_URLS = {
+    PostcodeSource.NSPL: settings.NSPL_URL,
+    PostcodeSource.ONSPD: settings.ONSPD_URL,
+    PostcodeSource.NHSPD: settings.NHSPD_URL,
+    PostcodeSource.PCON: settings.PCON_URL,
+}
+
+# prefix of the postcode CSV files within each source zip
+SOURCE_FILE_LOCATIONS = {
+    PostcodeSource.NSPL: "Data/multi_csv/NSPL",
+    PostcodeSource.ONSPD: "Data/multi_csv/ONSPD",
+    PostcodeSource.NHSPD: "Data/",
+    PostcodeSource.PCON: "pcd_pcon_",
+}
+
+# removes one source's record from a postcode, deleting it if none are left
+REMOVE_SOURCE_SCRIPT = """
+ctx._source.remove(params.source);
+if (ctx._source.isEmpty()) { ctx.op = 'delete' }
+"""
+
 
 @click.command("nspl")
 @click.option("--es-index", default=PC_INDEX)
 @click.option("--url", default=settings.NSPL_URL)
 @click.option("--file", default=None)
-def import_nspl(url=settings.NSPL_URL, es_index=PC_INDEX, file=None):
+@click.option("--workers", default=settings.IMPORT_WORKERS, type=int)
+@click.option("--new-index/--no-new-index", default=False)
+@click.option("--force/--no-force", default=False)
+@click.option("--incremental/--no-incremental", default=False)
+def import_nspl(
+    url=settings.NSPL_URL,
+    es_index=PC_INDEX,
+    file=None,
+    workers=settings.IMPORT_WORKERS,
+    new_index=False,
+    force=False,
+    incremental=False,
+):
     return import_from_postcode_file(
         url=url,
         es_index=es_index,
         file=file,
+        workers=workers,
+        new_index=new_index,
+        force=force,
+        incremental=incremental,
         filetype=PostcodeSource.NSPL,
-        file_location="Data/multi_csv/NSPL",
+        file_location=SOURCE_FILE_LOCATIONS[PostcodeSource.NSPL],
     )
 
 
@@ -36,13 +100,29 @@ def import_nspl(url=settings.NSPL_URL, es_index=PC_INDEX, file=None):
 @click.option("--es-index", default=PC_INDEX)
 @click.option("--url", default=settings.ONSPD_URL)
 @click.option("--file", default=None)
-def import_onspd(url=settings.ONSPD_URL, es_index=PC_INDEX, file=None):
+@click.option("--workers", default=settings.IMPORT_WORKERS, type=int)
+@click.option("--new-index/--no-new-index", default=False)
+@click.option("--force/--no-force", default=False)
+@click.option("--incremental/--no-incremental", default=False)
+def import_onspd(
+    url=settings.ONSPD_URL,
+    es_index=PC_INDEX,
+    file=None,
+    workers=settings.IMPORT_WORKERS,
+    new_index=False,
+    force=False,
+    incremental=False,
+):
     return import_from_postcode_file(
         url=url,
         es_index=es_index,
         file=file,
+        workers=workers,
+        new_index=new_index,
+        force=force,
+        incremental=incremental,
         filetype=PostcodeSource.ONSPD,
-        file_location="Data/multi_csv/ONSPD",
+        file_location=SOURCE_FILE_LOCATIONS[PostcodeSource.ONSPD],
     )
 
 
@@ -50,13 +130,29 @@ def import_onspd(url=settings.ONSPD_URL, es_index=PC_INDEX, file=None):
 @click.option("--es-index", default=PC_INDEX)
 @click.option("--url", default=settings.NHSPD_URL)
 @click.option("--file", default=None)
-def import_nhspd(url=settings.NHSPD_URL, es_index=PC_INDEX, file=None):
+@click.option("--workers", default=settings.IMPORT_WORKERS, type=int)
+@click.option("--new-index/--no-new-index", default=False)
+@click.option("--force/--no-force", default=False)
+@click.option("--incremental/--no-incremental", default=False)
+def import_nhspd(
+    url=settings.NHSPD_URL,
+    es_index=PC_INDEX,
+    file=None,
+    workers=settings.IMPORT_WORKERS,
+    new_index=False,
+    force=False,
+    incremental=False,
+):
     return import_from_postcode_file(
         url=url,
         es_index=es_index,
         file=file,
+        workers=workers,
+        new_index=new_index,
+        force=force,
+        incremental=incremental,
         filetype=PostcodeSource.NHSPD,
-        file_location="Data/",
+        file_location=SOURCE_FILE_LOCATIONS[PostcodeSource.NHSPD],
     )
 
 
@@ -64,67 +160,569 @@ def import_nhspd(url=settings.NHSPD_URL, es_index=PC_INDEX, file=None):
 @click.option("--es-index", default=PC_INDEX)
 @click.option("--url", default=settings.PCON_URL)
 @click.option("--file", default=None)
-def import_pcon(url=settings.PCON_URL, es_index=PC_INDEX, file=None):
+@click.option("--workers", default=settings.IMPORT_WORKERS, type=int)
+@click.option("--new-index/--no-new-index", default=False)
+@click.option("--force/--no-force", default=False)
+@click.option("--incremental/--no-incremental", default=False)
+def import_pcon(
+    url=settings.PCON_URL,
+    es_index=PC_INDEX,
+    file=None,
+    workers=settings.IMPORT_WORKERS,
+    new_index=False,
+    force=False,
+    incremental=False,
+):
     return import_from_postcode_file(
         url=url,
         es_index=es_index,
         file=file,
+        workers=workers,
+        new_index=new_index,
+        force=force,
+        incremental=incremental,
         filetype=PostcodeSource.PCON,
-        file_location="pcd_pcon_",
+        file_location=SOURCE_FILE_LOCATIONS[PostcodeSource.PCON],
     )
 
 
+def postcode_records(
+    pccsv: IO[bytes],
+    filetype: PostcodeSource,
+    fieldnames: Optional[List[str]] = None,
+) -> Generator[Tuple[str, Dict[str, Any]], None, None]:
+    """
+    Turn the rows of a postcode CSV file into (id, record) pairs
+
+    The id is the normalised postcode, so every source gives the same id for
+    a postcode however it is formatted in the file.
+    """
+    reader = csv.reader(io.TextIOWrapper(pccsv))
+    header = fieldnames or next(reader)
+    convert = PostcodeConverter(
+        header,
+        columns=PCON_COLUMNS if filetype == PostcodeSource.PCON else None,
+    )
+    rows = (row for row in reader if row)
+    for i, row in enumerate(rows):
+        if settings.DEBUG and i >= 100:
+            break
+        record = convert(row)
+        yield record["pcds"], record
+
+
+def postcode_actions(
+    pccsv: IO[bytes],
+    filetype: PostcodeSource,
+    es_index: str = PC_INDEX,
+    fieldnames: Optional[List[str]] = None,
+    upsert: bool = True,
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Turn the rows of a postcode CSV file into bulk actions
+
+    Records are merged into any existing document unless `upsert` is False,
+    in which case they are indexed as new documents.
+    """
+    for id_, record in postcode_records(pccsv, filetype, fieldnames):
+        yield postcode_action(id_, {filetype.value: record}, es_index, upsert)
+
+
+def postcode_action(
+    id_: str, doc: Dict[str, Any], es_index: str = PC_INDEX, upsert: bool = True
+) -> Dict[str, Any]:
+    if upsert:
+        return {
+            "_index": es_index,
+            "_op_type": "update",
+            "_id": id_,
+            "doc_as_upsert": True,
+            "doc": doc,
+        }
+    return {
+        "_index": es_index,
+        "_op_type": "index",
+        "_id": id_,
+        "_source": doc,
+    }
+
+
+def parse_postcode_file(
+    zip_path: str,
+    filename: str,
+    filetype: PostcodeSource,
+    es_index: str = PC_INDEX,
+    fieldnames: Optional[List[str]] = None,
+    upsert: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Parse one CSV file from a zip into bulk actions in a worker process
+    """
+    with zipfile.ZipFile(zip_path) as z, z.open(filename, "r") as pccsv:
+        return list(postcode_actions(pccsv, filetype, es_index, fieldnames, upsert))
+
+
+def parse_postcode_files(
+    zip_path: str,
+    filenames: List[str],
+    workers: int,
+    **kwargs,
+) -> Generator[Tuple[str, List[Dict[str, Any]]], None, None]:
+    """
+    Parse CSV files from a zip in a pool of processes, yielding the actions
+    for each file in order
+
+    Only a couple of files per worker are queued at once, so parsed actions
+    don't pile up in memory if indexing is slower than parsing.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(filenames)
+        pending: Deque[Tuple[str, Future]] = deque()
+
+        def submit(filename: str) -> None:
+            pending.append(
+                (
+                    filename,
+                    executor.submit(parse_postcode_file, zip_path, filename, **kwargs),
+                )
+            )
+
+        for filename in itertools.islice(remaining, workers * 2):
+            submit(filename)
+        while pending:
+            filename, future = pending.popleft()
+            actions = future.result()
+            next_filename = next(remaining, None)
+            if next_filename:
+                submit(next_filename)
+            yield filename, actions
+
+
+class FingerprintStore:
+    """
+    Fingerprints of the postcode records sent by the last incremental import
+
+    Each record is hashed to an 8 byte fingerprint stored in sqlite against
+    its postcode. While a new release is read, records whose fingerprint
+    matches the stored one are skipped, and postcodes that were in the last
+    release but not this one can be listed afterwards. The new fingerprints
+    replace the old ones when `commit` is called after a successful import,
+    along with the release version and the concrete index they were sent to.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints "
+            "(pcds TEXT PRIMARY KEY, fingerprint BLOB NOT NULL) WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.execute("DROP TABLE IF EXISTS incoming")
+        self.conn.execute(
+            "CREATE TABLE incoming "
+            "(pcds TEXT PRIMARY KEY, fingerprint BLOB NOT NULL) WITHOUT ROWID"
+        )
+        self.counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._meta("version")
+
+    @property
+    def index(self) -> Optional[str]:
+        return self._meta("index")
+
+    def reset(self) -> None:
+        self.conn.execute("DELETE FROM fingerprints")
+        self.conn.execute("DELETE FROM meta")
+
+    def changed(self, pcds: str, record: Dict[str, Any]) -> bool:
+        """
+        Store the fingerprint of a record, returning whether it is new or has
+        changed since the last import
+        """
+        fingerprint = record_fingerprint(record)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO incoming VALUES (?, ?)", (pcds, fingerprint)
+        )
+        row = self.conn.execute(
+            "SELECT fingerprint FROM fingerprints WHERE pcds = ?", (pcds,)
+        ).fetchone()
+        if row is None:
+            self.counts["added"] += 1
+        elif row[0] != fingerprint:
+            self.counts["changed"] += 1
+        else:
+            self.counts["unchanged"] += 1
+            return False
+        return True
+
+    def removed(self) -> List[str]:
+        """
+        Postcodes in the last import that haven't been seen in this one
+        """
+        removed = [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT pcds FROM fingerprints "
+                "WHERE pcds NOT IN (SELECT pcds FROM incoming)"
+            )
+        ]
+        self.counts["removed"] = len(removed)
+        return removed
+
+    def commit(self, version: str, index: str) -> None:
+        self.conn.execute("DROP TABLE fingerprints")
+        self.conn.execute("ALTER TABLE incoming RENAME TO fingerprints")
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            [("version", version), ("index", index)],
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def current_index(es: Elasticsearch, es_index: str) -> str:
+    """
+    The concrete index behind an index name or alias
+    """
+    return ",".join(db.resolve_index(es, es_index)) or es_index
+
+
+def record_fingerprint(record: Dict[str, Any]) -> bytes:
+    return hashlib.blake2b(
+        json.dumps(record, sort_keys=True, default=str).encode(), digest_size=8
+    ).digest()
+
+
+def source_fieldnames(filetype: PostcodeSource) -> Optional[List[str]]:
+    # the NHSPD files don't have a header row
+    if filetype == PostcodeSource.NHSPD:
+        return settings.NHSPD_FIELDNAMES
+    return None
+
+
+def postcode_filenames(z: zipfile.ZipFile, file_location: str) -> List[str]:
+    return [
+        f.filename
+        for f in z.filelist
+        if f.filename.endswith(".csv") and f.filename.startswith(file_location)
+    ]
+
+
 def import_from_postcode_file(
     url=settings.NSPL_URL,
     es_index=PC_INDEX,
     file=None,
     filetype: PostcodeSource = PostcodeSource.NSPL,
     file_location: str = "Data/multi_csv/NSPL",
+    workers: int = 1,
+    new_index: bool = False,
+    force: bool = False,
+    incremental: bool = False,
 ):
+    if incremental and new_index:
+        raise click.UsageError("--incremental can't be used with --new-index")
+    # the versioned index is always named after the postcode index
+    if new_index and es_index != PC_INDEX:
+        raise click.UsageError("--es-index can't be used with --new-index")
     if settings.DEBUG:
         requests_cache.install_cache()
 
-    # set up the elasticsearch client and index
     es = db.get_db()
-    Postcode.init(using=es)
+    source = file or url
+    if not file:
+        file = download_file(url)
+    source_hash = file_hash(file)
+    if not force and Release.unchanged(es, filetype.value, source_hash):
+        print(f"[postcodes] {source} is unchanged since the last import, skipping")
+        return
 
-    if file:
-        z = zipfile.ZipFile(file)
+    # set up the index
+    if new_index:
+        es_index = db.create_versioned_index(es, Postcode)
     else:
-        r = requests.get(url, stream=True)
-        z = zipfile.ZipFile(io.BytesIO(r.content))
+        Postcode.init(using=es)
+    z = zipfile.ZipFile(file)
 
-    fieldnames = None
-    if filetype == PostcodeSource.NHSPD:
-        fieldnames = settings.NHSPD_FIELDNAMES
-
-    for f in z.filelist:
-        if not f.filename.endswith(".csv") or not f.filename.startswith(file_location):
-            continue
-
-        print(f"[postcodes] Opening {f.filename}")
-
-        with z.open(f, "r") as pccsv, BulkImporter(es, name="postcodes") as importer:
-            pccsv = io.TextIOWrapper(pccsv)
-            reader = csv.DictReader(pccsv, fieldnames=fieldnames)
-            for record in tqdm(reader):
-                if filetype == PostcodeSource.PCON:
-                    record = {
-                        "pcds": record["pcd"],
-                        "pcon25": record["pconcd"],
-                    }
+    fieldnames = source_fieldnames(filetype)
+    filenames = postcode_filenames(z, file_location)
+
+    fingerprints = None
+    if incremental:
+        os.makedirs(settings.FINGERPRINT_DIR, exist_ok=True)
+        fingerprints = FingerprintStore(
+            os.path.join(settings.FINGERPRINT_DIR, f"{filetype.value}.sqlite")
+        )
+        # only trust the fingerprints if they came from the import that is
+        # currently in the index, and the alias still points at the index
+        # they were sent to
+        release = Release.latest(es, filetype.value)
+        if (
+            release is None
+            or release.version != fingerprints.version
+            or fingerprints.index != current_index(es, es_index)
+        ):
+            print("[postcodes] No fingerprints for the current data, sending all")
+            fingerprints.reset()
+
+    def actions() -> Generator[Dict[str, Any], None, None]:
+        if workers > 1:
+            print(f"[postcodes] Parsing {len(filenames)} files with {workers} workers")
+            for filename, file_actions in tqdm(
+                parse_postcode_files(
+                    file,
+                    filenames,
+                    workers,
+                    filetype=filetype,
+                    es_index=es_index,
+                    fieldnames=fieldnames,
+                    upsert=not new_index,
+                ),
+                total=len(filenames),
+                unit="file",
+            ):
+                print(f"[postcodes] Parsed {filename}")
+                yield from file_actions
+        else:
+            for filename in filenames:
+                print(f"[postcodes] Opening {filename}")
+                with z.open(filename, "r") as pccsv:
+                    yield from tqdm(
+                        postcode_actions(
+                            pccsv, filetype, es_index, fieldnames, not new_index
+                        )
+                    )
 
+    # one importer for every file, so batches stay in flight between files
+    with BulkImporter(es, name="postcodes") as importer:
+        for action in actions():
+            if fingerprints is not None and not fingerprints.changed(
+                action["_id"], action["doc"][filetype.value]
+            ):
+                continue
+            importer.add(action)
+
+    if fingerprints is not None:
+        # postcodes missing from this release lose this source's record, and
+        # are deleted if no other source has them
+        with BulkImporter(
+            es, name="removed postcodes", raise_on_error=False
+        ) as importer:
+            for id_ in fingerprints.removed():
                 importer.add(
                     {
                         "_index": es_index,
                         "_op_type": "update",
-                        "_id": record["pcds"],
-                        "doc_as_upsert": True,
-                        "doc": {
-                            filetype.value: Postcode.from_csv(record).to_dict(),
+                        "_id": id_,
+                        "script": {
+                            "source": REMOVE_SOURCE_SCRIPT,
+                            "params": {"source": filetype.value},
                         },
                     }
                 )
+        print(
+            "[postcodes] {added:,.0f} added, {changed:,.0f} changed, "
+            "{removed:,.0f} removed, {unchanged:,.0f} unchanged".format(
+                **fingerprints.counts
+            )
+        )
+
+    if new_index:
+        db.promote_index(es, Postcode, es_index)
+
+    version = zip_version(z)
+    Release.record(
+        es,
+        filetype.value,
+        version,
+        source=source,
+        source_hash=source_hash,
+        index=PC_INDEX if new_index else es_index,
+    )
+    if fingerprints is not None:
+        fingerprints.commit(version, current_index(es, es_index))
+        fingerprints.close()
+
+
+@click.command("postcodes")
+@click.option(
+    "--source",
+    "sources",
+    multiple=True,
+    type=click.Choice([s.value for s in PostcodeSource]),
+    default=[s.value for s in PostcodeSource],
+    help="Sources to merge (default: all)",
+)
+@click.option(
+    "--file",
+    "files",
+    multiple=True,
+    help="Use a local zip for a source, given as SOURCE=PATH",
+)
+@click.option("--es-index", default=PC_INDEX)
+@click.option("--new-index/--no-new-index", default=False)
+@click.option("--force/--no-force", default=False)
+def import_postcodes(
+    sources=(), files=(), es_index=PC_INDEX, new_index=False, force=False
+):
+    """Import several postcode sources, merged into one document per postcode"""
+    local_files = {}
+    for f in files:
+        source, _, path = f.partition("=")
+        if source not in sources or not path:
+            raise click.BadParameter(
+                "expected SOURCE=PATH for one of the selected sources",
+                param_hint="file",
+            )
+        local_files[PostcodeSource(source)] = path
+
+    return import_merged_postcode_files(
+        {PostcodeSource(s): local_files.get(PostcodeSource(s)) for s in sources},
+        es_index=es_index,
+        new_index=new_index,
+        force=force,
+    )
+
+
+def source_records(
+    filetype: PostcodeSource, zip_path: str
+) -> Generator[Tuple[str, Dict[str, Any]], None, None]:
+    """
+    Yield the (id, record) pairs from every postcode CSV file in a source zip
+    """
+    with zipfile.ZipFile(zip_path) as z:
+        for filename in postcode_filenames(z, SOURCE_FILE_LOCATIONS[filetype]):
+            print(f"[postcodes] Opening {filename}")
+            with z.open(filename, "r") as pccsv:
+                yield from postcode_records(
+                    pccsv, filetype, source_fieldnames(filetype)
+                )
+
+
+def merge_postcode_records(
+    sources: Iterable[Tuple[PostcodeSource, Iterable[Tuple[str, Dict[str, Any]]]]],
+    store_path: str,
+) -> Generator[Tuple[str, Dict[str, Dict[str, Any]]], None, None]:
+    """
+    Join the records from several sources by postcode, yielding each postcode
+    with a document holding the record from every source it appears in
+
+    Records are written to a sqlite table keyed by postcode and source, then
+    read back in key order, so the records for a postcode come out together
+    without every source needing to be held in memory.
+    """
+    store = sqlite3.connect(store_path)
+    try:
+        # the store is thrown away afterwards, so it doesn't need to be durable
+        store.execute("PRAGMA journal_mode = OFF")
+        store.execute("PRAGMA synchronous = OFF")
+        store.execute(
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                pcds TEXT NOT NULL,
+                source TEXT NOT NULL,
+                record BLOB NOT NULL,
+                PRIMARY KEY (pcds, source)
+            ) WITHOUT ROWID
+            """
+        )
+        for filetype, records in sources:
+            # records are pickled so dates and geo points survive the round trip
+            store.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                (
+                    (
+                        id_,
+                        filetype.value,
+                        pickle.dumps(record, pickle.HIGHEST_PROTOCOL),
+                    )
+                    for id_, record in records
+                ),
+            )
+            store.commit()
+
+        rows = store.execute("SELECT pcds, source, record FROM records ORDER BY pcds")
+        for pcds, group in itertools.groupby(rows, key=operator.itemgetter(0)):
+            yield pcds, {source: pickle.loads(record) for _, source, record in group}
+    finally:
+        store.close()
+
+
+def import_merged_postcode_files(
+    files: Dict[PostcodeSource, Optional[str]],
+    es_index: str = PC_INDEX,
+    new_index: bool = False,
+    force: bool = False,
+):
+    """
+    Import several postcode sources in a single indexing pass
+
+    Each source is downloaded (unless a local file is given) and its records
+    joined by postcode, so every postcode is sent to Elasticsearch once with
+    the records from all the sources, rather than once per source. Nothing is
+    imported if none of the sources have changed since they were last imported.
+    """
+    # the versioned index is always named after the postcode index
+    if new_index and es_index != PC_INDEX:
+        raise click.UsageError("--es-index can't be used with --new-index")
+    if settings.DEBUG:
+        requests_cache.install_cache()
+
+    es = db.get_db()
+    zip_paths = {
+        filetype: file or download_file(SOURCE_URLS[filetype])
+        for filetype, file in files.items()
+    }
+    source_hashes = {
+        filetype: file_hash(zip_path) for filetype, zip_path in zip_paths.items()
+    }
+    if not force and all(
+        Release.unchanged(es, filetype.value, source_hash)
+        for filetype, source_hash in source_hashes.items()
+    ):
+        print("[postcodes] No sources have changed since the last import, skipping")
+        return
+
+    # set up the index
+    if new_index:
+        es_index = db.create_versioned_index(es, Postcode)
+    else:
+        Postcode.init(using=es)
+
+    os.makedirs(settings.DOWNLOAD_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=settings.DOWNLOAD_DIR) as store_dir:
+        merged = merge_postcode_records(
+            (
+                (filetype, source_records(filetype, zip_path))
+                for filetype, zip_path in zip_paths.items()
+            ),
+            os.path.join(store_dir, "postcodes.sqlite"),
+        )
+        with contextlib.closing(merged), BulkImporter(es, name="postcodes") as importer:
+            for pcds, doc in tqdm(merged, unit="postcode"):
+                importer.add(postcode_action(pcds, doc, es_index, not new_index))
+
+    if new_index:
+        db.promote_index(es, Postcode, es_index)
 
-                if settings.DEBUG and (len(importer) >= 100):
-                    break
+    for filetype, zip_path in zip_paths.items():
+        with zipfile.ZipFile(zip_path) as z:
+            Release.record(
+                es,
+                filetype.value,
+                zip_version(z),
+                source=files[filetype] or SOURCE_URLS[filetype],
+                source_hash=source_hashes[filetype],
+                index=PC_INDEX if new_index else es_index,
+            )
@@ -1,17 +1,15 @@
 """
 Import commands for the register of geographic codes and code history database
 """
-import codecs
 import csv
 
 import click
-import requests
 import requests_cache
 import tqdm
 
 from findthatpostcode import db, settings
-from findthatpostcode.documents import Area
-from findthatpostcode.utils import BulkImporter
+from findthatpostcode.documents import Area, Release
+from findthatpostcode.utils import BulkImporter, download_file, file_hash
 
 AREA_INDEX = Area.Index.name
 
@@ -98,16 +96,21 @@ IMD_FIELDS = {
 @click.command("imd2019")
 @click.option("--es-index", default=AREA_INDEX)
 @click.option("--url", default=settings.IMD2019_URL)
-def import_imd2019(url=settings.IMD2019_URL, es_index=AREA_INDEX):
+@click.option("--force/--no-force", default=False)
+def import_imd2019(url=settings.IMD2019_URL, es_index=AREA_INDEX, force=False):
     if settings.DEBUG:
         requests_cache.install_cache()
 
     es = db.get_db()
 
-    r = requests.get(url, stream=True)
+    file = download_file(url)
+    source_hash = file_hash(file)
+    if not force and Release.unchanged(es, "imd2019", source_hash):
+        print(f"[imd2019] {url} is unchanged since the last import, skipping")
+        return
 
-    reader = csv.DictReader(codecs.iterdecode(r.iter_lines(), "utf-8-sig"))
-    with BulkImporter(es, "imd2019") as importer:
+    with open(file, encoding="utf-8-sig") as f, BulkImporter(es, "imd2019") as importer:
+        reader = csv.DictReader(f)
         for k, area in tqdm.tqdm(enumerate(reader)):
             area = {
                 IMD_FIELDS.get(k.strip(), k.strip()): parse_field(
@@ -139,20 +142,34 @@ def import_imd2019(url=settings.IMD2019_URL, es_index=AREA_INDEX):
             }
             importer.add(area_update)
 
+    Release.record(
+        es,
+        "imd2019",
+        source_hash[0:12],
+        source=url,
+        source_hash=source_hash,
+        index=es_index,
+    )
+
 
 @click.command("imd2015")
 @click.option("--es-index", default=AREA_INDEX)
 @click.option("--url", default=settings.IMD2015_URL)
-def import_imd2015(url=settings.IMD2015_URL, es_index=AREA_INDEX):
+@click.option("--force/--no-force", default=False)
+def import_imd2015(url=settings.IMD2015_URL, es_index=AREA_INDEX, force=False):
     if settings.DEBUG:
         requests_cache.install_cache()
 
     es = db.get_db()
 
-    r = requests.get(url, stream=True)
+    file = download_file(url)
+    source_hash = file_hash(file)
+    if not force and Release.unchanged(es, "imd2015", source_hash):
+        print(f"[imd2015] {url} is unchanged since the last import, skipping")
+        return
 
-    reader = csv.DictReader(codecs.iterdecode(r.iter_lines(), "utf-8-sig"))
-    with BulkImporter(es, "imd2015") as importer:
+    with open(file, encoding="utf-8-sig") as f, BulkImporter(es, "imd2015") as importer:
+        reader = csv.DictReader(f)
         for k, area in tqdm.tqdm(enumerate(reader)):
             area = {
                 IMD_FIELDS.get(k.strip(), k.strip()): parse_field(
@@ -183,3 +200,12 @@ def import_imd2015(url=settings.IMD2015_URL, es_index=AREA_INDEX):
                 },
             }
             importer.add(area_update)
+
+    Release.record(
+        es,
+        "imd2015",
+        source_hash[0:12],
+        source=url,
+        source_hash=source_hash,
+        index=es_index,
+    )
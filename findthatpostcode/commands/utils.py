@@ -3,6 +3,8 @@ import zipfile
 
 import click
 
+from findthatpostcode import cache, db
+
 
 @click.command("sample-zip")
 @click.argument("input", type=click.Path(exists=True))
@@ -25,3 +27,11 @@ def sample_zip(input, output):
             else:
                 output_lines = [lines[0]] + random.sample(lines[1:], 100)
             output_zip.writestr(f, b"".join(output_lines))
+
+
+@click.command("area-table")
+def area_table_report():
+    """Load the in-memory area name table and report how much memory it uses."""
+    cache.area_table.load(db.get_db())
+    for k, v in cache.area_table.memory_report().items():
+        click.echo(f"{k}: {v:,.0f}")
@@ -1,29 +1,37 @@
+import csv
 import dataclasses
 import io
-import json
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     Any,
     Dict,
     Generator,
+    Iterable,
     List,
     Optional,
+    Set,
     Tuple,
     Type,
     overload,
 )
 
+from botocore.exceptions import ClientError
 from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Q
+from elasticsearch_dsl import Q, Search
 from mypy_boto3_s3.client import S3Client
-from pydantic_geojson import FeatureModel
 
-from findthatpostcode import schemas, settings
+from findthatpostcode import cache, schemas, settings, spatial
 from findthatpostcode.documents import Area, Placename, Postcode
-from findthatpostcode.utils import PostcodeStr
+from findthatpostcode.documents.postcode import HASH_PREFIX_LENGTHS
+from findthatpostcode.utils import PostcodeStr, boundary_key
 
 logger = logging.getLogger(__name__)
 
+# the keys of full boundaries in S3, rather than simplified or compressed ones
+BOUNDARY_KEY_REGEX = re.compile(r"^[A-Za-z0-9]{3}/(?P<code>[A-Za-z0-9]+)\.json$")
+
 
 def get_fields(model, fields: Optional[List[str]] = None) -> List[str]:
     all_fields = model.__table__.columns.keys()
@@ -113,13 +121,44 @@ def record_to_schema(
     return new_record
 
 
-def get_area_names(db: Elasticsearch, area_codes: List = []) -> dict:
-    search = Area.mget(area_codes, using=db, missing="skip")
-    return {
-        area.code: (area.name, area.type)
-        for area in search
-        if area and (area.name or area.name_welsh)
-    }
+def get_area_names(db: Elasticsearch, area_codes: Iterable[str] = ()) -> dict:
+    """
+    Look up the names of a set of areas
+
+    If the area name table has been preloaded it answers every lookup.
+    Otherwise names are served from the in-process cache where possible. Any
+    remaining codes are deduplicated and fetched in chunks of
+    `settings.AREA_NAMES_CHUNK_SIZE`, so the number of requests depends on the
+    number of distinct uncached codes rather than how many records they came
+    from.
+    """
+    if cache.area_table.loaded:
+        return cache.area_table.get_names(area_codes)
+
+    cached, unique_codes = cache.area_names.get_many(dict.fromkeys(area_codes))
+    names = {code: name for code, name in cached.items() if name}
+    for i in range(0, len(unique_codes), settings.AREA_NAMES_CHUNK_SIZE):
+        chunk = unique_codes[i : i + settings.AREA_NAMES_CHUNK_SIZE]
+        search = Area.mget(chunk, using=db, missing="skip")
+        found = {
+            area.code: (area.name, area.type)
+            for area in search
+            if area and (area.name or area.name_welsh)
+        }
+        names.update(found)
+        # codes without a name are cached too, so they aren't looked up again
+        cache.area_names.set_many({code: found.get(code) for code in chunk})
+    return names
+
+
+def get_records_area_names(db: Elasticsearch, records: Iterable[Postcode]) -> dict:
+    """
+    Look up the names for every area referenced by a group of postcodes
+    """
+    area_codes: Dict[str, None] = {}
+    for record in records:
+        area_codes.update(dict.fromkeys(record.area_codes()))
+    return get_area_names(db, area_codes)
 
 
 def get_postcode(
@@ -141,35 +180,252 @@ def get_postcode(
 def get_postcodes(
     db: Elasticsearch, postcodes: List[str], fields: Optional[List[str]] = None
 ) -> List[schemas.Postcode]:
-    cleaned_postcodes: Dict[str, Any] = {}
+    """
+    Look up a list of postcodes, returning one result for each in the same
+    order - including any repeated or unknown postcodes
+    """
+    cleaned_postcodes: List[Tuple[str, str]] = []
     for postcode in postcodes:
         try:
-            cleaned_postcodes[postcode] = PostcodeStr(postcode)
+            cleaned_postcodes.append((postcode, PostcodeStr(postcode)))
         except ValueError:
-            cleaned_postcodes[postcode] = postcode
+            cleaned_postcodes.append((postcode, postcode))
     fields, name_fields = postcode_get_fields(fields)
     records = {
         p.pcds: p
         for p in Postcode.mget(
-            cleaned_postcodes.values(),
+            list(dict.fromkeys(cleaned for _, cleaned in cleaned_postcodes)),
             using=db,
             _source_includes=fields,
             missing="skip",
         )
     }
+    name_lookup = get_records_area_names(db, records.values())
     return [
         record_to_schema(
             records[cleaned_postcode],
             schemas.Postcode,
             name_fields,
-            get_area_names(db, records[cleaned_postcode].area_codes()),
+            name_lookup,
         )
         if records.get(cleaned_postcode)
         else schemas.Postcode(pcds=postcode)
-        for postcode, cleaned_postcode in cleaned_postcodes.items()
+        for postcode, cleaned_postcode in cleaned_postcodes
     ]
 
 
+def iter_postcodes(
+    db: Elasticsearch,
+    postcodes: Iterable[str],
+    fields: Optional[List[str]] = None,
+    chunk_size: Optional[int] = None,
+) -> Generator[List[schemas.Postcode], None, None]:
+    """
+    Look up a stream of postcodes, yielding the results a chunk at a time
+
+    Each chunk is fetched with one `Postcode.mget` and one area name lookup,
+    so memory use depends on the chunk size rather than the total number of
+    postcodes.
+    """
+    chunk_size = chunk_size or settings.POSTCODES_CHUNK_SIZE
+    chunk: List[str] = []
+    for postcode in postcodes:
+        chunk.append(postcode)
+        if len(chunk) >= chunk_size:
+            yield get_postcodes(db, chunk, fields)
+            chunk = []
+    if chunk:
+        yield get_postcodes(db, chunk, fields)
+
+
+def area_postcode_fields(areacode: str) -> List[str]:
+    """
+    Find the postcode fields that could hold an area code, based on its type
+    """
+    area_type = settings.ENTITIES.get(areacode[0:3])
+    if not area_type:
+        return []
+    postcode_fields = Postcode._doc_type.mapping
+    return [
+        f
+        for f in settings.AREA_POSTCODE_FIELDS.get(area_type, [area_type])
+        if f in postcode_fields
+    ]
+
+
+def open_point_in_time(db: Elasticsearch, index: str) -> str:
+    response = db.transport.perform_request(
+        "POST",
+        "/{}/_pit".format(index),
+        params={"keep_alive": settings.ES_PIT_KEEP_ALIVE},
+    )
+    return response["id"]
+
+
+def close_point_in_time(db: Elasticsearch, pit_id: str) -> None:
+    db.transport.perform_request("DELETE", "/_pit", body={"id": pit_id})
+
+
+def iter_area_postcodes(
+    db: Elasticsearch,
+    areacode: str,
+    fields: Optional[List[str]] = None,
+    page_size: Optional[int] = None,
+) -> Generator[List[schemas.Postcode], None, None]:
+    """
+    Yield every postcode in an area, a page at a time
+
+    Pages are fetched from a point in time with `search_after`, so exports are
+    consistent, use constant memory and are not limited by the index's
+    `max_result_window`.
+    """
+    area_fields = area_postcode_fields(areacode)
+    if not area_fields:
+        return
+    page_size = page_size or settings.AREA_POSTCODES_PAGE_SIZE
+    fields, name_fields = postcode_get_fields(fields)
+    search = (
+        Search(using=db, doc_type=Postcode)
+        .filter(
+            "bool",
+            should=[Q("term", **{f: areacode}) for f in area_fields],
+            minimum_should_match=1,
+        )
+        .sort("pcds")
+        .extra(size=page_size, track_total_hits=False)
+    )
+    if fields:
+        search = search.source(includes=fields)
+
+    pit_id = open_point_in_time(db, settings.ES_INDICES["postcode"])
+    try:
+        search_after = None
+        while True:
+            page = search.extra(
+                pit={"id": pit_id, "keep_alive": settings.ES_PIT_KEEP_ALIVE}
+            )
+            if search_after:
+                page = page.extra(search_after=search_after)
+            results = page.execute()
+            # the point in time id can change between requests
+            pit_id = results.to_dict().get("pit_id", pit_id)
+            records = list(results)
+            if records:
+                name_lookup = get_records_area_names(db, records)
+                yield [
+                    record_to_schema(r, schemas.Postcode, name_fields, name_lookup)
+                    for r in records
+                ]
+            if len(records) < page_size:
+                break
+            search_after = list(records[-1].meta.sort)
+    finally:
+        close_point_in_time(db, pit_id)
+
+
+def expand_upload_fields(fields: Iterable[str]) -> List[str]:
+    """
+    Turn fields chosen on the add to CSV page into the columns they produce
+    """
+    expanded: Dict[str, None] = {}
+    for field in fields:
+        expanded.update(
+            dict.fromkeys(settings.UPLOAD_FIELD_ALIASES.get(field, [field]))
+        )
+    return list(expanded)
+
+
+def get_area_stats(
+    db: Elasticsearch, area_codes: Iterable[str], stats_fields: Dict[str, str]
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Fetch statistics (such as IMD ranks) stored against areas
+
+    `stats_fields` maps an output field name to its dotted path in the area
+    record, as in `settings.STATS_FIELDS`.
+    """
+    area_codes = list(dict.fromkeys(area_codes))
+    if not area_codes:
+        return {}
+    results = {}
+    for area in Area.mget(
+        area_codes, using=db, missing="skip", _source_includes=["code", "stats"]
+    ):
+        values = area.to_dict()
+        area_stats = {}
+        for field, path in stats_fields.items():
+            value: Any = values
+            for key in path.split("."):
+                value = value.get(key) if isinstance(value, dict) else None
+            area_stats[field] = value
+        results[area.meta.id] = area_stats
+    return results
+
+
+def add_fields_to_csv(
+    db: Elasticsearch,
+    reader: "csv.DictReader[str]",
+    column_name: str,
+    fields: List[str],
+    chunk_size: Optional[int] = None,
+) -> Generator[str, None, None]:
+    """
+    Add postcode data to each row of a CSV file, yielding the new CSV in chunks
+
+    Rows are read `chunk_size` at a time, and the postcodes, area names and
+    stats for each chunk are fetched together.
+    """
+    chunk_size = chunk_size or settings.POSTCODES_CHUNK_SIZE
+    fields = expand_upload_fields(fields)
+    stats_fields = {f[0]: f[3] for f in settings.STATS_FIELDS if f[0] in fields}
+    postcode_fields = [f for f in fields if f not in stats_fields]
+    # the LSOA is needed to find the stats for each postcode
+    query_fields = postcode_fields + (["lsoa11"] if stats_fields else [])
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(
+        buffer,
+        fieldnames=list(reader.fieldnames or [])
+        + [f for f in fields if f not in (reader.fieldnames or [])],
+        extrasaction="ignore",
+    )
+    writer.writeheader()
+
+    def process_chunk(rows: List[Dict[str, str]]) -> str:
+        postcodes = list(
+            dict.fromkeys(r[column_name] for r in rows if r.get(column_name))
+        )
+        results = (
+            dict(zip(postcodes, get_postcodes(db, postcodes, fields=query_fields)))
+            if postcodes
+            else {}
+        )
+        stats = {}
+        if stats_fields:
+            stats = get_area_stats(
+                db, [r.lsoa11 for r in results.values() if r.lsoa11], stats_fields
+            )
+        for row in rows:
+            result = results.get(row.get(column_name))
+            if result:
+                row.update({f: getattr(result, f, None) for f in postcode_fields})
+                if stats_fields:
+                    row.update(stats.get(result.lsoa11, {}))
+            writer.writerow(row)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return value
+
+    rows: List[Dict[str, str]] = []
+    for row in reader:
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            yield process_chunk(rows)
+            rows = []
+    yield process_chunk(rows)
+
+
 def get_nearest_postcode(
     db: Elasticsearch, lat: float, long: float, fields: Optional[List[str]] = None
 ) -> Optional[schemas.NearestPoint]:
@@ -198,42 +454,81 @@ def get_nearest_postcode(
     )
 
 
+def hash_query(hashes: Iterable[str]) -> Q:
+    """
+    Build a query matching postcodes whose hash starts with any of `hashes`
+
+    Hashes of a length stored in a `hashN` keyword field are matched with a
+    single `terms` query per length. Any other length falls back to a
+    `prefix` query on the full hash.
+    """
+    by_length: Dict[int, Set[str]] = {}
+    for hash_ in hashes:
+        if len(hash_) < 3:
+            raise ValueError("Hash length must be at least 3 characters")
+        by_length.setdefault(len(hash_), set()).add(hash_.lower())
+
+    queries = []
+    for length, values in sorted(by_length.items()):
+        if length in HASH_PREFIX_LENGTHS:
+            queries.append(Q("terms", **{"hash{}".format(length): sorted(values)}))
+        else:
+            queries.extend(Q("prefix", hash=value) for value in sorted(values))
+    return Q("bool", should=queries, minimum_should_match=1)
+
+
 def get_postcode_by_hash(
     db: Elasticsearch, hashes: List[str], fields: Optional[List[str]] = None
 ) -> Generator[schemas.Postcode, None, None]:
+    """
+    Find every postcode whose hash starts with one of `hashes`
+
+    Results are fetched in pages of `settings.HASH_LOOKUP_PAGE_SIZE` using
+    `search_after`. A ValueError is raised if there are more than
+    `settings.HASH_LOOKUP_MAX_HASHES` hashes, or if they match more than
+    `settings.HASH_LOOKUP_MAX_RESULTS` postcodes.
+    """
     if not isinstance(hashes, list):
         hashes = [hashes]
-    fields, name_fields = postcode_get_fields(fields)
-    query = []
-    for hash_ in hashes:
-        if len(hash_) < 3:
-            raise ValueError("Hash length must be at least 3 characters")
-        query.append(
-            {
-                "prefix": {
-                    "hash": hash_,
-                },
-            }
+    if len({h.lower() for h in hashes}) > settings.HASH_LOOKUP_MAX_HASHES:
+        raise ValueError(
+            "No more than {} hashes can be looked up at once".format(
+                settings.HASH_LOOKUP_MAX_HASHES
+            )
         )
-
-    results = (
+    fields, name_fields = postcode_get_fields(fields)
+    search = (
         Postcode.search(using=db)
-        .source(include=fields + name_fields)
-        .query("bool", should=query)
-        .execute()
+        .filter(hash_query(hashes))
+        .sort("pcds")
+        .extra(track_total_hits=False)
     )
-    name_lookup = {}
-    for result in results:
-        area_codes_to_check = set()
-        for code in result.area_codes():
-            if code not in name_lookup:
-                area_codes_to_check.add(code)
-        if area_codes_to_check:
-            name_lookup = {
-                **name_lookup,
-                **get_area_names(db, list(area_codes_to_check)),
-            }
-        yield record_to_schema(result, schemas.Postcode, name_fields, name_lookup)
+    if fields:
+        search = search.source(includes=fields)
+
+    found = 0
+    while True:
+        # ask for one more postcode than the limit allows, to tell whether
+        # the limit has been passed
+        size = min(
+            settings.HASH_LOOKUP_PAGE_SIZE,
+            settings.HASH_LOOKUP_MAX_RESULTS - found + 1,
+        )
+        results = search.extra(size=size).execute()
+        records = list(results)
+        found += len(records)
+        if found > settings.HASH_LOOKUP_MAX_RESULTS:
+            raise ValueError(
+                "More than {} postcodes match these hashes".format(
+                    settings.HASH_LOOKUP_MAX_RESULTS
+                )
+            )
+        name_lookup = get_records_area_names(db, records)
+        for result in records:
+            yield record_to_schema(result, schemas.Postcode, name_fields, name_lookup)
+        if len(records) < size:
+            break
+        search = search.extra(search_after=list(records[-1].meta.sort))
 
 
 def get_area(
@@ -247,22 +542,219 @@ def get_area(
     return record_to_schema(record, schemas.Area)
 
 
+def area_exists(db: Elasticsearch, areacode: str) -> bool:
+    return Area.exists(id=areacode, using=db)
+
+
+def fetch_area_boundary(
+    client: S3Client,
+    areacode: str,
+    resolution: str = "full",
+    encoding: str = "identity",
+) -> Optional[bytes]:
+    """
+    The GeoJSON boundary for an area, fetched from S3 without any caching
+
+    `resolution` picks one of the simplified versions made on import (see
+    `settings.BOUNDARY_RESOLUTIONS`), falling back to the full boundary for
+    areas imported before they were made. `encoding` picks the gzip or
+    brotli compressed version, which is `None` if it wasn't stored.
+    """
+
+    def fetch(key: str) -> Optional[bytes]:
+        try:
+            response = client.get_object(Bucket=settings.S3_BUCKET, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return response["Body"].read()
+
+    boundary = fetch(boundary_key(areacode, resolution, encoding))
+    if boundary is None and resolution != "full":
+        boundary = fetch(boundary_key(areacode, "full", encoding))
+    return boundary
+
+
 def get_area_boundary(
-    db: Elasticsearch, client: S3Client, areacode: str
-) -> Optional[FeatureModel]:
-    record = Area.exists(id=areacode, using=db)
-    if not record:
-        return None
+    client: S3Client,
+    areacode: str,
+    resolution: str = "full",
+    encoding: str = "identity",
+) -> Optional[bytes]:
+    """
+    The GeoJSON boundary for an area, as the raw bytes stored in S3
 
-    buffer = io.BytesIO()
-    prefix = areacode[0:3]
-    client.download_fileobj(
-        settings.S3_BUCKET,
-        "%s/%s.json" % (prefix, areacode),
-        buffer,
+    See `fetch_area_boundary` for the options. Boundaries (and areas without
+    one) are cached by area code, resolution, encoding and data version, so
+    S3 is only asked once for each.
+    """
+
+    def load() -> Optional[bytes]:
+        return fetch_area_boundary(client, areacode, resolution, encoding)
+
+    name = ".".join(
+        [areacode]
+        + ([resolution] if resolution != "full" else [])
+        + ([encoding] if encoding != "identity" else [])
     )
-    boundary = json.loads(buffer.getvalue().decode("utf-8"))
-    return boundary
+    return cache.boundaries.get(name, cache.release.etag or "", load)
+
+
+def list_area_boundaries(client: S3Client, areatype: str) -> List[str]:
+    """
+    The codes of every area of a type with a boundary stored in S3
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    codes = []
+    for entity in settings.AREA_TYPES[areatype]["entities"]:
+        for page in paginator.paginate(
+            Bucket=settings.S3_BUCKET, Prefix="{}/".format(entity)
+        ):
+            for item in page.get("Contents", []):
+                match = BOUNDARY_KEY_REGEX.match(item["Key"])
+                if match:
+                    codes.append(match.group("code"))
+    return sorted(codes)
+
+
+def get_area_type_status(db: Elasticsearch, areatype: str) -> Dict[str, bool]:
+    """
+    Whether each area of a type is live, by area code
+
+    The areas are paged through in code order with `search_after`.
+    """
+    page_size = settings.AREA_NAMES_PRELOAD_PAGE_SIZE
+    search = (
+        Search(using=db, index=settings.ES_INDICES["area"])
+        .filter("term", type=areatype)
+        .sort("code")
+        .source(["code", "active"])
+        .extra(size=page_size, track_total_hits=False)
+    )
+    status: Dict[str, bool] = {}
+    search_after = None
+    while True:
+        page = search.extra(search_after=search_after) if search_after else search
+        records = list(page.execute())
+        for record in records:
+            status[record.code] = bool(getattr(record, "active", False))
+        if len(records) < page_size:
+            return status
+        search_after = list(records[-1].meta.sort)
+
+
+def load_area_type_boundaries(
+    db: Elasticsearch, client: S3Client, areatype: str, resolution: str = "full"
+) -> spatial.AreaBoundaries:
+    """
+    Fetch every boundary of a live area of a type from S3 and build a
+    spatial index
+
+    Boundaries of terminated areas are left out, unless no areas of the type
+    have been imported to tell which are live. The boundaries are fetched
+    directly rather than through the boundary cache, so loading a whole area
+    type doesn't push out other boundaries.
+    """
+    codes = list_area_boundaries(client, areatype)
+    status = get_area_type_status(db, areatype)
+    if status:
+        codes = [code for code in codes if status.get(code)]
+    with ThreadPoolExecutor(settings.BOUNDARY_LOAD_CONCURRENCY) as executor:
+        features = executor.map(
+            lambda code: (code, fetch_area_boundary(client, code, resolution)),
+            codes,
+        )
+        boundaries = spatial.AreaBoundaries.from_geojson(
+            (code, feature) for code, feature in features if feature
+        )
+    logger.info(
+        "Loaded %s %s boundaries at %s resolution (%s)",
+        len(boundaries),
+        areatype,
+        resolution,
+        "{:,.0f} bytes".format(boundaries.nbytes),
+    )
+    return boundaries
+
+
+def get_area_type_boundaries(
+    db: Elasticsearch, client: S3Client, areatype: str, resolution: str = "full"
+) -> Optional[spatial.AreaBoundaries]:
+    """
+    Every boundary of a live area of a type, in a spatial index
+
+    The index is built in the background the first time an area type is
+    used, and then kept in memory for the data version. `None` is returned
+    until it has been built, and `cache.BoundariesUnavailable` is raised if
+    it can't be built.
+    """
+    key = (cache.release.etag or "", areatype, resolution)
+    return cache.area_boundaries.get(
+        key, lambda: load_area_type_boundaries(db, client, areatype, resolution)
+    )
+
+
+def get_point_areas(
+    db: Elasticsearch,
+    client: S3Client,
+    lat: float,
+    long: float,
+    areatypes: List[str],
+) -> Optional[schemas.PointAreas]:
+    """
+    The live areas whose boundaries contain a point
+
+    Lookups use the spatial index of each area type, so don't need
+    Elasticsearch or S3. `None` is returned while any of the indexes are
+    still being built.
+    """
+    indexes = [
+        get_area_type_boundaries(
+            db, client, areatype, settings.POINT_BOUNDARY_RESOLUTION
+        )
+        for areatype in areatypes
+    ]
+    areas = []
+    for areatype, boundaries in zip(areatypes, indexes):
+        if boundaries is None:
+            return None
+        for i in boundaries.containing(long, lat):
+            areas.append(
+                schemas.PointArea(
+                    code=boundaries.codes[i],
+                    type=areatype,
+                    name=boundaries.names[i],
+                )
+            )
+    return schemas.PointAreas(point_lat=lat, point_long=long, areas=areas)
+
+
+def get_boundary_tile(
+    db: Elasticsearch, client: S3Client, areatype: str, z: int, x: int, y: int
+) -> Optional[bytes]:
+    """
+    A Mapbox vector tile of the boundaries of the live areas of a type
+
+    Tiles are made from the simplified boundaries set for the zoom level in
+    `settings.TILE_RESOLUTIONS`, and cached by data version. `None` is
+    returned if the tile isn't cached and the boundaries are still loading.
+    """
+    resolution = [
+        r for zoom, r in sorted(settings.TILE_RESOLUTIONS.items()) if zoom <= z
+    ][-1]
+    name = "{}.{}.{}.{}".format(areatype, z, x, y)
+    version = cache.release.etag or ""
+
+    tile = cache.tiles.peek(name, version)
+    if tile is cache.MISSING:
+        boundaries = get_area_type_boundaries(db, client, areatype, resolution)
+        if boundaries is None:
+            return None
+        tile = cache.tiles.get(
+            name, version, lambda: boundaries.tile(z, x, y, layer=areatype)
+        )
+    return tile or b""
 
 
 def search_areas(
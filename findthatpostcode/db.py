@@ -1,43 +1,205 @@
+import datetime
+import functools
+import threading
+from typing import Any, Callable, Dict, List, Optional, Type, TypeVar
+
+import anyio
 import click
 from boto3 import session
+from botocore.config import Config
 from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Index
+from elasticsearch_dsl import Document, Index
 from mypy_boto3_s3.client import S3Client
 
 from findthatpostcode import documents, settings
 
+T = TypeVar("T")
+
+_es_limiter: Optional[anyio.CapacityLimiter] = None
+
+# clients are shared for the lifetime of the application so that their
+# connection pools are reused between requests
+_es_client: Optional[Elasticsearch] = None
+_s3_client: Optional[S3Client] = None
+_client_lock = threading.Lock()
+
 
 def get_db() -> Elasticsearch:
-    return Elasticsearch(settings.ES_URL, timeout=120)
+    global _es_client
+    if _es_client is None:
+        with _client_lock:
+            if _es_client is None:
+                _es_client = Elasticsearch(
+                    settings.ES_URL,
+                    timeout=settings.ES_TIMEOUT,
+                    maxsize=settings.ES_MAXSIZE,
+                    max_retries=settings.ES_MAX_RETRIES,
+                    retry_on_timeout=True,
+                    http_compress=settings.ES_HTTP_COMPRESS,
+                )
+    return _es_client
 
 
 def close_db(e=None):
-    pass
+    global _es_client
+    with _client_lock:
+        if _es_client is not None:
+            _es_client.transport.close()
+            _es_client = None
+
+
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a blocking database function in a worker thread
+
+    The Elasticsearch client is synchronous, so calling it directly from an
+    async route would block the event loop. The number of threads used is
+    capped by `settings.ES_THREADPOOL_SIZE`.
+    """
+    global _es_limiter
+    if _es_limiter is None:
+        _es_limiter = anyio.CapacityLimiter(settings.ES_THREADPOOL_SIZE)
+    return await anyio.to_thread.run_sync(
+        functools.partial(func, *args, **kwargs), limiter=_es_limiter
+    )
+
+
+def resolve_index(es: Elasticsearch, name: str) -> List[str]:
+    """
+    Find the concrete indexes behind an index name or alias
+    """
+    if es.indices.exists_alias(name=name):
+        return sorted(es.indices.get_alias(name=name).keys())
+    if es.indices.exists(index=name):
+        return [name]
+    return []
 
 
 def init_db(reset=False):
     es = get_db()
     for doc_type in documents.__all__:
         DocumentType = getattr(documents, doc_type)
-        DocumentIndex = Index(DocumentType.Index.name)
+        if not isinstance(DocumentType, type) or not issubclass(DocumentType, Document):
+            continue
+        name = DocumentType.Index.name
         if reset:
-            click.echo(f"[elasticsearch] deleting '{DocumentType.Index.name}' index...")
-            res = DocumentIndex.delete(using=es, ignore=[400, 404])
-            click.echo(f"[elasticsearch] response: '{res}'")
-        click.echo(f"[elasticsearch] creating '{DocumentType.Index.name}' index...")
-        DocumentIndex.create(using=es)
+            for index in resolve_index(es, name):
+                click.echo(f"[elasticsearch] deleting '{index}' index...")
+                res = Index(index).delete(using=es, ignore=[400, 404])
+                click.echo(f"[elasticsearch] response: '{res}'")
+        if resolve_index(es, name):
+            click.echo(f"[elasticsearch] '{name}' index already exists")
+            continue
+        click.echo(f"[elasticsearch] creating '{name}' index...")
+        Index(name).create(using=es)
 
 
-def get_s3_client() -> S3Client:
-    s3_session = session.Session()
-    return s3_session.client(
-        "s3",
-        region_name=settings.S3_REGION,
-        endpoint_url=settings.S3_ENDPOINT,
-        aws_access_key_id=settings.S3_ACCESS_ID,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
+def index_versions(es: Elasticsearch, alias: str) -> List[str]:
+    """
+    List the versioned indexes created for an alias, oldest first
+    """
+    return sorted(es.indices.get(index="{}_*".format(alias)).keys())
+
+
+def create_versioned_index(
+    es: Elasticsearch, doc_type: Type[Document], version: Optional[str] = None
+) -> str:
+    """
+    Create a new index for a document type, set up for a bulk import
+
+    The index is named after the document's index with a version suffix and
+    is created with no replicas and refresh turned off. Once it's loaded,
+    `promote_index` puts it live.
+    """
+    version = version or datetime.datetime.now().strftime("%Y_%m_%d_%H%M%S")
+    name = "{}_{}".format(doc_type.Index.name, version)
+    index = doc_type._index.clone(name=name)
+    index.settings(number_of_replicas=0, refresh_interval="-1")
+    click.echo(f"[elasticsearch] creating '{name}' index...")
+    index.create(using=es)
+    return name
+
+
+def promote_index(
+    es: Elasticsearch,
+    doc_type: Type[Document],
+    name: str,
+    keep: Optional[int] = None,
+) -> None:
+    """
+    Put a versioned index live in place of the current one
+
+    Restores the normal index settings, force merges the index and then
+    moves the alias over to it in one atomic action. An existing concrete
+    index with the alias name (from before versioned indexes were used) is
+    removed in the same action. The releases recorded for the old index are
+    cleared, and older versions beyond the `keep` most recent ones (by default
+    `settings.ES_INDEX_VERSIONS_KEEP`) are then deleted.
+    """
+    alias = doc_type.Index.name
+    click.echo(f"[elasticsearch] restoring settings for '{name}'...")
+    es.indices.put_settings(
+        index=name,
+        body={
+            "index": {
+                "number_of_replicas": settings.ES_REPLICAS,
+                "refresh_interval": None,
+            }
+        },
+    )
+    es.indices.refresh(index=name)
+    click.echo(f"[elasticsearch] force merging '{name}'...")
+    es.indices.forcemerge(
+        index=name,
+        max_num_segments=1,
+        request_timeout=settings.ES_FORCEMERGE_TIMEOUT,
     )
 
+    actions: List[Dict[str, Any]] = []
+    if es.indices.exists_alias(name=alias):
+        for index in es.indices.get_alias(name=alias):
+            actions.append({"remove": {"index": index, "alias": alias}})
+    elif es.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": name, "alias": alias}})
+    click.echo(f"[elasticsearch] pointing '{alias}' at '{name}'...")
+    es.indices.update_aliases(body={"actions": actions})
+    # data imported into the old index isn't in the new one, so those imports
+    # will need to be run again
+    documents.Release.clear_index(es, alias)
+
+    keep = settings.ES_INDEX_VERSIONS_KEEP if keep is None else keep
+    old_versions = [i for i in index_versions(es, alias) if i != name]
+    for index in old_versions[: max(len(old_versions) - keep, 0)]:
+        click.echo(f"[elasticsearch] deleting old index '{index}'...")
+        es.indices.delete(index=index)
+
+
+def get_s3_client() -> S3Client:
+    global _s3_client
+    if _s3_client is None:
+        with _client_lock:
+            if _s3_client is None:
+                s3_session = session.Session()
+                _s3_client = s3_session.client(
+                    "s3",
+                    region_name=settings.S3_REGION,
+                    endpoint_url=settings.S3_ENDPOINT,
+                    aws_access_key_id=settings.S3_ACCESS_ID,
+                    aws_secret_access_key=settings.S3_SECRET_KEY,
+                    config=Config(
+                        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                        connect_timeout=settings.S3_TIMEOUT,
+                        read_timeout=settings.S3_TIMEOUT,
+                        tcp_keepalive=True,
+                    ),
+                )
+    return _s3_client
+
 
 def close_s3_client(e=None):
-    pass
+    global _s3_client
+    with _client_lock:
+        if _s3_client is not None:
+            _s3_client.close()
+            _s3_client = None
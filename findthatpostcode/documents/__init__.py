@@ -2,5 +2,6 @@ from .area import Area
 from .entity import Entity
 from .placename import Placename
 from .postcode import Postcode, PostcodeSource
+from .release import Release
 
-__all__ = ["Postcode", "Entity", "Area", "Placename", "PostcodeSource"]
+__all__ = ["Postcode", "Entity", "Area", "Placename", "PostcodeSource", "Release"]
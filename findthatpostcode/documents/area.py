@@ -1,6 +1,7 @@
-from elasticsearch_dsl import Document, InnerDoc, field
+from elasticsearch_dsl import InnerDoc, field
 
 from findthatpostcode import settings
+from findthatpostcode.documents.base import VersionedDocument
 
 
 class AreaEquivalents(InnerDoc):
@@ -11,7 +12,7 @@ class AreaEquivalents(InnerDoc):
     welsh_government = field.Keyword()
 
 
-class Area(Document):
+class Area(VersionedDocument):
     code = field.Keyword()
     name = field.Text()
     name_welsh = field.Text()
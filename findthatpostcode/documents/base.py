@@ -0,0 +1,20 @@
+from fnmatch import fnmatch
+
+from elasticsearch_dsl import Document
+
+
+class VersionedDocument(Document):
+    """
+    A document whose index can be an alias for a versioned index
+
+    `Index.name` may point at an index such as `geo_postcode_2024_02_01_120000`
+    after a reindex, so search hits from those indexes are matched to the
+    document class too.
+    """
+
+    @classmethod
+    def _matches(cls, hit):
+        index = hit.get("_index", "")
+        return fnmatch(index, cls._index._name) or fnmatch(
+            index, cls._index._name + "_*"
+        )
@@ -1,11 +1,14 @@
 import datetime
 import hashlib
+import re
 from enum import Enum
-from typing import Any, Dict, List
+from itertools import takewhile
+from typing import Any, Dict, List, Optional
 
-from elasticsearch_dsl import Document, field
+from elasticsearch_dsl import field
 
 from findthatpostcode import settings
+from findthatpostcode.documents.base import VersionedDocument
 from findthatpostcode.utils import PostcodeStr
 
 
@@ -16,7 +19,43 @@ class PostcodeSource(Enum):
     PCON = "pcon"  # new parliamentary constituencies - separate lookup provided
 
 
-class Postcode(Document):
+# lengths of hash prefix stored as exact keyword fields (hash3, hash4, hash5)
+HASH_PREFIX_LENGTHS = (3, 4, 5)
+
+# fields converted from strings when importing
+DATE_FIELDS = ("dointr", "doterm")
+GEO_FIELDS = ("lat", "long")
+INT_FIELDS = (
+    "oseast1m",
+    "osnrth1m",
+    "oseast100m",
+    "osnrth100m",
+    "usertype",
+    "osgrdind",
+    "imd",
+)
+
+# values ending in this are dummy codes, and latitude/longitude for no location
+NULL_SUFFIX = "99999999"
+NULL_GEO = 99.999999
+
+# postcodes already in the standard "AB1 2CD" format
+STANDARD_POSTCODE_REGEX = re.compile(r"^[A-Z]{1,2}[0-9][0-9A-Z]? [0-9][A-Z]{2}$")
+
+# string fields which identify the postcode itself rather than an area
+NON_AREA_FIELDS = {
+    "pcd",
+    "pcd2",
+    "pcds",
+    "hash",
+    *["hash{}".format(length) for length in HASH_PREFIX_LENGTHS],
+    "postcode_area",
+    "postcode_district",
+    "postcode_sector",
+}
+
+
+class Postcode(VersionedDocument):
     pcd = field.Keyword()
     pcd2 = field.Keyword()
     pcds = field.Keyword()
@@ -64,7 +103,10 @@ class Postcode(Document):
 
     # added fields
     location = field.GeoPoint()
-    hash = field.Text(index_prefixes={})
+    hash = field.Keyword()
+    hash3 = field.Keyword()
+    hash4 = field.Keyword()
+    hash5 = field.Keyword()
     postcode_area = field.Keyword()
     postcode_district = field.Keyword()
     postcode_sector = field.Keyword()
@@ -73,7 +115,11 @@ class Postcode(Document):
         name = settings.ES_INDICES["postcode"]
 
     def area_codes(self) -> List[str]:
-        return [f for f in self.to_dict().values() if isinstance(f, str)]
+        return [
+            v
+            for k, v in self.to_dict().items()
+            if isinstance(v, str) and k not in NON_AREA_FIELDS
+        ]
 
     @classmethod
     def from_csv(
@@ -87,35 +133,27 @@ class Postcode(Document):
 
         # null any blank fields (or ones with a dummy code in)
         for k in record:
-            if record[k] == "" or record[k].endswith("99999999"):
+            if record[k] == "" or record[k].endswith(NULL_SUFFIX):
                 record[k] = None
 
         # date fields
-        for date_field in ["dointr", "doterm"]:
+        for date_field in DATE_FIELDS:
             if record.get(date_field):
                 record[date_field] = datetime.datetime.strptime(
                     record[date_field], "%Y%m"
                 )
 
         # latitude and longitude
-        for geo_field in ["lat", "long"]:
+        for geo_field in GEO_FIELDS:
             if record.get(geo_field):
                 record[geo_field] = float(record[geo_field])
-                if record[geo_field] == 99.999999:
+                if record[geo_field] == NULL_GEO:
                     record[geo_field] = None
         if record.get("lat") and record.get("long"):
             record["location"] = {"lat": record["lat"], "lon": record["long"]}
 
         # integer fields
-        for int_field in [
-            "oseast1m",
-            "osnrth1m",
-            "oseast100m",
-            "osnrth100m",
-            "usertype",
-            "osgrdind",
-            "imd",
-        ]:
+        for int_field in INT_FIELDS:
             if record.get(int_field):
                 value = record[int_field].strip()
                 if value == "":
@@ -127,6 +165,8 @@ class Postcode(Document):
         record["hash"] = hashlib.md5(
             postcode.lower().replace(" ", "").encode()
         ).hexdigest()
+        for length in HASH_PREFIX_LENGTHS:
+            record["hash{}".format(length)] = record["hash"][0:length]
 
         # add postcode
         record["postcode_area"] = postcode.postcode_area
@@ -136,3 +176,81 @@ class Postcode(Document):
         p = cls(**record)
         p.meta["id"] = postcode
         return p
+
+
+class PostcodeConverter:
+    """
+    Turn raw CSV rows into postcode documents
+
+    Gives the same result as `Postcode.from_csv(record).to_dict()`, but the
+    work of finding the columns is done once from the header rather than for
+    every row, dates are parsed once for each distinct value, and no
+    `Postcode` object is created.
+
+    `columns` can be used to rename columns, in which case only the renamed
+    columns are kept.
+    """
+
+    def __init__(self, header: List[str], columns: Optional[Dict[str, str]] = None):
+        if columns:
+            fields = [(i, columns[c]) for i, c in enumerate(header) if c in columns]
+        else:
+            fields = list(enumerate(header))
+        self.pcds_index = next(i for i, f in fields if f == "pcds")
+        self.date_fields = [(i, f) for i, f in fields if f in DATE_FIELDS]
+        self.geo_fields = [(i, f) for i, f in fields if f in GEO_FIELDS]
+        self.int_fields = [(i, f) for i, f in fields if f in INT_FIELDS]
+        special = {"pcds", *DATE_FIELDS, *GEO_FIELDS, *INT_FIELDS}
+        self.string_fields = [(i, f) for i, f in fields if f not in special]
+        self._dates: Dict[str, datetime.datetime] = {}
+
+    def parse_date(self, value: str) -> datetime.datetime:
+        date = self._dates.get(value)
+        if date is None:
+            date = self._dates[value] = datetime.datetime.strptime(value, "%Y%m")
+        return date
+
+    def __call__(self, row: List[str]) -> Dict[str, Any]:
+        record: Dict[str, Any] = {}
+
+        pcds = row[self.pcds_index]
+        if STANDARD_POSTCODE_REGEX.match(pcds):
+            outward, inward = pcds.split(" ")
+        else:
+            postcode = PostcodeStr(pcds)
+            pcds, outward, inward = str(postcode), postcode.outward, postcode.inward
+        record["pcds"] = pcds
+
+        for i, f in self.string_fields:
+            value = row[i]
+            if value and not value.endswith(NULL_SUFFIX):
+                record[f] = value
+        for i, f in self.date_fields:
+            value = row[i]
+            if value and not value.endswith(NULL_SUFFIX):
+                record[f] = self.parse_date(value)
+        for i, f in self.geo_fields:
+            value = row[i]
+            if value and not value.endswith(NULL_SUFFIX):
+                number = float(value)
+                if number != NULL_GEO:
+                    record[f] = number
+        for i, f in self.int_fields:
+            value = row[i]
+            if value and not value.endswith(NULL_SUFFIX):
+                value = value.strip()
+                if value:
+                    record[f] = int(value)
+
+        if record.get("lat") and record.get("long"):
+            record["location"] = {"lat": record["lat"], "lon": record["long"]}
+
+        hash_ = hashlib.md5((outward + inward).lower().encode()).hexdigest()
+        record["hash"] = hash_
+        for length in HASH_PREFIX_LENGTHS:
+            record["hash{}".format(length)] = hash_[0:length]
+
+        record["postcode_area"] = "".join(takewhile(str.isalpha, outward))
+        record["postcode_district"] = outward
+        record["postcode_sector"] = pcds[:-2]
+        return record
@@ -0,0 +1,70 @@
+import datetime
+from typing import Optional
+
+from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch_dsl import Document, field
+
+from findthatpostcode import settings
+
+
+class Release(Document):
+    """
+    The version of a dataset loaded by one of the import commands
+    """
+
+    dataset = field.Keyword()
+    version = field.Keyword()
+    source = field.Keyword()
+    source_hash = field.Keyword()
+    index = field.Keyword()
+    imported_at = field.Date()
+
+    class Index:
+        name = settings.ES_INDICES["release"]
+
+    @classmethod
+    def record(
+        cls,
+        es: Elasticsearch,
+        dataset: str,
+        version: str,
+        source: Optional[str] = None,
+        source_hash: Optional[str] = None,
+        index: Optional[str] = None,
+    ) -> "Release":
+        release = cls(
+            dataset=dataset,
+            version=version,
+            source=source,
+            source_hash=source_hash,
+            index=index,
+            imported_at=datetime.datetime.now(datetime.timezone.utc),
+        )
+        release.meta["id"] = dataset
+        release.save(using=es)
+        return release
+
+    @classmethod
+    def latest(cls, es: Elasticsearch, dataset: str) -> Optional["Release"]:
+        try:
+            return cls.get(id=dataset, using=es)
+        except NotFoundError:
+            return None
+
+    @classmethod
+    def unchanged(cls, es: Elasticsearch, dataset: str, source_hash: str) -> bool:
+        """
+        Whether the last import of a dataset was from a file with this hash
+        """
+        release = cls.latest(es, dataset)
+        return release is not None and release.source_hash == source_hash
+
+    @classmethod
+    def clear_index(cls, es: Elasticsearch, index: str) -> None:
+        """
+        Forget the releases imported into an index, when the index is replaced
+        with a new one that doesn't hold their data
+        """
+        cls.search(using=es).filter("term", index=index).params(
+            ignore_unavailable=True, conflicts="proceed", refresh=True
+        ).delete()
@@ -6,7 +6,7 @@ from strawberry.fastapi import GraphQLRouter
 from strawberry.types import Info
 
 from findthatpostcode import crud, schemas
-from findthatpostcode.db import get_db
+from findthatpostcode.db import get_db, run_db
 
 
 def get_selected_fields(info: Info) -> Generator[str, None, None]:
@@ -17,40 +17,50 @@ def get_selected_fields(info: Info) -> Generator[str, None, None]:
 @strawberry.type
 class Query:
     @strawberry.field
-    def get_postcode(self, postcode: str, info: Info) -> Optional[schemas.Postcode]:
+    async def get_postcode(
+        self, postcode: str, info: Info
+    ) -> Optional[schemas.Postcode]:
         db = get_db()
-        return crud.get_postcode(db, postcode, fields=list(get_selected_fields(info)))
+        return await run_db(
+            crud.get_postcode, db, postcode, fields=list(get_selected_fields(info))
+        )
 
     @strawberry.field
-    def get_postcodes(
+    async def get_postcodes(
         self, postcodes: List[str], info: Info
     ) -> Optional[List[schemas.Postcode]]:
         db = get_db()
-        return crud.get_postcodes(db, postcodes, fields=list(get_selected_fields(info)))
+        return await run_db(
+            crud.get_postcodes, db, postcodes, fields=list(get_selected_fields(info))
+        )
 
     @strawberry.field
-    def get_nearest_point(
+    async def get_nearest_point(
         self, lat: float, long: float, info: Info
     ) -> Optional[schemas.NearestPoint]:
         db = get_db()
-        return crud.get_nearest_postcode(
-            db, lat, long, fields=list(get_selected_fields(info))
+        return await run_db(
+            crud.get_nearest_postcode,
+            db,
+            lat,
+            long,
+            fields=list(get_selected_fields(info)),
         )
 
     @strawberry.field
-    def get_hashes(self, hashes: List[str], info: Info) -> List[schemas.Postcode]:
+    async def get_hashes(self, hashes: List[str], info: Info) -> List[schemas.Postcode]:
         db = get_db()
-        postcode_items = list(
-            crud.get_postcode_by_hash(
-                db, hashes, fields=list(get_selected_fields(info))
-            )
+        fields = list(get_selected_fields(info))
+        return await run_db(
+            lambda: list(crud.get_postcode_by_hash(db, hashes, fields=fields))
         )
-        return postcode_items
 
     @strawberry.field
-    def get_area(self, areacode: str, info: Info) -> Optional[schemas.Area]:
+    async def get_area(self, areacode: str, info: Info) -> Optional[schemas.Area]:
         db = get_db()
-        return crud.get_area(db, areacode, fields=list(get_selected_fields(info)))
+        return await run_db(
+            crud.get_area, db, areacode, fields=list(get_selected_fields(info))
+        )
 
 
 schema = strawberry.Schema(Query)
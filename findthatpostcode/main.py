@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from typing import Any
 
 from elasticsearch import Elasticsearch
@@ -6,8 +7,9 @@ from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.routing import Route as StarletteRoute
 
-from findthatpostcode import api, crud, graphql
-from findthatpostcode.db import get_db
+from findthatpostcode import api, cache, crud, graphql, settings
+from findthatpostcode.db import close_db, close_s3_client, get_db, get_s3_client
+from findthatpostcode.middleware import ReleaseCacheMiddleware
 from findthatpostcode.routers import areatypes, postcodes, tools
 from findthatpostcode.utils import templates
 
@@ -41,6 +43,28 @@ The licence covers internal use of the data. Commercial use may require addition
 """
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # create the shared clients up front rather than on the first request
+    get_db()
+    get_s3_client()
+    if settings.AREA_NAMES_PRELOAD:
+        cache.area_table.load(get_db())
+        if settings.AREA_NAMES_PRELOAD_REFRESH:
+            cache.area_table.start_refresh(get_db, settings.AREA_NAMES_PRELOAD_REFRESH)
+    if settings.POINT_BOUNDARIES_PRELOAD:
+        # the indexes are keyed by data version, so find it before queueing them
+        cache.release.refresh(get_db())
+        for areatype in settings.POINT_AREA_TYPES:
+            crud.get_area_type_boundaries(
+                get_db(), get_s3_client(), areatype, settings.POINT_BOUNDARY_RESOLUTION
+            )
+    yield
+    cache.area_table.stop_refresh()
+    close_db()
+    close_s3_client()
+
+
 app = FastAPI(
     title="Find that Postcode API",
     description=description,
@@ -58,6 +82,7 @@ app = FastAPI(
         }
     ],
     openapi_url="/api/v1/openapi.json",
+    lifespan=lifespan,
     docs_url="/api/v1/docs",
     # license_info={
     #     "name": "Apache 2.0",
@@ -65,6 +90,8 @@ app = FastAPI(
     # },
 )
 
+app.add_middleware(ReleaseCacheMiddleware, exclude_paths=["/static"])
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 app.include_router(api.router)
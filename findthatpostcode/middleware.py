@@ -0,0 +1,107 @@
+import functools
+import hashlib
+import os
+from email.utils import format_datetime
+from typing import List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from findthatpostcode import cache, settings
+from findthatpostcode.db import get_db, run_db
+
+
+class ReleaseCacheMiddleware:
+    """
+    Add caching headers to responses based on the version of the data loaded
+
+    Successful GET responses get an ETag made from the imported data releases
+    and the app version, along with `Cache-Control` headers that let a CDN keep
+    them until the next import or deploy. Requests with a matching
+    `If-None-Match` header get a 304 response without the route (or
+    Elasticsearch) being called - a client only has the ETag for a URL if it
+    got a successful response from it, and the response can't have changed
+    unless the data or the app has.
+    """
+
+    def __init__(self, app: ASGIApp, exclude_paths: Optional[List[str]] = None):
+        self.app = app
+        self.exclude_paths = exclude_paths or []
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] != "http"
+            or scope["method"] not in ("GET", "HEAD")
+            or any(scope["path"].startswith(p) for p in self.exclude_paths)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        if cache.release.stale:
+            # respect any override of the database dependency, as used in tests
+            db_factory = scope["app"].dependency_overrides.get(get_db, get_db)
+            await run_db(cache.release.refresh, db_factory())
+        if not cache.release.etag:
+            await self.app(scope, receive, send)
+            return
+
+        etag = 'W/"{}-{}"'.format(cache.release.etag, app_version())
+        cache_headers = {
+            "ETag": etag,
+            "Cache-Control": "public, max-age={}, stale-while-revalidate={}".format(
+                settings.HTTP_CACHE_MAX_AGE,
+                settings.HTTP_CACHE_STALE_WHILE_REVALIDATE,
+            ),
+        }
+        if cache.release.last_modified:
+            cache_headers["Last-Modified"] = format_datetime(
+                cache.release.last_modified, usegmt=True
+            )
+
+        if etag_matches(Headers(scope=scope).get("if-none-match"), etag):
+            response = Response(status_code=304, headers=cache_headers)
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                headers = MutableHeaders(scope=message)
+                if "cache-control" not in headers:
+                    for key, value in cache_headers.items():
+                        headers[key] = value
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+@functools.lru_cache(maxsize=None)
+def app_version() -> str:
+    """
+    A short identifier for the deployed version of the app
+
+    Uses `settings.APP_VERSION` if it is set, otherwise a hash of the source
+    files and templates, which is the same in every worker of a deploy.
+    """
+    if settings.APP_VERSION:
+        return settings.APP_VERSION[0:12]
+    package_dir = os.path.dirname(__file__)
+    version = hashlib.md5()
+    for root in (package_dir, os.path.join(os.path.dirname(package_dir), "templates")):
+        for dirpath, dirnames, filenames in sorted(os.walk(root)):
+            dirnames[:] = sorted(
+                d for d in dirnames if d not in ("tests", "__pycache__")
+            )
+            for filename in sorted(filenames):
+                if filename.endswith((".py", ".j2", ".json")):
+                    with open(os.path.join(dirpath, filename), "rb") as f:
+                        version.update(f.read())
+    return version.hexdigest()[0:12]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # `*` isn't accepted, as it would match URLs that don't exist
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return any(t.removeprefix("W/") == etag[2:] for t in tags)
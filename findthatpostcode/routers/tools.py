@@ -1,6 +1,15 @@
-from fastapi import APIRouter, Request
-from fastapi.responses import HTMLResponse
+import codecs
+import csv
+import os
 
+from elasticsearch import Elasticsearch
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import HTMLResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile
+
+from findthatpostcode import crud, settings
+from findthatpostcode.db import get_db
 from findthatpostcode.utils import templates
 
 router = APIRouter(include_in_schema=False, default_response_class=HTMLResponse)
@@ -18,4 +27,51 @@ def geojson_reduce(request: Request):
 
 @router.get("/addtocsv", name="tools_addtocsv")
 def addtocsv(request: Request):
-    return templates.TemplateResponse(request, "addtocsv.html.j2")
+    return templates.TemplateResponse(
+        request,
+        "addtocsv.html.j2",
+        {
+            "basic_fields": settings.BASIC_UPLOAD_FIELDS,
+            "stats_fields": settings.STATS_FIELDS,
+            "default_fields": settings.DEFAULT_UPLOAD_FIELDS,
+            "key_area_types": settings.KEY_AREA_TYPES,
+            "area_types": settings.AREA_TYPES,
+        },
+    )
+
+
+@router.post("/addtocsv", name="tools_addtocsv_upload")
+async def addtocsv_upload(request: Request, db: Elasticsearch = Depends(get_db)):
+    # the form is parsed here rather than with Form/File parameters, as FastAPI
+    # closes uploaded files before a streaming response has been sent
+    form = await request.form()
+    csvfile = form.get("csvfile")
+    column_name = form.get("column_name")
+    fields = [f for f in form.getlist("fields") if isinstance(f, str)]
+    if not isinstance(csvfile, UploadFile) or not isinstance(column_name, str):
+        await form.close()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="A CSV file and postcode column must be provided",
+        )
+
+    # decoded line by line, as the uploaded file can't be wrapped in a
+    # TextIOWrapper on every Python version
+    reader = csv.DictReader(codecs.iterdecode(csvfile.file, "utf-8-sig"))
+    if column_name not in (reader.fieldnames or []):
+        await form.close()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Column {} not found in CSV file".format(column_name),
+        )
+
+    filename = os.path.splitext(os.path.basename(csvfile.filename or "postcodes"))[0]
+    filename = filename.replace('"', "")
+    return StreamingResponse(
+        crud.add_fields_to_csv(db, reader, column_name, fields),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": 'attachment; filename="{}-geo.csv"'.format(filename)
+        },
+        background=BackgroundTask(form.close),
+    )
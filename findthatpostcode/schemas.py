@@ -242,6 +242,18 @@ class Placename:
         return {"name": "Place"}
 
 
+@dataclass
+class PointArea:
+    code: str
+    type: str
+    name: Optional[str] = None
+
+
+@dataclass
+class PointAreas(Point):
+    areas: List[PointArea]
+
+
 @dataclass
 class AreaSearchResults:
     result_count: int
@@ -1,5 +1,6 @@
 import json
 import os
+import tempfile
 
 from dotenv import load_dotenv
 
@@ -25,15 +26,157 @@ ES_INDICES = {
     "postcode": str(ES_INDEX_PREFIX) + "_postcode",
     "placename": str(ES_INDEX_PREFIX) + "_placename",
     "uprn": str(ES_INDEX_PREFIX) + "_uprn",
+    "release": str(ES_INDEX_PREFIX) + "_release",
 }
+ES_THREADPOOL_SIZE = int(os.environ.get("ES_THREADPOOL_SIZE", 20))
+ES_MAXSIZE = int(os.environ.get("ES_MAXSIZE", ES_THREADPOOL_SIZE))  # connection pool
+ES_TIMEOUT = float(os.environ.get("ES_TIMEOUT", 10))  # default per-request timeout
+ES_BULK_TIMEOUT = float(os.environ.get("ES_BULK_TIMEOUT", 120))
+ES_BULK_CONCURRENCY = int(os.environ.get("ES_BULK_CONCURRENCY", 2))  # batches in flight
+ES_BULK_MAX_BYTES = int(os.environ.get("ES_BULK_MAX_BYTES", 10 * 1024 * 1024))
+ES_BULK_MAX_RETRIES = int(os.environ.get("ES_BULK_MAX_RETRIES", 5))  # on 429 errors
+ES_BULK_INITIAL_BACKOFF = float(os.environ.get("ES_BULK_INITIAL_BACKOFF", 2))
+ES_HTTP_COMPRESS = os.environ.get("ES_HTTP_COMPRESS", "true").lower()[0] == "t"
+ES_REPLICAS = int(os.environ.get("ES_REPLICAS", 1))  # once a new index is live
+ES_INDEX_VERSIONS_KEEP = int(os.environ.get("ES_INDEX_VERSIONS_KEEP", 1))  # old ones
+ES_FORCEMERGE_TIMEOUT = float(os.environ.get("ES_FORCEMERGE_TIMEOUT", 60 * 60))
+ES_MAX_RETRIES = int(os.environ.get("ES_MAX_RETRIES", 3))
 DEFAULT_ENCODING = "latin1"
 
+# number of processes used to parse postcode files during an import
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", 1))
+
+# maximum number of area codes to request in a single mget call
+AREA_NAMES_CHUNK_SIZE = 1000
+
+# number of postcodes to fetch at once when streaming bulk lookups
+POSTCODES_CHUNK_SIZE = 1000
+
+# number of postcodes to fetch per request when looking up hash prefixes
+HASH_LOOKUP_PAGE_SIZE = 5000
+
+# limits on the number of hashes in one lookup and the postcodes it can return
+HASH_LOOKUP_MAX_HASHES = int(os.environ.get("HASH_LOOKUP_MAX_HASHES", 1000))
+HASH_LOOKUP_MAX_RESULTS = int(os.environ.get("HASH_LOOKUP_MAX_RESULTS", 20000))
+
+# postcodes fetched per page when exporting every postcode in an area, and how
+# long the point in time used to page through them is kept open between pages
+AREA_POSTCODES_PAGE_SIZE = 5000
+ES_PIT_KEEP_ALIVE = os.environ.get("ES_PIT_KEEP_ALIVE", "2m")
+
+# in-process cache of area names (set size to 0 to disable)
+AREA_NAMES_CACHE_SIZE = int(os.environ.get("AREA_NAMES_CACHE_SIZE", 50000))
+AREA_NAMES_CACHE_TTL = int(os.environ.get("AREA_NAMES_CACHE_TTL", 60 * 60))
+
+# load every area name into memory at startup, refreshing every N seconds
+AREA_NAMES_PRELOAD = os.environ.get("AREA_NAMES_PRELOAD", "false").lower()[0] == "t"
+AREA_NAMES_PRELOAD_REFRESH = int(
+    os.environ.get("AREA_NAMES_PRELOAD_REFRESH", 60 * 60 * 6)
+)
+AREA_NAMES_PRELOAD_PAGE_SIZE = 5000
+
+# HTTP caching - responses carry an ETag based on the data releases imported,
+# which is checked against the database every RELEASE_CHECK_INTERVAL seconds
+HTTP_CACHE_MAX_AGE = int(os.environ.get("HTTP_CACHE_MAX_AGE", 60 * 60 * 24))
+HTTP_CACHE_STALE_WHILE_REVALIDATE = int(
+    os.environ.get("HTTP_CACHE_STALE_WHILE_REVALIDATE", 60 * 60 * 24 * 7)
+)
+RELEASE_CHECK_INTERVAL = int(os.environ.get("RELEASE_CHECK_INTERVAL", 60))
+# the ETag also includes the version of the app, so a deploy invalidates cached
+# responses - if no version is set a hash of the code and templates is used
+APP_VERSION = os.environ.get("APP_VERSION", os.environ.get("GIT_REV"))
+
 # S3 Storage settings
 S3_REGION = os.environ.get("S3_REGION")
 S3_ENDPOINT = os.environ.get("S3_ENDPOINT")
 S3_ACCESS_ID = os.environ.get("S3_ACCESS_ID")
 S3_SECRET_KEY = os.environ.get("S3_SECRET_KEY")
 S3_BUCKET = os.environ.get("S3_BUCKET", "geo-boundaries")
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 20))
+S3_TIMEOUT = float(os.environ.get("S3_TIMEOUT", 10))
+
+# boundaries served by the API are cached in memory and on disk (0 disables)
+BOUNDARY_CACHE_MAX_BYTES = int(
+    os.environ.get("BOUNDARY_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+)
+BOUNDARY_CACHE_DIR = os.environ.get(
+    "BOUNDARY_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "findthatpostcode-boundaries"),
+)
+BOUNDARY_CACHE_DISK_BYTES = int(
+    os.environ.get("BOUNDARY_CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024)
+)
+
+# simplified boundaries generated on import, as the tolerance used to simplify
+# them (in degrees) and the number of decimal places kept in coordinates
+BOUNDARY_RESOLUTIONS = {
+    "high": (0.0001, 5),
+    "medium": (0.001, 4),
+    "low": (0.005, 3),
+}
+
+# compression used for the gzip and brotli versions of boundaries made on import
+BOUNDARY_GZIP_LEVEL = int(os.environ.get("BOUNDARY_GZIP_LEVEL", 9))
+BOUNDARY_BROTLI_QUALITY = int(os.environ.get("BOUNDARY_BROTLI_QUALITY", 11))
+
+# vector tiles of boundaries are made when first requested, then cached in
+# memory and on disk
+TILE_CACHE_MAX_BYTES = int(os.environ.get("TILE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+TILE_CACHE_DIR = os.environ.get(
+    "TILE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "findthatpostcode-tiles"),
+)
+TILE_CACHE_DISK_BYTES = int(os.environ.get("TILE_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+TILE_MAX_ZOOM = int(os.environ.get("TILE_MAX_ZOOM", 16))
+
+# the simplified boundaries used to make tiles, by the lowest zoom level
+# each one is used for
+TILE_RESOLUTIONS = {0: "low", 8: "medium", 11: "high"}
+
+# area types with many small areas only have tiles from this zoom level, as a
+# tile covering a large part of the country would clip thousands of them
+TILE_MIN_ZOOM = {
+    "oa11": 12,
+    "wz11": 12,
+    "lsoa11": 10,
+    "msoa11": 8,
+    "ward": 8,
+    "par": 8,
+}
+
+# every boundary of an area type is loaded into memory (in the background) to
+# make tiles - this many sets of boundaries are kept, up to a total
+# (estimated) size in bytes, each fetched with this many threads. Requests
+# made while they load are asked to retry after this many seconds, and each
+# set is loaded at most once in the retry interval.
+AREA_BOUNDARIES_CACHE_SIZE = int(os.environ.get("AREA_BOUNDARIES_CACHE_SIZE", 16))
+AREA_BOUNDARIES_CACHE_MAX_BYTES = int(
+    os.environ.get("AREA_BOUNDARIES_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+)
+BOUNDARY_LOAD_CONCURRENCY = int(os.environ.get("BOUNDARY_LOAD_CONCURRENCY", 16))
+BOUNDARY_LOAD_RETRY_AFTER = int(os.environ.get("BOUNDARY_LOAD_RETRY_AFTER", 30))
+BOUNDARY_LOAD_RETRY_INTERVAL = int(
+    os.environ.get("BOUNDARY_LOAD_RETRY_INTERVAL", 5 * 60)
+)
+
+# boundary imports - uploads in flight per file, and boundary files at once
+BOUNDARY_UPLOAD_CONCURRENCY = int(os.environ.get("BOUNDARY_UPLOAD_CONCURRENCY", 16))
+BOUNDARY_UPLOAD_RETRIES = int(os.environ.get("BOUNDARY_UPLOAD_RETRIES", 3))
+BOUNDARY_UPLOAD_BACKOFF = float(os.environ.get("BOUNDARY_UPLOAD_BACKOFF", 1))
+BOUNDARY_IMPORT_WORKERS = int(os.environ.get("BOUNDARY_IMPORT_WORKERS", 1))
+
+# downloaded source files are streamed to disk here before being imported
+DOWNLOAD_DIR = os.environ.get(
+    "DOWNLOAD_DIR", os.path.join(tempfile.gettempdir(), "findthatpostcode")
+)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_RETRIES = 5
+
+# fingerprints of the postcodes sent by the last incremental import
+FINGERPRINT_DIR = os.environ.get(
+    "FINGERPRINT_DIR", os.path.join(DOWNLOAD_DIR, "fingerprints")
+)
 
 # postcode data URLs
 NSPL_URL = "https://www.arcgis.com/sharing/rest/content/items/677cfc3ef56541999314efc795664ce9/data"
@@ -72,6 +215,15 @@ KEY_AREA_TYPES = [
     ("Other", ["bua11", "wz11"]),
 ]
 
+# area types a point is looked up in when none are asked for, and the
+# boundaries used to find them - these can be loaded when the app starts,
+# rather than when first used, if there is memory for them in every worker
+POINT_AREA_TYPES = KEY_AREA_TYPES[0][1]
+POINT_BOUNDARY_RESOLUTION = os.environ.get("POINT_BOUNDARY_RESOLUTION", "high")
+POINT_BOUNDARIES_PRELOAD = (
+    os.environ.get("POINT_BOUNDARIES_PRELOAD", "false").lower()[0] == "t"
+)
+
 OTHER_CODES = {
     "osgrdind": [
         "",  # no code 0
@@ -97,7 +249,23 @@ OTHER_CODES = {
 }
 
 
+# postcode fields holding codes for an area type, where they differ from the
+# area type itself
+AREA_POSTCODE_FIELDS = {
+    "lep": ["lep1", "lep2"],
+    "oa11": ["oa11", "oa21"],
+    "lsoa11": ["lsoa11", "lsoa21"],
+    "msoa11": ["msoa11", "msoa21"],
+}
+
 DEFAULT_UPLOAD_FIELDS = ["latlng", "laua", "laua_name", "rgn", "rgn_name"]
+# upload fields which are added as more than one column
+UPLOAD_FIELD_ALIASES = {
+    "latlng": ["lat", "long"],
+    "estnrth": ["oseast1m", "osnrth1m"],
+    "lep": ["lep1", "lep2"],
+    "lep_name": ["lep1_name", "lep2_name"],
+}
 BASIC_UPLOAD_FIELDS = [
     ("latlng", "Latitude / Longitude", False),
     ("estnrth", "OS Easting / Northing", False),
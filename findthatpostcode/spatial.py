@@ -0,0 +1,161 @@
+"""
+Spatial indexes of area boundaries, used to make vector tiles and to find
+the areas containing a point
+"""
+
+import json
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import mapbox_vector_tile
+import numpy as np
+import shapely
+from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
+from shapely.geometry import box, shape
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
+
+EARTH_RADIUS = 6378137
+MERCATOR_MAX_LAT = 85.0511287798066
+
+# tiles are drawn on a grid of TILE_EXTENT units, with geometries clipped a
+# little outside the tile so lines aren't drawn along the tile edges
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+TILE_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+# rough memory used by each coordinate of a boundary, and by each area, used
+# to keep the indexes held in memory under a size limit
+COORDINATE_BYTES = 32
+AREA_BYTES = 256
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    The (west, south, east, north) bounds of a web mercator tile, in degrees
+    """
+    n = 2**z
+
+    def lat(y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def to_mercator(geometry: BaseGeometry) -> BaseGeometry:
+    """
+    Project a geometry from longitude and latitude to web mercator metres
+    """
+
+    def project(coords: np.ndarray) -> np.ndarray:
+        lat = np.clip(coords[:, 1], -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT)
+        return np.column_stack(
+            [
+                np.radians(coords[:, 0]) * EARTH_RADIUS,
+                np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS,
+            ]
+        )
+
+    return shapely.transform(geometry, project)
+
+
+def tile_is_valid(z: int, x: int, y: int, max_zoom: int, min_zoom: int = 0) -> bool:
+    return min_zoom <= z <= max_zoom and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+class AreaBoundaries:
+    """
+    The boundaries of every area of one type, in an STRtree spatial index
+
+    Geometries are kept in longitude and latitude, and only the parts of
+    them inside a tile are projected when the tile is made. They are also
+    prepared, so testing points against them is fast. `nbytes` is a rough
+    estimate of the memory used, so caches of indexes can be limited by size.
+    """
+
+    def __init__(
+        self,
+        codes: List[str],
+        geometries: List[BaseGeometry],
+        names: Optional[List[Optional[str]]] = None,
+    ):
+        self.codes = codes
+        self.names = names or [None] * len(codes)
+        self.geometries = np.array(geometries, dtype=object)
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+        self.nbytes = (
+            int(shapely.get_num_coordinates(self.geometries).sum()) * COORDINATE_BYTES
+            + len(codes) * AREA_BYTES
+        )
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def from_geojson(cls, boundaries: Iterable[Tuple[str, bytes]]) -> "AreaBoundaries":
+        """
+        Build the index from (area code, GeoJSON feature) pairs, taking the
+        name of each area from a property ending in `nm` if there is one
+        """
+        codes: List[str] = []
+        names: List[Optional[str]] = []
+        geometries: List[BaseGeometry] = []
+        for code, boundary in boundaries:
+            feature: Dict[str, Any] = json.loads(boundary)
+            if not feature.get("geometry"):
+                continue
+            properties = feature.get("properties") or {}
+            codes.append(code)
+            names.append(
+                next(
+                    (v for k, v in properties.items() if k.lower().endswith("nm")),
+                    None,
+                )
+            )
+            geometries.append(shape(feature["geometry"]))
+        return cls(codes, geometries, names)
+
+    def containing(self, lon: float, lat: float) -> List[int]:
+        """
+        The positions of the areas containing (or on the edge of) a point
+        """
+        point = shapely.Point(lon, lat)
+        return sorted(int(i) for i in self.tree.query(point, predicate="intersects"))
+
+    def tile(self, z: int, x: int, y: int, layer: str) -> bytes:
+        """
+        A Mapbox vector tile of the boundaries in one web mercator tile
+
+        Each boundary is clipped to the tile and then simplified to the size
+        of a unit on the tile's grid, so tiles at every zoom level stay small.
+        """
+        west, south, east, north = tile_bounds(z, x, y)
+        buffer_x = (east - west) * TILE_BUFFER / TILE_EXTENT
+        buffer_y = (north - south) * TILE_BUFFER / TILE_EXTENT
+        clip = (west - buffer_x, south - buffer_y, east + buffer_x, north + buffer_y)
+        mercator_bounds = to_mercator(box(west, south, east, north)).bounds
+        tolerance = (mercator_bounds[2] - mercator_bounds[0]) / TILE_EXTENT
+
+        features = []
+        for i in sorted(self.tree.query(box(*clip))):
+            geometry = shapely.clip_by_rect(self.geometries[i], *clip)
+            if geometry.is_empty:
+                continue
+            geometry = to_mercator(geometry).simplify(tolerance)
+            if geometry.is_empty:
+                continue
+            properties = {"code": self.codes[i]}
+            if self.names[i]:
+                properties["name"] = self.names[i]
+            features.append({"geometry": geometry, "properties": properties})
+
+        return mapbox_vector_tile.encode(
+            [{"name": layer, "features": features}],
+            default_options={
+                "quantize_bounds": mercator_bounds,
+                "extents": TILE_EXTENT,
+                "on_invalid_geometry": on_invalid_geometry_make_valid,
+            },
+        )
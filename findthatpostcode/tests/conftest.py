@@ -1,12 +1,28 @@
 import pytest
 
 import findthatpostcode.utils
+from benchmarks.stubs import stub_postcodes
+from findthatpostcode import cache, settings
+from findthatpostcode.cache import AreaBoundaryIndexes, BoundaryCache
 from findthatpostcode.commands.codes import (
     Area,
     Entity,
     db,
 )
-from findthatpostcode.tests.fixtures import MOCK_FILES, MockES, mock_bulk
+from findthatpostcode.db import get_db, get_s3_client
+from findthatpostcode.main import app
+from findthatpostcode.tests.fixtures import (
+    MOCK_FILES,
+    MockES,
+    StubS3,
+    mock_streaming_bulk,
+)
+
+
+@pytest.fixture(autouse=True)
+def download_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_DIR", str(tmp_path / "downloads"))
+    monkeypatch.setattr(settings, "FINGERPRINT_DIR", str(tmp_path / "fingerprints"))
 
 
 @pytest.fixture
@@ -20,4 +36,44 @@ def mock_files(requests_mock, monkeypatch):
     monkeypatch.setattr(db, "get_db", lambda: MockES())
     monkeypatch.setattr(Entity, "init", lambda *args, **kwargs: None)
     monkeypatch.setattr(Area, "init", lambda *args, **kwargs: None)
-    monkeypatch.setattr(findthatpostcode.utils, "bulk", mock_bulk)
+    monkeypatch.setattr(findthatpostcode.utils, "streaming_bulk", mock_streaming_bulk)
+
+
+@pytest.fixture
+def bulk_actions(monkeypatch):
+    # the actions sent to elasticsearch by BulkImporter, in the order sent
+    actions = []
+
+    def recording_bulk(es, records, **kwargs):
+        for record in records:
+            actions.append(record)
+            yield True, {}
+
+    monkeypatch.setattr(findthatpostcode.utils, "streaming_bulk", recording_bulk)
+    return actions
+
+
+@pytest.fixture
+def stub_db(monkeypatch):
+    # a database of local authorities (without postcodes) used by the API
+    es = stub_postcodes(0)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: es)
+    return es
+
+
+@pytest.fixture
+def s3(stub_db, tmp_path, monkeypatch):
+    # an empty bucket used by the API, with empty boundary, tile and index
+    # caches - boundaries and tiles are cached on disk in tmp_path
+    s3 = StubS3()
+    monkeypatch.setitem(app.dependency_overrides, get_s3_client, lambda: s3)
+    for name in ["boundaries", "tiles"]:
+        monkeypatch.setattr(
+            cache,
+            name,
+            BoundaryCache(
+                max_bytes=100000, disk_dir=str(tmp_path / name), disk_max_bytes=100000
+            ),
+        )
+    monkeypatch.setattr(cache, "area_boundaries", AreaBoundaryIndexes(maxsize=16))
+    return s3
@@ -1,5 +1,8 @@
+import io
 import os
 
+from botocore.exceptions import ClientError
+from elasticsearch import NotFoundError
 from fastapi.testclient import TestClient
 
 from findthatpostcode.main import app, get_db
@@ -45,21 +48,40 @@ MOCK_FILES = {
 }
 
 
-def mock_bulk(es, records, **kwargs):
-    return len(records), []
+def mock_streaming_bulk(es, actions, **kwargs):
+    for action in actions:
+        yield True, {"index": {"_id": action.get("_id"), "status": 200}}
+
+
+class MockIndices:
+    def __init__(self):
+        self.aliases = {}
+
+    def exists_alias(self, name, **kwargs):
+        return name in self.aliases
+
+    def get_alias(self, name, **kwargs):
+        return {self.aliases[name]: {"aliases": {name: {}}}}
+
+    def exists(self, index, **kwargs):
+        return True
 
 
 class MockES:
     def __init__(self):
         self._index = {}
         self._index_name = None
+        self.indices = MockIndices()
 
-    def index(self, index_name, doc_type, body, id):
-        self._index_name = index_name
+    def index(self, index, body, id, doc_type=None, **kwargs):
+        self._index_name = index
         self._index[id] = body
+        return {"_index": index, "_id": id, "result": "created"}
 
-    def get(self, index_name, doc_type, id):
-        return self._index[id]
+    def get(self, index, id, doc_type=None, **kwargs):
+        if id not in self._index:
+            raise NotFoundError(404, "not_found", {"_id": id, "found": False})
+        return {"_index": index, "_id": id, "found": True, "_source": self._index[id]}
 
     def search(self, *args, **kwargs):
         return {
@@ -72,6 +94,31 @@ class MockES:
         }
 
 
+class StubS3:
+    """
+    Minimal stand-in for the S3 client, holding objects by key
+    """
+
+    def __init__(self, objects=None):
+        self.objects = objects or {}
+        self.calls = []
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.calls.append(("get_object", Key))
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix="", **kwargs):
+        self.calls.append(("list_objects_v2", Prefix))
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        yield {"Contents": [{"Key": k} for k in keys]} if keys else {}
+
+
 def override_get_db():
     return MockES()
 
@@ -1,4 +1,18 @@
+import csv
+import gzip
+import io
+import json
+
+import brotli
+import mapbox_vector_tile
+
+from benchmarks.stubs import stub_postcodes
+from findthatpostcode import cache, settings, spatial
+from findthatpostcode.cache import AreaBoundaryIndexes
+from findthatpostcode.db import get_db
+from findthatpostcode.main import app
 from findthatpostcode.tests.fixtures import client
+from findthatpostcode.tests.test_spatial import square
 
 
 def test_read_main():
@@ -6,3 +20,398 @@ def test_read_main():
     assert response.status_code == 200
     assert response.headers["content-type"] == "text/html; charset=utf-8"
     assert "Find that Postcode" in response.text
+
+
+def test_read_postcode(monkeypatch):
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    response = client.get("/api/v1/postcodes/AB10%200CD.json")
+    assert response.status_code == 200
+    result = response.json()
+    assert result["pcds"] == "AB10 0CD"
+    assert result["laua_name"] == "Local authority 0"
+
+
+def test_read_postcodes_ndjson(monkeypatch):
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    response = client.post(
+        "/api/v1/postcodes",
+        params={"fields": ["laua_name"]},
+        json=["AB10 0CD", "ab101cd", "ZZ99 9ZZ"],
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {"pcds": "AB10 0CD", "laua_name": "Local authority 0"},
+        {"pcds": "AB10 1CD", "laua_name": "Local authority 1"},
+        {"pcds": "ZZ99 9ZZ", "laua_name": None},
+    ]
+
+
+def test_read_postcodes_csv(monkeypatch):
+    monkeypatch.setattr(settings, "POSTCODES_CHUNK_SIZE", 2)
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    response = client.post(
+        "/api/v1/postcodes",
+        params={"fields": ["laua", "laua_name"], "format": "csv"},
+        content="AB10 0CD\nAB10 1CD\n\nAB10 2CD\n",
+        headers={"content-type": "text/plain"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == 3
+    assert db.count_calls("mget", settings.ES_INDICES["postcode"]) == 2
+    assert rows[2] == {
+        "pcds": "AB10 2CD",
+        "laua": "E07000002",
+        "laua_name": "Local authority 2",
+    }
+
+
+def test_read_postcodes_streamed(monkeypatch):
+    monkeypatch.setattr(settings, "POSTCODES_CHUNK_SIZE", 2)
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+
+    def body():
+        # lines are split across the chunks of the request body
+        yield b"AB10 0CD\nAB1"
+        yield b"0 1CD\n\nab100cd\n"
+        yield b"AB10 0CD"
+
+    response = client.post(
+        "/api/v1/postcodes",
+        params={"fields": ["laua"]},
+        content=body(),
+        headers={"content-type": "text/plain"},
+    )
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["pcds"] for line in lines] == [
+        "AB10 0CD",
+        "AB10 1CD",
+        "AB10 0CD",
+        "AB10 0CD",
+    ]
+    assert db.count_calls("mget", settings.ES_INDICES["postcode"]) == 2
+
+
+def test_read_postcodes_invalid():
+    response = client.post("/api/v1/postcodes", json={"postcodes": "AB10 0CD"})
+    assert response.status_code == 400
+    response = client.post("/api/v1/postcodes", json=[1, "AB10 0CD"])
+    assert response.status_code == 400
+    response = client.post("/api/v1/postcodes", json=[])
+    assert response.status_code == 200
+    assert response.text == ""
+
+
+def test_area_postcodes_json(monkeypatch):
+    db = stub_postcodes(100)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    response = client.get("/api/v1/areas/E07000001/postcodes")
+    assert response.status_code == 200
+    result = response.json()
+    assert len(result) == 4
+    assert result[0]["laua"] == "E07000001"
+    assert result[0]["laua_name"] == "Local authority 1"
+
+
+def test_area_postcodes_csv(monkeypatch):
+    db = stub_postcodes(100)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    response = client.get(
+        "/api/v1/areas/E07000001/postcodes",
+        params={"format": "csv", "fields": ["laua_name"]},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert list(rows[0].keys()) == ["pcds", "laua_name"]
+    assert len(rows) == 4
+
+
+def test_area_postcodes_not_found(monkeypatch):
+    db = stub_postcodes(100)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    assert client.get("/api/v1/areas/E07009999/postcodes").status_code == 404
+    assert client.get("/api/v1/areas/X99999999/postcodes").status_code == 404
+
+
+def test_hash_too_many(monkeypatch):
+    monkeypatch.setattr(settings, "HASH_LOOKUP_MAX_HASHES", 2)
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    response = client.post("/api/v1/hashes.json", data={"hash": ["abc", "abd", "abe"]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "No more than 2 hashes can be looked up at once"
+
+    response = client.get("/api/v1/hash/ab.json")
+    assert response.status_code == 400
+
+
+def test_addtocsv_upload(monkeypatch):
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    response = client.post(
+        "/tools/addtocsv",
+        data={"column_name": "postcode", "fields": ["latlng", "laua_name"]},
+        files={"csvfile": ("test.csv", b"postcode\nAB10 0CD\n", "text/csv")},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert 'filename="test-geo.csv"' in response.headers["content-disposition"]
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert rows == [
+        {
+            "postcode": "AB10 0CD",
+            "lat": "",
+            "long": "",
+            "laua_name": "Local authority 0",
+        }
+    ]
+
+
+def test_addtocsv_upload_encoding(monkeypatch):
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    # a byte order mark, windows line endings and a quoted line break
+    content = '\ufeffname,postcode\r\n"Caf\u00e9\r\nNorth",AB10 0CD\r\n'
+    response = client.post(
+        "/tools/addtocsv",
+        data={"column_name": "postcode", "fields": ["laua"]},
+        files={"csvfile": ("test.csv", content.encode("utf-8"), "text/csv")},
+    )
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert rows == [
+        {"name": "Caf\u00e9\r\nNorth", "postcode": "AB10 0CD", "laua": "E07000000"}
+    ]
+
+
+def test_addtocsv_upload_missing_column():
+    response = client.post(
+        "/tools/addtocsv",
+        data={"column_name": "pc"},
+        files={"csvfile": ("test.csv", b"postcode\nAB10 0CD\n", "text/csv")},
+    )
+    assert response.status_code == 400
+
+
+def test_area_boundary(s3):
+    feature = {"type": "Feature", "properties": {"code": "E07000001"}}
+    s3.objects["E07/E07000001.json"] = json.dumps(feature).encode()
+
+    headers = {"Accept-Encoding": "identity"}
+    for _ in range(2):
+        response = client.get("/api/v1/areas/E07000001.geojson", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        assert response.json() == feature
+        response = client.get("/api/v1/areas/E07009999.geojson", headers=headers)
+        assert response.status_code == 404
+
+    # each area is only fetched from S3 once, including missing areas
+    assert s3.calls == [
+        ("get_object", "E07/E07000001.json"),
+        ("get_object", "E07/E07009999.json"),
+    ]
+
+
+def test_area_boundary_resolution(s3, tmp_path):
+    feature = {"type": "Feature", "properties": {"code": "E07000001"}}
+    low = {"type": "Feature", "properties": {"code": "E07000001", "low": True}}
+    s3.objects.update(
+        {
+            "E07/E07000001.json": json.dumps(feature).encode(),
+            "E07/E07000001.low.json": json.dumps(low).encode(),
+            "E07/E07000002.json": json.dumps(feature).encode(),
+        }
+    )
+
+    headers = {"Accept-Encoding": "identity"}
+    response = client.get(
+        "/api/v1/areas/E07000001.geojson?resolution=low", headers=headers
+    )
+    assert response.status_code == 200
+    assert response.json() == low
+    response = client.get("/api/v1/areas/E07000001.geojson", headers=headers)
+    assert response.json() == feature
+
+    # areas imported without simplified versions get the full boundary
+    response = client.get(
+        "/api/v1/areas/E07000002.geojson?resolution=medium", headers=headers
+    )
+    assert response.status_code == 200
+    assert response.json() == feature
+
+    response = client.get(
+        "/api/v1/areas/E07000001.geojson?resolution=tiny", headers=headers
+    )
+    assert response.status_code == 422
+
+    assert s3.calls == [
+        ("get_object", "E07/E07000001.low.json"),
+        ("get_object", "E07/E07000001.json"),
+        ("get_object", "E07/E07000002.medium.json"),
+        ("get_object", "E07/E07000002.json"),
+    ]
+    assert (tmp_path / "boundaries" / "unversioned" / "E07000001.low.json").exists()
+
+
+def test_area_boundary_compressed(s3):
+    body = json.dumps({"type": "Feature", "properties": {"code": "E07000001"}})
+    s3.objects.update(
+        {
+            "E07/E07000001.json": body.encode(),
+            "E07/E07000001.json.br": brotli.compress(body.encode()),
+            "E07/E07000001.json.gz": gzip.compress(body.encode()),
+            "E07/E07000002.json": body.encode(),
+        }
+    )
+
+    for accept_encoding, content_encoding in [
+        ("gzip, deflate, br", "br"),
+        ("gzip;q=1.0, br;q=0.5", "gzip"),
+        ("deflate", None),
+    ]:
+        response = client.get(
+            "/api/v1/areas/E07000001.geojson",
+            headers={"Accept-Encoding": accept_encoding},
+        )
+        assert response.status_code == 200
+        assert response.headers.get("content-encoding") == content_encoding
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.text == body
+
+    # boundaries imported without compressed versions are sent uncompressed
+    response = client.get(
+        "/api/v1/areas/E07000002.geojson", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.text == body
+
+
+def test_boundary_tile(s3, stub_db):
+    objects = dict(
+        [
+            square("E07000001", -2.0, 52.0),
+            square("E07000002", -1.5, 52.0),
+            square("E07000003", -1.5, 52.0),
+            square("E01000001", -1.5, 52.0),
+        ]
+    )
+    # terminated areas aren't included
+    stub_db.documents[settings.ES_INDICES["area"]]["E07000003"]["active"] = False
+    objects = {"{}/{}.json".format(code[0:3], code): b for code, b in objects.items()}
+    # simplified and compressed boundaries aren't loaded as separate areas
+    objects["E07/E07000001.json.gz"] = gzip.compress(objects["E07/E07000001.json"])
+    s3.objects.update(objects)
+
+    # the boundaries are loaded in the background, rather than in the request
+    response = client.get("/api/v1/tiles/laua/7/63/42.mvt")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == str(settings.BOUNDARY_LOAD_RETRY_AFTER)
+    cache.area_boundaries.wait()
+
+    for _ in range(2):
+        response = client.get("/api/v1/tiles/laua/7/63/42.mvt")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == spatial.TILE_MEDIA_TYPE
+        tile = mapbox_vector_tile.decode(response.content)
+        assert {f["properties"]["code"] for f in tile["laua"]["features"]} == {
+            "E07000001",
+            "E07000002",
+        }
+
+    # boundaries are loaded once, using the low resolution level for zoom 7
+    assert s3.calls.count(("list_objects_v2", "E07/")) == 1
+    assert ("get_object", "E07/E07000001.low.json") in s3.calls
+    assert ("get_object", "E01/E01000001.json") not in s3.calls
+    assert ("get_object", "E07/E07000003.low.json") not in s3.calls
+    # and not through the boundary cache
+    assert len(cache.boundaries.memory) == 0
+    calls = len(s3.calls)
+
+    # other tiles are made from the loaded boundaries
+    response = client.get("/api/v1/tiles/laua/7/0/0.mvt")
+    assert response.status_code == 200
+    assert mapbox_vector_tile.decode(response.content)["laua"]["features"] == []
+    assert len(s3.calls) == calls
+
+    assert client.get("/api/v1/tiles/unknown/7/63/42.mvt").status_code == 404
+    assert client.get("/api/v1/tiles/laua/7/128/42.mvt").status_code == 404
+    assert client.get("/api/v1/tiles/laua/30/0/0.mvt").status_code == 404
+    # small areas don't have tiles at low zoom levels
+    assert client.get("/api/v1/tiles/oa11/7/63/42.mvt").status_code == 404
+    assert ("list_objects_v2", "E00/") not in s3.calls
+
+
+def test_point_areas(s3, stub_db, monkeypatch):
+    s3.objects.update(
+        {
+            "{}/{}.json".format(code[0:3], code): boundary
+            for code, boundary in [
+                square("E07000001", -2.0, 52.0),
+                square("E07000002", -1.5, 52.0),
+                square("E07000003", -2.0, 52.0),
+                square("E92000001", -3.0, 51.0, size=2),
+            ]
+        }
+    )
+    stub_db.documents[settings.ES_INDICES["area"]]["E07000003"]["active"] = False
+    monkeypatch.setattr(settings, "POINT_AREA_TYPES", ["ctry", "laua"])
+
+    response = client.get("/api/v1/points/52.25,-1.75/areas")
+    assert response.status_code == 503
+    cache.area_boundaries.wait()
+    # both area types are loaded, at the default resolution
+    assert ("get_object", "E92/E92000001.high.json") in s3.calls
+    assert ("get_object", "E07/E07000001.high.json") in s3.calls
+
+    response = client.get("/api/v1/points/52.25,-1.75/areas")
+    assert response.status_code == 200
+    assert response.json() == {
+        "point_lat": 52.25,
+        "point_long": -1.75,
+        "areas": [
+            {"code": "E92000001", "type": "ctry", "name": "Area E92000001"},
+            {"code": "E07000001", "type": "laua", "name": "Area E07000001"},
+        ],
+    }
+    calls = len(s3.calls)
+
+    # later lookups use the loaded boundaries
+    response = client.get("/api/v1/points/52.25,-1.25/areas?areatype=laua")
+    assert [a["code"] for a in response.json()["areas"]] == ["E07000002"]
+    response = client.get("/api/v1/points/60.0,-1.25/areas")
+    assert response.json()["areas"] == []
+    assert len(s3.calls) == calls
+
+    response = client.get("/api/v1/points/52.25,-1.25/areas?areatype=unknown")
+    assert response.status_code == 400
+
+
+def test_point_areas_too_big(s3, monkeypatch):
+    s3.objects["E07/E07000001.json"] = square("E07000001", -2.0, 52.0)[1]
+    monkeypatch.setattr(
+        cache, "area_boundaries", AreaBoundaryIndexes(maxsize=16, max_bytes=10)
+    )
+
+    response = client.get("/api/v1/points/52.25,-1.75/areas?areatype=laua")
+    assert response.status_code == 503
+    cache.area_boundaries.wait()
+    calls = len(s3.calls)
+
+    # the index isn't kept, and isn't loaded again on every request
+    for _ in range(2):
+        response = client.get("/api/v1/points/52.25,-1.75/areas?areatype=laua")
+        assert response.status_code == 503
+        assert "too big" in response.json()["detail"]
+        assert "retry-after" not in response.headers
+    assert len(s3.calls) == calls
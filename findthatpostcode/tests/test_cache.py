@@ -0,0 +1,244 @@
+import pytest
+
+from findthatpostcode.cache import (
+    MISSING,
+    AreaBoundaryIndexes,
+    AreaNameTable,
+    BoundariesUnavailable,
+    BoundaryCache,
+    LRUCache,
+)
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("findthatpostcode.cache.time.monotonic", lambda: now[0])
+    cache = LRUCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    now[0] += 59
+    assert cache.get("a") == 1
+    now[0] += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_counters():
+    cache = LRUCache(maxsize=10)
+    cache.set_many({"a": 1, "b": None})
+    found, missing = cache.get_many(["a", "b", "c"])
+    assert found == {"a": 1, "b": None}
+    assert missing == ["c"]
+    assert cache.get("d", "default") == "default"
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 2
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == 0
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(maxsize=0)
+    cache.set("a", 1)
+    assert "a" not in cache
+
+
+def test_area_name_table(monkeypatch):
+    hits = [
+        {
+            "_id": "W06000001",
+            "_source": {
+                "code": "W06000001",
+                "name": "Isle of Anglesey",
+                "name_welsh": "Ynys Môn",
+                "type": "laua",
+            },
+        },
+        {
+            "_id": "E92000001",
+            "_source": {"code": "E92000001", "name": "England", "type": "ctry"},
+        },
+        {"_id": "E00000001", "_source": {"code": "E00000001", "type": "oa11"}},
+    ]
+    monkeypatch.setattr("findthatpostcode.cache.scan", lambda *args, **kwargs: hits)
+
+    table = AreaNameTable()
+    assert not table.loaded
+    table.load(None)
+    assert table.loaded
+    assert len(table) == 3
+
+    assert table.get("E92000001") == ("England", None, "ctry")
+    assert table.get("W06000001") == ("Isle of Anglesey", "Ynys Môn", "laua")
+    assert table.get("X99999999") is None
+    assert table.get_names(["E92000001", "E00000001", "X99999999"]) == {
+        "E92000001": ("England", "ctry")
+    }
+
+    report = table.memory_report()
+    assert report["areas"] == 3
+    assert report["total_bytes"] > 0
+
+
+def test_lru_cache_max_bytes():
+    cache = LRUCache(maxsize=10, max_bytes=10)
+    cache.set("a", b"1234")
+    cache.set("b", b"5678")
+    cache.set("missing", None)
+    assert cache.bytes == 8
+    cache.set("c", b"90ab")
+    assert "a" not in cache
+    assert cache.bytes == 8
+    # values bigger than the limit aren't stored
+    cache.set("d", b"x" * 11)
+    assert "d" not in cache
+    assert "b" in cache
+
+
+def test_lru_cache_max_bytes_nbytes():
+    class Sized:
+        def __init__(self, nbytes):
+            self.nbytes = nbytes
+
+    cache = LRUCache(maxsize=10, max_bytes=10)
+    cache.set("a", Sized(6))
+    cache.set("b", Sized(6))
+    assert "a" not in cache
+    assert cache.bytes == 6
+
+
+def test_boundary_cache(tmp_path):
+    loads = []
+
+    def loader(value):
+        def load():
+            loads.append(value)
+            return value
+
+        return load
+
+    boundaries = BoundaryCache(
+        max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000
+    )
+    assert boundaries.get("E01000001", "v1", loader(b"{}")) == b"{}"
+    assert boundaries.get("E01000001", "v1", loader(b"other")) == b"{}"
+    assert boundaries.get("E01000002", "v1", loader(None)) is None
+    assert boundaries.get("E01000002", "v1", loader(b"other")) is None
+    assert loads == [b"{}", None]
+
+    # the disk copy is used once the memory cache is cleared
+    boundaries.memory.clear()
+    assert boundaries.get("E01000001", "v1", loader(b"other")) == b"{}"
+    assert loads == [b"{}", None]
+    assert (tmp_path / "v1" / "E01000001.json").exists()
+
+    # a new version is loaded again, and replaces the old files
+    assert boundaries.get("E01000001", "v2", loader(b"[]")) == b"[]"
+    assert not (tmp_path / "v1").exists()
+
+
+def test_boundary_cache_disk_eviction(tmp_path):
+    boundaries = BoundaryCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=25)
+    for i in range(5):
+        boundaries.get("E0100000{}".format(i), "v1", lambda: b"x" * 10)
+    files = list((tmp_path / "v1").iterdir())
+    assert sum(f.stat().st_size for f in files) <= 25
+    assert tmp_path / "v1" / "E01000004.json" in files
+
+
+def test_boundary_cache_peek(tmp_path):
+    boundaries = BoundaryCache(
+        max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000
+    )
+    assert boundaries.peek("E01000001", "v1") is MISSING
+    boundaries.get("E01000001", "v1", lambda: b"{}")
+    assert boundaries.peek("E01000001", "v1") == b"{}"
+    boundaries.memory.clear()
+    assert boundaries.peek("E01000001", "v1") == b"{}"
+
+
+def test_area_boundary_indexes():
+    loads = []
+
+    def load(value):
+        loads.append(value)
+        if value is None:
+            raise ValueError("Could not load")
+        return value
+
+    indexes = AreaBoundaryIndexes(maxsize=2)
+    # indexes are built in the background, and only queued once
+    assert indexes.get("a", lambda: load("index a")) is None
+    assert indexes.get("a", lambda: load("index a")) in (None, "index a")
+    indexes.wait()
+    assert indexes.get("a", lambda: load("other")) == "index a"
+    assert loads == ["index a"]
+
+    # indexes that fail to load are tried again
+    assert indexes.get("b", lambda: load(None)) is None
+    indexes.wait()
+    assert indexes.get("b", lambda: load("index b")) is None
+    indexes.wait()
+    assert indexes.get("b", lambda: load("other")) == "index b"
+
+    indexes.clear()
+    assert indexes.get("a", lambda: load("index a")) is None
+
+
+def test_area_boundary_indexes_retry_interval():
+    loads = []
+
+    def load():
+        loads.append(1)
+        raise ValueError("Could not load")
+
+    indexes = AreaBoundaryIndexes(maxsize=2, retry_interval=60)
+    assert indexes.get("a", load) is None
+    indexes.wait()
+
+    # an index that failed isn't built again until the interval has passed
+    with pytest.raises(BoundariesUnavailable) as e:
+        indexes.get("a", load)
+    assert 0 < e.value.retry_after <= 60
+    assert loads == [1]
+
+    # or one that was pushed out of the cache by others
+    for key in ["b", "c", "d"]:
+        indexes.get(key, lambda: key)
+        indexes.wait()
+    with pytest.raises(BoundariesUnavailable):
+        indexes.get("b", lambda: "b")
+
+    indexes.clear()
+    assert indexes.get("a", load) is None
+
+
+def test_area_boundary_indexes_too_big():
+    class Index:
+        nbytes = 20
+
+    loads = []
+
+    def load():
+        loads.append(1)
+        return Index()
+
+    indexes = AreaBoundaryIndexes(maxsize=2, max_bytes=10)
+    assert indexes.get("a", load) is None
+    indexes.wait()
+    for _ in range(2):
+        with pytest.raises(BoundariesUnavailable) as e:
+            indexes.get("a", load)
+        assert e.value.retry_after is None
+    assert loads == [1]
@@ -0,0 +1,243 @@
+import gzip
+import json
+import math
+
+import brotli
+import pytest
+from botocore.exceptions import ClientError
+from click.testing import CliRunner
+from shapely.errors import GEOSException
+
+from findthatpostcode import settings
+from findthatpostcode.commands import boundaries
+from findthatpostcode.commands.boundaries import db, import_boundaries
+from findthatpostcode.tests.fixtures import MockES
+
+
+class FakeS3:
+    def __init__(self, fail=None):
+        self.objects = {}
+        self.fail = fail or {}
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        if self.fail.get(key, 0) > 0:
+            self.fail[key] -= 1
+            raise ClientError({"Error": {"Code": "SlowDown"}}, "PutObject")
+        body = fileobj.read()
+        # compressed versions are kept as they are
+        self.objects[key] = json.loads(body) if key.endswith(".json") else body
+
+
+def write_boundaries(path, codes):
+    features = [
+        {
+            "type": "Feature",
+            "properties": {"lad23cd": code, "lad23nm": "Area {}".format(code)},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]],
+            },
+        }
+        for code in codes
+    ]
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = FakeS3()
+    monkeypatch.setattr(db, "get_s3_client", lambda: client)
+    monkeypatch.setattr(db, "get_db", lambda: MockES())
+    monkeypatch.setattr(settings, "BOUNDARY_UPLOAD_BACKOFF", 0)
+    return client
+
+
+def test_import_boundaries(s3, tmp_path):
+    codes = ["E0700{:04d}".format(i) for i in range(50)]
+    write_boundaries(tmp_path / "lad_1.geojson", codes[0:30])
+    write_boundaries(tmp_path / "lad_2.geojson", codes[30:])
+    s3.fail = {"E07/E07000003.json": 2}
+
+    result = CliRunner().invoke(
+        import_boundaries,
+        [str(tmp_path / "*.geojson"), "--concurrency", "4"],
+        catch_exceptions=False,
+    )
+
+    assert result.exit_code == 0
+    assert set(s3.objects.keys()) == {
+        "E07/{}{}.json{}".format(c, r, e)
+        for c in codes
+        for r in ["", ".high", ".medium", ".low"]
+        for e in ["", ".br", ".gz"]
+    }
+    assert s3.objects["E07/E07000003.json"]["properties"]["lad23nm"] == (
+        "Area E07000003"
+    )
+    assert "2 files, 50 boundaries uploaded, 0 failed" in result.output
+
+
+def test_import_boundaries_upload_fails(s3, tmp_path):
+    write_boundaries(tmp_path / "lad.geojson", ["E07000001", "E07000002"])
+    s3.fail = {"E07/E07000001.json": settings.BOUNDARY_UPLOAD_RETRIES + 1}
+
+    summary = boundaries.import_boundary(s3, str(tmp_path / "lad.geojson"))
+
+    assert summary["uploaded"] == 1
+    assert summary["failed"] == 1
+    assert [k for k in s3.objects.keys() if k.startswith("E07/E07000001")] == []
+
+
+def test_import_boundaries_workers(s3, tmp_path):
+    for i in range(3):
+        write_boundaries(
+            tmp_path / "lad_{}.geojson".format(i),
+            ["E0700{:04d}".format(i * 10 + j) for j in range(10)],
+        )
+
+    result = CliRunner().invoke(
+        import_boundaries,
+        [str(tmp_path / "*.geojson"), "--workers", "2"],
+        catch_exceptions=False,
+    )
+
+    # uploads happen in the worker processes, so only the summary is checked
+    assert result.exit_code == 0
+    assert "3 files, 30 boundaries uploaded, 0 failed" in result.output
+
+
+def test_iter_features(tmp_path):
+    path = tmp_path / "lad.geojson"
+    path.write_bytes(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {"type": "Feature", "properties": {"lad23nm": "Ynys Môn"}},
+                ],
+            },
+            ensure_ascii=False,
+        ).encode("latin1")
+    )
+
+    features = list(boundaries.iter_features(str(path), encoding="latin1"))
+
+    assert features == [{"type": "Feature", "properties": {"lad23nm": "Ynys Môn"}}]
+
+
+def test_import_boundary_url(s3, tmp_path, requests_mock):
+    url = "https://example.com/lad.geojson"
+    write_boundaries(tmp_path / "lad.geojson", ["E07000001", "E07000002"])
+    collection = json.loads((tmp_path / "lad.geojson").read_text())
+    # an invalid feature is skipped, and the code field comes from the first
+    collection["features"].insert(1, {"type": "Feature", "geometry": None})
+    collection["features"][2]["properties"]["extra_cd"] = "X"
+    requests_mock.get(url, json=collection)
+
+    summary = boundaries.import_boundary(s3, url)
+
+    assert summary["uploaded"] == 2
+    assert s3.objects["E07/E07000001.json"]["geometry"]["coordinates"][0][2] == [1, 1]
+    assert {k.split(".")[0] for k in s3.objects.keys()} == {
+        "E07/E07000001",
+        "E07/E07000002",
+    }
+
+
+def test_boundary_objects():
+    # a circle with a point for every 1/1000th of a turn
+    points = [
+        [
+            round(-1.5 + 0.1 * math.cos(i * math.pi / 500), 8),
+            round(52 + 0.1 * math.sin(i * math.pi / 500), 8),
+        ]
+        for i in range(1000)
+    ]
+    feature = {
+        "type": "Feature",
+        "properties": {"lad23cd": "E07000001"},
+        "geometry": {"type": "Polygon", "coordinates": [points + [points[0]]]},
+    }
+
+    objects = dict(boundaries.boundary_objects("E07000001", feature, compress=False))
+
+    assert list(objects.keys()) == [
+        "E07/E07000001.json",
+        "E07/E07000001.high.json",
+        "E07/E07000001.medium.json",
+        "E07/E07000001.low.json",
+    ]
+    assert json.loads(objects["E07/E07000001.json"]) == feature
+    sizes = [len(body) for body in objects.values()]
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[-1] < sizes[0] / 10
+    low = json.loads(objects["E07/E07000001.low.json"])
+    assert low["properties"] == feature["properties"]
+    assert low["geometry"]["type"] == "Polygon"
+    ring = low["geometry"]["coordinates"][0]
+    assert ring[0] == ring[-1]
+    assert all(round(c, 3) == c for point in ring for c in point)
+
+    # without simplifying only the original is stored
+    assert len(list(boundaries.boundary_objects("E07000001", feature, False))) == 3
+
+
+def test_boundary_objects_invalid():
+    # a self-intersecting "bowtie" polygon is made valid before simplifying
+    feature = {
+        "type": "Feature",
+        "properties": {"lad23cd": "E07000001"},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]],
+        },
+    }
+
+    objects = dict(boundaries.boundary_objects("E07000001", feature, compress=False))
+
+    assert len(objects) == 4
+    low = json.loads(objects["E07/E07000001.low.json"])
+    assert low["geometry"]["type"] == "MultiPolygon"
+
+
+def test_upload_boundaries_simplify_fails(s3, monkeypatch):
+    def fail(geometry, tolerance, precision):
+        raise GEOSException("TopologyException: side location conflict")
+
+    monkeypatch.setattr(boundaries, "simplify_geometry", fail)
+    feature = {
+        "type": "Feature",
+        "properties": {},
+        "geometry": {"type": "Point", "coordinates": [-1.5, 52.0]},
+    }
+
+    summary = boundaries.upload_boundaries(
+        s3, [("E07000001", feature), ("E07000002", feature)], concurrency=1
+    )
+
+    # the full boundaries are still uploaded, and the import carries on
+    assert summary["failed"] == 2
+    assert "E07/E07000001.json" in s3.objects
+    assert "E07/E07000002.json.br" in s3.objects
+    assert "E07/E07000002.low.json" not in s3.objects
+
+
+def test_boundary_objects_compressed():
+    feature = {
+        "type": "Feature",
+        "properties": {"lad23cd": "E07000001"},
+        "geometry": {"type": "Point", "coordinates": [-1.5, 52.0]},
+    }
+
+    objects = dict(boundaries.boundary_objects("E07000001", feature, simplify=False))
+
+    assert list(objects.keys()) == [
+        "E07/E07000001.json",
+        "E07/E07000001.json.br",
+        "E07/E07000001.json.gz",
+    ]
+    body = objects["E07/E07000001.json"]
+    assert brotli.decompress(objects["E07/E07000001.json.br"]) == body
+    assert gzip.decompress(objects["E07/E07000001.json.gz"]) == body
+    # the same boundary always gives the same compressed bytes
+    assert dict(boundaries.boundary_objects("E07000001", feature, False)) == objects
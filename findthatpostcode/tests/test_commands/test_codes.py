@@ -26,3 +26,11 @@ def test_import_codes(function, args, mock_files):
 
     result = runner.invoke(function, args)
     assert result.exit_code == 0
+
+
+def test_import_chd_new_index_es_index():
+    result = CliRunner().invoke(
+        import_chd, ["--new-index", "--es-index", "other", "--file", "missing.zip"]
+    )
+    assert result.exit_code == 2
+    assert "--es-index can't be used with --new-index" in result.output
@@ -1,17 +1,27 @@
+import csv
+import datetime
+import io
+import zipfile
+
 import pytest
 from click.testing import CliRunner
 
 import findthatpostcode.utils
+from findthatpostcode import settings
 from findthatpostcode.commands.postcodes import (
     Postcode,
+    PostcodeSource,
     db,
     import_nhspd,
     import_nspl,
     import_onspd,
     import_pcon,
+    import_postcodes,
+    merge_postcode_records,
+    postcode_records,
 )
 from findthatpostcode.settings import NHSPD_URL, NSPL_URL, ONSPD_URL, PCON_URL
-from findthatpostcode.tests.fixtures import MOCK_FILES, MockES, mock_bulk
+from findthatpostcode.tests.fixtures import MOCK_FILES, MockES, mock_streaming_bulk
 
 files = [
     ("nspl", NSPL_URL, import_nspl),
@@ -26,6 +36,12 @@ for f in files:
     parameters.append(tuple([*f, ["--file", MOCK_FILES[url]]]))
     parameters.append(tuple([*f, []]))
     parameters.append(tuple([*f, ["--url", url]]))
+parameters.append(
+    ("nspl", NSPL_URL, import_nspl, ["--file", MOCK_FILES[NSPL_URL], "--workers", "2"])
+)
+parameters.append(
+    ("nspl", NSPL_URL, import_nspl, ["--url", NSPL_URL, "--workers", "2"])
+)
 
 
 @pytest.mark.parametrize("filetype, url, command, args", parameters)
@@ -37,9 +53,175 @@ def test_import_postcode(filetype, url, command, args, requests_mock, monkeypatc
         requests_mock.get(url, content=f.read())
     monkeypatch.setattr(db, "get_db", lambda: MockES())
     monkeypatch.setattr(Postcode, "init", lambda *args, **kwargs: None)
-    monkeypatch.setattr(findthatpostcode.utils, "bulk", mock_bulk)
+    monkeypatch.setattr(findthatpostcode.utils, "streaming_bulk", mock_streaming_bulk)
 
     runner = CliRunner()
 
     result = runner.invoke(command, args, catch_exceptions=False)
     assert result.exit_code == 0
+
+
+def test_postcode_records_ids():
+    # the PCON file formats postcodes differently, but gets the same ids
+    pcon = io.BytesIO(b"pcd,pconcd\nCV213DN,E14000001\nAB1  0AB,S14000001\n")
+    nspl = io.BytesIO(b"pcds,laua\nCV21 3DN,E07000220\n")
+
+    assert [id_ for id_, _ in postcode_records(pcon, PostcodeSource.PCON)] == [
+        "CV21 3DN",
+        "AB1 0AB",
+    ]
+    assert [id_ for id_, _ in postcode_records(nspl, PostcodeSource.NSPL)] == [
+        "CV21 3DN"
+    ]
+
+
+def test_merge_postcode_records(tmp_path):
+    nspl = io.BytesIO(
+        b"pcds,laua,dointr\nAB1 0AA,S12000033,198001\nAB1 0AB,S12000033,198001\n"
+    )
+    pcon = io.BytesIO(b"pcd,pconcd\nAB1  0AB,S14000001\nAB1 0AD,S14000002\n")
+
+    merged = list(
+        merge_postcode_records(
+            [
+                (PostcodeSource.NSPL, postcode_records(nspl, PostcodeSource.NSPL)),
+                (PostcodeSource.PCON, postcode_records(pcon, PostcodeSource.PCON)),
+            ],
+            str(tmp_path / "postcodes.sqlite"),
+        )
+    )
+
+    assert [pcds for pcds, _ in merged] == ["AB1 0AA", "AB1 0AB", "AB1 0AD"]
+    assert list(merged[0][1].keys()) == ["nspl"]
+    assert list(merged[1][1].keys()) == ["nspl", "pcon"]
+    assert merged[1][1]["nspl"]["dointr"] == datetime.datetime(1980, 1, 1)
+    assert merged[1][1]["pcon"]["pcon25"] == "S14000001"
+    assert list(merged[2][1].keys()) == ["pcon"]
+
+
+@pytest.mark.parametrize("new_index", [False, True])
+def test_import_postcodes_merged(new_index, bulk_actions, monkeypatch):
+    monkeypatch.setattr(db, "get_db", lambda: MockES())
+    monkeypatch.setattr(db, "create_versioned_index", lambda *args: "postcode_v")
+    monkeypatch.setattr(db, "promote_index", lambda *args, **kwargs: None)
+    monkeypatch.setattr(Postcode, "init", lambda *args, **kwargs: None)
+
+    args = ["--source", "nspl", "--source", "nhspd"]
+    args += ["--file", "nspl=" + MOCK_FILES[NSPL_URL]]
+    args += ["--file", "nhspd=" + MOCK_FILES[NHSPD_URL]]
+    if new_index:
+        args.append("--new-index")
+
+    result = CliRunner().invoke(import_postcodes, args, catch_exceptions=False)
+    assert result.exit_code == 0
+
+    ids = [a["_id"] for a in bulk_actions]
+    assert len(ids) == len(set(ids))
+    docs = [a["_source"] if new_index else a["doc"] for a in bulk_actions]
+    assert all(set(doc.keys()) <= {"nspl", "nhspd"} for doc in docs)
+    assert any(set(doc.keys()) == {"nspl", "nhspd"} for doc in docs)
+    op_types = {a["_op_type"] for a in bulk_actions}
+    assert op_types == {"index" if new_index else "update"}
+
+
+def test_import_postcodes_bad_file():
+    result = CliRunner().invoke(
+        import_postcodes, ["--source", "nspl", "--file", "nhspd=nhspd.zip"]
+    )
+    assert result.exit_code == 2
+
+
+def test_import_postcode_unchanged(bulk_actions, monkeypatch):
+    actions = bulk_actions
+    es = MockES()
+    monkeypatch.setattr(db, "get_db", lambda: es)
+    monkeypatch.setattr(Postcode, "init", lambda *args, **kwargs: None)
+    args = ["--file", MOCK_FILES[NHSPD_URL]]
+
+    runner = CliRunner()
+    assert runner.invoke(import_nhspd, args).exit_code == 0
+    imported = len(actions)
+    assert imported > 0
+
+    # the same file again is skipped, unless forced
+    result = runner.invoke(import_nhspd, args)
+    assert result.exit_code == 0
+    assert "unchanged" in result.output
+    assert len(actions) == imported
+
+    assert runner.invoke(import_nhspd, args + ["--force"]).exit_code == 0
+    assert len(actions) == imported * 2
+
+
+def test_import_postcode_incremental(tmp_path, bulk_actions, monkeypatch):
+    actions = bulk_actions
+    es = MockES()
+    monkeypatch.setattr(db, "get_db", lambda: es)
+    monkeypatch.setattr(Postcode, "init", lambda *args, **kwargs: None)
+
+    # a new release with one postcode changed and one file of postcodes gone
+    new_release = tmp_path / "nhspd_new.zip"
+    postcodes = {}
+    with zipfile.ZipFile(MOCK_FILES[NHSPD_URL]) as z, zipfile.ZipFile(
+        new_release, "w"
+    ) as new_z:
+        for f in z.namelist():
+            content = z.read(f)
+            if f.startswith("Data/"):
+                postcodes[f] = {
+                    row[1] for row in csv.reader(io.StringIO(content.decode())) if row
+                }
+            if f == "Data/feb24wsn.csv":
+                continue
+            if f == "Data/feb24oth.csv":
+                content = content.replace(b'"200501","200502"', b'"200501","200601"', 1)
+            new_z.writestr(f, content)
+    removed = postcodes.pop("Data/feb24wsn.csv").difference(*postcodes.values())
+
+    runner = CliRunner()
+    args = ["--incremental", "--file", MOCK_FILES[NHSPD_URL]]
+    result = runner.invoke(import_nhspd, args, catch_exceptions=False)
+    assert "0 changed, 0 removed, 0 unchanged" in result.output
+    total = len(actions)
+
+    # nothing is sent if nothing has changed
+    actions.clear()
+    result = runner.invoke(import_nhspd, args + ["--force"], catch_exceptions=False)
+    assert actions == []
+    assert "0 added, 0 changed, 0 removed, {:,.0f} unchanged".format(total) in (
+        result.output
+    )
+
+    actions.clear()
+    result = runner.invoke(import_nhspd, ["--incremental", "--file", str(new_release)])
+    assert result.exit_code == 0
+    assert [a["_id"] for a in actions if a.get("doc")] == ["AL1 9ZA"]
+    assert {a["_id"] for a in actions if a.get("script")} == removed
+    assert "0 added, 1 changed, {:,.0f} removed".format(len(removed)) in (result.output)
+
+    # once the alias points at another index the fingerprints aren't trusted
+    es.indices.aliases[settings.ES_INDICES["postcode"]] = "geo_postcode_2024_03"
+    actions.clear()
+    args = ["--incremental", "--force", "--file", str(new_release)]
+    result = runner.invoke(import_nhspd, args, catch_exceptions=False)
+    assert "No fingerprints for the current data" in result.output
+    assert "0 changed, 0 removed, 0 unchanged" in result.output
+    assert len(actions) > 1
+
+
+def test_import_postcode_incremental_new_index():
+    result = CliRunner().invoke(import_nspl, ["--incremental", "--new-index"])
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize(
+    "command,args",
+    [
+        (import_nspl, []),
+        (import_postcodes, ["--source", "nspl"]),
+    ],
+)
+def test_import_postcode_new_index_es_index(command, args):
+    result = CliRunner().invoke(command, args + ["--new-index", "--es-index", "other"])
+    assert result.exit_code == 2
+    assert "--es-index can't be used with --new-index" in result.output
@@ -0,0 +1,212 @@
+import csv
+import io
+import math
+
+import pytest
+
+from benchmarks.stubs import LAUA_COUNT, stub_postcodes
+from findthatpostcode import cache, crud, settings
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.area_names.clear()
+    yield
+    cache.area_names.clear()
+
+
+@pytest.mark.parametrize("n", [1, 10, 100, 1000])
+def test_get_postcodes_round_trips(n):
+    db = stub_postcodes(n)
+    postcodes = list(db.documents[settings.ES_INDICES["postcode"]].keys())
+
+    results = crud.get_postcodes(db, postcodes)
+
+    assert len(results) == n
+    assert results[0].laua_name == "Local authority 0"
+    assert results[-1].ctry_name == "England"
+    assert db.count_calls("mget", settings.ES_INDICES["postcode"]) == 1
+    assert db.count_calls("mget", settings.ES_INDICES["area"]) == 1
+
+
+def test_get_postcodes_repeated():
+    db = stub_postcodes(10)
+
+    results = crud.get_postcodes(db, ["AB10 0CD", "ZZ99 9ZZ", "ab100cd", "AB10 0CD"])
+
+    # one result for each postcode asked for, in the same order
+    assert [r.pcds for r in results] == ["AB10 0CD", "ZZ99 9ZZ", "AB10 0CD", "AB10 0CD"]
+    assert results[3].laua == "E07000000"
+    assert db.calls[0] == ("mget", settings.ES_INDICES["postcode"], 2)
+
+
+def test_get_area_names_chunked(monkeypatch):
+    monkeypatch.setattr(settings, "AREA_NAMES_CHUNK_SIZE", 10)
+    db = stub_postcodes(LAUA_COUNT)
+    area_codes = list(db.documents[settings.ES_INDICES["area"]].keys())
+
+    names = crud.get_area_names(db, area_codes + area_codes)
+
+    assert len(names) == len(area_codes)
+    assert names["E92000001"] == ("England", "ctry")
+    assert db.count_calls("mget", settings.ES_INDICES["area"]) == math.ceil(
+        len(area_codes) / 10
+    )
+
+
+def test_get_area_names_empty():
+    db = stub_postcodes(0)
+    assert crud.get_area_names(db, []) == {}
+    assert db.count_calls("mget") == 0
+
+
+def test_get_area_names_cached():
+    db = stub_postcodes(LAUA_COUNT)
+    area_codes = ["E92000001", "E07000000", "E99999999"]
+
+    assert crud.get_area_names(db, area_codes) == {
+        "E92000001": ("England", "ctry"),
+        "E07000000": ("Local authority 0", "laua"),
+    }
+    assert db.count_calls("mget") == 1
+
+    # second lookup is served from the cache, including the unknown code
+    assert len(crud.get_area_names(db, area_codes)) == 2
+    assert db.count_calls("mget") == 1
+    assert cache.area_names.hits == 3
+
+    # only uncached codes are requested
+    crud.get_area_names(db, area_codes + ["E07000001"])
+    assert db.calls[-1] == ("mget", settings.ES_INDICES["area"], 1)
+
+
+def test_hash_query():
+    query = crud.hash_query(["abc", "ABCD", "abce", "abcdef"]).to_dict()
+    assert query["bool"]["should"] == [
+        {"terms": {"hash3": ["abc"]}},
+        {"terms": {"hash4": ["abcd", "abce"]}},
+        {"prefix": {"hash": "abcdef"}},
+    ]
+    with pytest.raises(ValueError):
+        crud.hash_query(["ab"])
+
+
+def test_get_postcode_by_hash_pages(monkeypatch):
+    monkeypatch.setattr(settings, "HASH_LOOKUP_PAGE_SIZE", 10)
+    db = stub_postcodes(1000)
+    postcodes = db.documents[settings.ES_INDICES["postcode"]]
+    hashes = [p["hash4"] for p in postcodes.values()][0:500]
+    expected = {pcds for pcds, p in postcodes.items() if p["hash4"] in set(hashes)}
+
+    results = list(crud.get_postcode_by_hash(db, hashes, fields=["laua_name"]))
+
+    assert {r.pcds for r in results} == expected
+    assert len(results) == len(expected)
+    assert results[0].laua_name.startswith("Local authority")
+    assert db.count_calls("search") == len(expected) // 10 + 1
+
+
+def test_get_postcode_by_hash_limits(monkeypatch):
+    monkeypatch.setattr(settings, "HASH_LOOKUP_PAGE_SIZE", 10)
+    monkeypatch.setattr(settings, "HASH_LOOKUP_MAX_HASHES", 50)
+    monkeypatch.setattr(settings, "HASH_LOOKUP_MAX_RESULTS", 25)
+    db = stub_postcodes(100)
+    postcodes = db.documents[settings.ES_INDICES["postcode"]]
+    hashes = [p["hash4"] for p in postcodes.values()]
+
+    with pytest.raises(ValueError, match="No more than 50 hashes"):
+        list(crud.get_postcode_by_hash(db, hashes[0:51]))
+    with pytest.raises(ValueError, match="More than 25 postcodes"):
+        list(crud.get_postcode_by_hash(db, hashes[0:50]))
+    # pages stop at the limit rather than fetching every match
+    sizes = [c[2]["size"] for c in db.calls if c[0] == "search"]
+    assert sizes == [10, 10, 6]
+    assert len(list(crud.get_postcode_by_hash(db, hashes[0:25]))) == 25
+
+
+def test_expand_upload_fields():
+    assert crud.expand_upload_fields(["latlng", "laua", "lep_name", "lat"]) == [
+        "lat",
+        "long",
+        "laua",
+        "lep1_name",
+        "lep2_name",
+    ]
+
+
+def test_add_fields_to_csv():
+    db = stub_postcodes(10)
+    db.documents[settings.ES_INDICES["postcode"]]["AB10 1CD"]["lsoa11"] = "E01000001"
+    db.documents[settings.ES_INDICES["area"]]["E01000001"] = {
+        "code": "E01000001",
+        "stats": {"imd2019": {"imd_rank": 1234, "imd_decile": 1}},
+    }
+    infile = io.StringIO("id,postcode\n1,AB10 0CD\n2,ab101cd\n3,\n4,ZZ99 9ZZ\n")
+
+    output = "".join(
+        crud.add_fields_to_csv(
+            db,
+            csv.DictReader(infile),
+            "postcode",
+            ["laua", "laua_name", "imd2019_rank"],
+            chunk_size=3,
+        )
+    )
+
+    rows = list(csv.DictReader(io.StringIO(output)))
+    assert list(rows[0].keys()) == [
+        "id",
+        "postcode",
+        "laua",
+        "laua_name",
+        "imd2019_rank",
+    ]
+    assert [r["id"] for r in rows] == ["1", "2", "3", "4"]
+    assert rows[0]["laua_name"] == "Local authority 0"
+    assert rows[0]["imd2019_rank"] == ""
+    assert rows[1]["laua"] == "E07000001"
+    assert rows[1]["imd2019_rank"] == "1234"
+    assert rows[2]["laua"] == ""
+    assert rows[3]["laua"] == ""
+    # two chunks of postcodes
+    assert db.count_calls("mget", settings.ES_INDICES["postcode"]) == 2
+
+
+def test_area_postcode_fields():
+    assert crud.area_postcode_fields("E07000001") == ["laua"]
+    assert crud.area_postcode_fields("E01000001") == ["lsoa11", "lsoa21"]
+    assert crud.area_postcode_fields("E37000001") == ["lep1", "lep2"]
+    assert crud.area_postcode_fields("X99999999") == []
+
+
+def test_iter_area_postcodes():
+    db = stub_postcodes(1000)
+
+    chunks = list(
+        crud.iter_area_postcodes(db, "E07000003", fields=["laua_name"], page_size=15)
+    )
+
+    assert [len(c) for c in chunks] == [15, 15, 10]
+    postcodes = [p.pcds for c in chunks for p in c]
+    assert postcodes == sorted(postcodes)
+    assert len(set(postcodes)) == 1000 / LAUA_COUNT
+    assert chunks[0][0].laua_name == "Local authority 3"
+    assert db.count_calls("search") == 3
+    assert db.count_calls("POST") == db.count_calls("DELETE") == 1
+    assert not db.transport.open_pits
+
+
+def test_get_area_type_status(monkeypatch):
+    monkeypatch.setattr(settings, "AREA_NAMES_PRELOAD_PAGE_SIZE", 10)
+    db = stub_postcodes(0)
+    db.documents[settings.ES_INDICES["area"]]["E07000003"]["active"] = False
+
+    status = crud.get_area_type_status(db, "laua")
+
+    assert len(status) == LAUA_COUNT
+    assert status["E07000001"]
+    assert not status["E07000003"]
+    assert "E92000001" not in status
+    assert db.count_calls("search", settings.ES_INDICES["area"]) == math.ceil(
+        (LAUA_COUNT + 1) / 10
+    )
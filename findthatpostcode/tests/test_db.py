@@ -0,0 +1,77 @@
+from benchmarks.stubs import StubES
+from findthatpostcode import db, settings
+from findthatpostcode.documents import Postcode, Release
+
+
+def test_get_db_shared():
+    db.close_db()
+    es = db.get_db()
+    assert db.get_db() is es
+    assert es.transport.kwargs["timeout"] == settings.ES_TIMEOUT
+    db.close_db()
+    assert db.get_db() is not es
+    db.close_db()
+
+
+def test_get_s3_client_shared():
+    db.close_s3_client()
+    client = db.get_s3_client()
+    assert db.get_s3_client() is client
+    db.close_s3_client()
+    assert db.get_s3_client() is not client
+    db.close_s3_client()
+
+
+def test_versioned_index():
+    es = StubES({settings.ES_INDICES["postcode"]: {}})
+    alias = settings.ES_INDICES["postcode"]
+
+    first = db.create_versioned_index(es, Postcode, version="2024_01")
+    assert first == alias + "_2024_01"
+    assert es.indices.settings[first]["number_of_replicas"] == 0
+    assert es.indices.settings[first]["refresh_interval"] == "-1"
+
+    # the concrete index from before versioning is swapped out for the alias
+    db.promote_index(es, Postcode, first)
+    assert db.resolve_index(es, alias) == [first]
+    assert alias not in es.documents
+    assert es.indices.settings[first]["refresh_interval"] is None
+    assert es.indices.settings[first]["number_of_replicas"] == settings.ES_REPLICAS
+    assert es.count_calls("indices.forcemerge", first) == 1
+
+    second = db.create_versioned_index(es, Postcode, version="2024_02")
+    db.promote_index(es, Postcode, second)
+    third = db.create_versioned_index(es, Postcode, version="2024_03")
+    db.promote_index(es, Postcode, third, keep=1)
+
+    # the alias is moved in a single request
+    alias_calls = [c for c in es.calls if c[0] == "indices.update_aliases"]
+    assert alias_calls[-1][2]["actions"] == [
+        {"remove": {"index": second, "alias": alias}},
+        {"add": {"index": third, "alias": alias}},
+    ]
+    assert db.resolve_index(es, alias) == [third]
+    assert db.index_versions(es, alias) == [second, third]
+
+
+def test_versioned_document_matches():
+    alias = settings.ES_INDICES["postcode"]
+    assert Postcode._matches({"_index": alias})
+    assert Postcode._matches({"_index": alias + "_2024_01"})
+    assert not Postcode._matches({"_index": settings.ES_INDICES["area"]})
+
+
+def test_promote_index_clears_releases():
+    alias = settings.ES_INDICES["postcode"]
+    es = StubES({alias: {}})
+    Release.record(es, "nspl", "2024_01", index=alias)
+    Release.record(es, "pcon", "2024_01", index=alias)
+    Release.record(es, "chd", "2024_01", index=settings.ES_INDICES["area"])
+
+    new = db.create_versioned_index(es, Postcode, version="2024_02")
+    db.promote_index(es, Postcode, new)
+
+    # the postcode sources will need importing into the new index again
+    assert Release.latest(es, "nspl") is None
+    assert Release.latest(es, "pcon") is None
+    assert Release.latest(es, "chd") is not None
@@ -2,6 +2,7 @@ from typing import Tuple
 
 import pytest
 
+from findthatpostcode.documents.postcode import Postcode, PostcodeConverter
 from findthatpostcode.utils import PostcodeStr
 
 
@@ -52,3 +53,49 @@ def test_split_postcode(value: str, expected: Tuple[str, str, str]):
     assert postcode_value.postcode_area == expected[0]
     assert postcode_value.postcode_district == expected[1]
     assert postcode_value.postcode_sector == expected[2]
+
+
+HEADER = [
+    "pcd",
+    "pcds",
+    "dointr",
+    "doterm",
+    "usertype",
+    "osgrdind",
+    "laua",
+    "lat",
+    "long",
+]
+
+
+@pytest.mark.parametrize(
+    "row",
+    [
+        [
+            "AB1 0AA",
+            "AB1 0AA",
+            "198001",
+            "199606",
+            "0",
+            "1",
+            "S12000033",
+            "57.1",
+            "-2.2",
+        ],
+        ["AB1 0AB", "AB1 0AB", "198001", "", "1", "9", "S99999999", "99.999999", "0"],
+        ["AB101AB", "ab10 1ab", "202001", "", " ", "", "", "", ""],
+        ["AB1 0AD", "AB1 OAD", "", "", "0", "1", "S12000033", "57.1", "0.0"],
+    ],
+)
+def test_postcode_converter(row):
+    expected = Postcode.from_csv(dict(zip(HEADER, row))).to_dict()
+    assert PostcodeConverter(HEADER)(row) == expected
+
+
+def test_postcode_converter_columns():
+    header = ["pcd", "pconcd", "pconnm"]
+    row = ["CV213DN", "E14001453", "Rugby"]
+    expected = Postcode.from_csv({"pcds": row[0], "pcon25": row[1]}).to_dict()
+    converter = PostcodeConverter(header, columns={"pcd": "pcds", "pconcd": "pcon25"})
+    assert converter(row) == expected
+    assert expected["pcds"] == "CV21 3DN"
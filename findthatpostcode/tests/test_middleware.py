@@ -0,0 +1,99 @@
+import pytest
+
+from benchmarks.stubs import stub_postcodes
+from findthatpostcode import cache, settings
+from findthatpostcode.db import get_db
+from findthatpostcode.documents import Release
+from findthatpostcode.main import app
+from findthatpostcode.middleware import app_version, etag_matches
+from findthatpostcode.tests.fixtures import client
+
+POSTCODE_URL = "/api/v1/postcodes/AB10%200CD.json"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = stub_postcodes(10)
+    Release.record(db, "nspl", "abc123")
+    Release.record(db, "chd", "def456")
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    cache.release.clear()
+    yield db
+    cache.release.clear()
+
+
+def test_etag_headers(db):
+    response = client.get(POSTCODE_URL)
+    assert response.status_code == 200
+    assert response.headers["etag"] == 'W/"{}-{}"'.format(
+        cache.release.etag, app_version()
+    )
+    assert (
+        "max-age={}".format(settings.HTTP_CACHE_MAX_AGE)
+        in (response.headers["cache-control"])
+    )
+    assert "stale-while-revalidate" in response.headers["cache-control"]
+    assert response.headers["last-modified"].endswith("GMT")
+
+    # html pages get the same headers
+    assert client.get("/").headers["etag"] == response.headers["etag"]
+
+
+def test_not_modified(db):
+    etag = client.get(POSTCODE_URL).headers["etag"]
+    calls = len(db.calls)
+
+    response = client.get(POSTCODE_URL, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+    assert len(db.calls) == calls
+
+
+def test_not_modified_missing(db):
+    response = client.get("/api/v1/missing", headers={"If-None-Match": "*"})
+    assert response.status_code == 404
+
+
+def test_app_version_changes(db, monkeypatch):
+    etag = client.get(POSTCODE_URL).headers["etag"]
+
+    monkeypatch.setattr(settings, "APP_VERSION", "v2")
+    app_version.cache_clear()
+    try:
+        response = client.get(POSTCODE_URL, headers={"If-None-Match": etag})
+    finally:
+        app_version.cache_clear()
+    assert response.status_code == 200
+    assert response.headers["etag"].endswith('-v2"')
+
+
+def test_release_changes(db):
+    etag = client.get(POSTCODE_URL).headers["etag"]
+    cache.area_names.set("W92000004", ("Wales", "ctry"))
+
+    Release.record(db, "nspl", "ghi789")
+    cache.release.checked_at = None
+    response = client.get(POSTCODE_URL, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert "W92000004" not in cache.area_names
+
+
+def test_no_release(monkeypatch):
+    db = stub_postcodes(10)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+    cache.release.clear()
+    response = client.get(POSTCODE_URL)
+    cache.release.clear()
+    assert response.status_code == 200
+    assert "etag" not in response.headers
+
+
+def test_etag_matches():
+    assert etag_matches('W/"abc"', 'W/"abc"')
+    assert etag_matches('"abc"', 'W/"abc"')
+    assert etag_matches('"xyz", W/"abc"', 'W/"abc"')
+    assert not etag_matches("*", 'W/"abc"')
+    assert not etag_matches('"xyz"', 'W/"abc"')
+    assert not etag_matches(None, 'W/"abc"')
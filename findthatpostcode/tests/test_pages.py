@@ -96,6 +96,8 @@ def test_addtocsv():
         "think carefully before using this tool with any personal or sensitive data."
         in response.text
     )
+    assert "Key areas" in response.text
+    assert 'name="fields" value="laua"' in response.text
 
 
 def test_combine_geojson():
@@ -0,0 +1,105 @@
+import json
+import math
+
+import mapbox_vector_tile
+import pytest
+from shapely.geometry import box, mapping
+
+from findthatpostcode import spatial
+
+
+def square(code, west, south, size=0.5):
+    return (
+        code,
+        json.dumps(
+            {
+                "type": "Feature",
+                "properties": {"lad23cd": code, "lad23nm": "Area {}".format(code)},
+                "geometry": mapping(box(west, south, west + size, south + size)),
+            }
+        ).encode(),
+    )
+
+
+@pytest.fixture
+def boundaries():
+    return spatial.AreaBoundaries.from_geojson(
+        [
+            square("E07000001", -2.0, 52.0),
+            square("E07000002", -1.5, 52.0),
+            square("E07000003", 10.0, 10.0),
+            ("E07000004", json.dumps({"type": "Feature", "geometry": None}).encode()),
+        ]
+    )
+
+
+def test_tile_bounds():
+    assert spatial.tile_bounds(0, 0, 0) == pytest.approx(
+        (-180, -spatial.MERCATOR_MAX_LAT, 180, spatial.MERCATOR_MAX_LAT)
+    )
+    west, south, east, north = spatial.tile_bounds(1, 1, 0)
+    assert (west, south, east) == pytest.approx((0, 0, 180))
+
+    x, y = spatial.to_mercator(box(0, 0, 180, spatial.MERCATOR_MAX_LAT)).bounds[2:]
+    assert x == pytest.approx(math.pi * spatial.EARTH_RADIUS)
+    assert y == pytest.approx(math.pi * spatial.EARTH_RADIUS)
+
+
+def test_tile_is_valid():
+    assert spatial.tile_is_valid(0, 0, 0, 16)
+    assert spatial.tile_is_valid(2, 3, 3, 16)
+    assert not spatial.tile_is_valid(2, 4, 0, 16)
+    assert not spatial.tile_is_valid(17, 0, 0, 16)
+    assert not spatial.tile_is_valid(-1, 0, 0, 16)
+    assert spatial.tile_is_valid(12, 0, 0, 16, min_zoom=12)
+    assert not spatial.tile_is_valid(11, 0, 0, 16, min_zoom=12)
+
+
+def test_area_boundaries(boundaries):
+    assert len(boundaries) == 3
+    assert boundaries.codes == ["E07000001", "E07000002", "E07000003"]
+    assert boundaries.names[0] == "Area E07000001"
+    # three squares of five coordinates each
+    assert boundaries.nbytes == (15 * spatial.COORDINATE_BYTES + 3 * spatial.AREA_BYTES)
+
+
+def test_containing(boundaries):
+    assert boundaries.containing(-1.75, 52.25) == [0]
+    assert boundaries.containing(-1.25, 52.25) == [1]
+    # points on a shared edge are in both areas
+    assert boundaries.containing(-1.5, 52.25) == [0, 1]
+    assert boundaries.containing(-1.75, 53.0) == []
+
+
+def test_tile(boundaries):
+    # zoom 7 tile covering the middle of England
+    tile = mapbox_vector_tile.decode(boundaries.tile(7, 63, 42, layer="lad"))
+
+    features = tile["lad"]["features"]
+    assert {f["properties"]["code"] for f in features} == {"E07000001", "E07000002"}
+    assert features[0]["properties"]["name"] == "Area E07000001"
+    assert features[0]["geometry"]["type"] == "Polygon"
+    limit = spatial.TILE_EXTENT + spatial.TILE_BUFFER
+    for feature in features:
+        for x, y in feature["geometry"]["coordinates"][0]:
+            assert -spatial.TILE_BUFFER <= x <= limit
+            assert -spatial.TILE_BUFFER <= y <= limit
+
+
+def test_tile_clipped(boundaries):
+    # a zoom 12 tile inside E07000001 is clipped to the edges of the tile
+    west, south, east, north = spatial.tile_bounds(12, 2027, 1349)
+    assert box(-2.0, 52.0, -1.5, 52.5).contains(box(west, south, east, north))
+
+    tile = mapbox_vector_tile.decode(boundaries.tile(12, 2027, 1349, layer="lad"))
+
+    (feature,) = tile["lad"]["features"]
+    assert feature["properties"]["code"] == "E07000001"
+    xs = [x for x, y in feature["geometry"]["coordinates"][0]]
+    assert min(xs) == -spatial.TILE_BUFFER
+    assert max(xs) == spatial.TILE_EXTENT + spatial.TILE_BUFFER
+
+
+def test_tile_empty(boundaries):
+    tile = mapbox_vector_tile.decode(boundaries.tile(7, 0, 0, layer="lad"))
+    assert tile["lad"]["features"] == []
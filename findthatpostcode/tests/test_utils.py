@@ -1,11 +1,23 @@
 import datetime
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+
+from types import SimpleNamespace
 
 import pytest
+import requests
+from elasticsearch.serializer import JSONSerializer
 
 import findthatpostcode.utils
-from findthatpostcode.tests.fixtures import mock_bulk
+from findthatpostcode import settings
+from findthatpostcode.tests.fixtures import mock_streaming_bulk
 from findthatpostcode.utils import (
     BulkImporter,
+    download_file,
     process_date,
     process_float,
     process_int,
@@ -79,16 +91,250 @@ def test_process_float(value, expected):
 
 
 def test_bulk_importer(monkeypatch):
-    monkeypatch.setattr(findthatpostcode.utils, "bulk", mock_bulk)
+    monkeypatch.setattr(findthatpostcode.utils, "streaming_bulk", mock_streaming_bulk)
 
     with BulkImporter(None, name="test", limit=3) as bulk_importer:
         for i in range(10):
             bulk_importer.add({"_index": "test", "_id": i, "_source": {"id": i}})
-            assert len(bulk_importer) == (i + 1) % 3
-        assert len(bulk_importer.errors) == 0
+    assert bulk_importer.success_count == 10
+    assert len(bulk_importer) == 0
+    assert len(bulk_importer.errors) == 0
 
     with BulkImporter(None, name="test", limit=3) as bulk_importer:
         for i in range(10):
             bulk_importer.append({"_index": "test", "_id": i, "_source": {"id": i}})
-            assert len(bulk_importer) == (i + 1) % 3
-        assert len(bulk_importer.errors) == 0
+    assert bulk_importer.success_count == 10
+
+
+def test_bulk_importer_bytes():
+    class BulkES:
+        transport = SimpleNamespace(serializer=JSONSerializer())
+
+        def __init__(self):
+            self.bodies = []
+
+        def bulk(self, body, **kwargs):
+            self.bodies.append(body)
+            items = [{"index": {"status": 201}} for _ in range(body.count('"_id"'))]
+            return {"items": items}
+
+    es = BulkES()
+    with BulkImporter(es, name="test", limit=3, concurrency=2) as importer:
+        for i in range(10):
+            importer.add({"_index": "test", "_id": i, "_source": {"id": i}})
+        importer.add({"_op_type": "delete", "_index": "test", "_id": 10})
+    assert importer.success_count == 11
+    assert importer.bytes_sent == sum(len(body.encode("utf-8")) for body in es.bodies)
+    assert "null" not in "".join(es.bodies)
+
+
+def test_bulk_importer_errors(monkeypatch):
+    def failing_items(es, actions, **kwargs):
+        for action in actions:
+            yield action["_id"] % 2 == 0, {"index": {"_id": action["_id"]}}
+
+    monkeypatch.setattr(findthatpostcode.utils, "streaming_bulk", failing_items)
+
+    with BulkImporter(None, name="test", raise_on_error=False) as importer:
+        for i in range(10):
+            importer.add({"_index": "test", "_id": i, "_source": {"id": i}})
+    assert importer.success_count == 5
+    assert importer.error_count == 5
+    assert sorted(e["index"]["_id"] for e in importer.errors) == [1, 3, 5, 7, 9]
+
+
+def test_bulk_importer_concurrent(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+    active = []
+
+    def slow_bulk(es, actions, chunk_size, **kwargs):
+        # take actions a chunk at a time, as streaming_bulk does
+        chunk = []
+        for action in itertools.chain(actions, [None]):
+            if action is not None:
+                chunk.append(action)
+                if len(chunk) < chunk_size:
+                    continue
+            if not chunk:
+                break
+            with lock:
+                active.append(1)
+                calls.append((len(chunk), len(active), kwargs))
+            time.sleep(0.01)
+            with lock:
+                active.pop()
+            for _ in chunk:
+                yield True, {}
+            chunk = []
+
+    monkeypatch.setattr(findthatpostcode.utils, "streaming_bulk", slow_bulk)
+
+    with BulkImporter(None, name="test", limit=10, concurrency=3) as importer:
+        for i in range(100):
+            importer.add({"_index": "test", "_id": i, "_source": {"id": i}})
+    assert importer.success_count == 100
+    assert sum(c[0] for c in calls) == 100
+    assert max(c[0] for c in calls) <= 10
+    assert max(c[1] for c in calls) <= 3
+    assert calls[0][2]["max_chunk_bytes"] == settings.ES_BULK_MAX_BYTES
+    assert calls[0][2]["max_retries"] == settings.ES_BULK_MAX_RETRIES
+
+
+def test_bulk_importer_raises(monkeypatch):
+    def failing_bulk(es, actions, **kwargs):
+        next(actions)
+        raise ValueError("bulk failed")
+
+    monkeypatch.setattr(findthatpostcode.utils, "streaming_bulk", failing_bulk)
+
+    with pytest.raises(ValueError):
+        with BulkImporter(None, name="test", limit=10, concurrency=2) as importer:
+            for i in range(100):
+                importer.add({"_index": "test", "_id": i, "_source": {"id": i}})
+
+    # an error is raised when the importer closes, if it isn't raised before
+    with pytest.raises(ValueError):
+        with BulkImporter(None, name="test", limit=10, concurrency=2) as importer:
+            importer.add({"_index": "test", "_id": 1, "_source": {"id": 1}})
+
+
+def test_download_file(requests_mock, tmp_path):
+    url = "https://example.com/data.zip"
+    requests_mock.get(url, content=b"0123456789")
+
+    path = download_file(url, str(tmp_path))
+
+    with open(path, "rb") as f:
+        assert f.read() == b"0123456789"
+    assert not os.path.exists(path + ".part")
+
+
+def test_download_file_resume(requests_mock, tmp_path):
+    url = "https://example.com/data.zip"
+    content = b"0123456789"
+
+    def respond(request, context):
+        start = int(request.headers["Range"].split("=")[1].rstrip("-"))
+        context.status_code = 206
+        return content[start:]
+
+    requests_mock.get(url, content=respond)
+    part_path = tmp_path / (hashlib.md5(url.encode()).hexdigest() + ".part")
+    part_path.write_bytes(content[0:4])
+    (tmp_path / (part_path.name + ".json")).write_text(json.dumps({"etag": '"v1"'}))
+
+    path = download_file(url, str(tmp_path))
+
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert requests_mock.last_request.headers["Range"] == "bytes=4-"
+    assert requests_mock.last_request.headers["If-Range"] == '"v1"'
+    assert not os.path.exists(str(part_path) + ".json")
+
+
+def test_download_file_resume_changed(requests_mock, tmp_path):
+    url = "https://example.com/data.zip"
+    # the file has changed since the partial download, so If-Range doesn't
+    # match and the whole of the new version is sent
+    requests_mock.get(url, content=b"abcdefghij", headers={"ETag": '"v2"'})
+    part_path = tmp_path / (hashlib.md5(url.encode()).hexdigest() + ".part")
+    part_path.write_bytes(b"0123")
+    (tmp_path / (part_path.name + ".json")).write_text(json.dumps({"etag": '"v1"'}))
+
+    path = download_file(url, str(tmp_path))
+
+    with open(path, "rb") as f:
+        assert f.read() == b"abcdefghij"
+    with open(str(tmp_path / hashlib.md5(url.encode()).hexdigest()) + ".json") as f:
+        assert json.load(f)["etag"] == '"v2"'
+
+
+def test_download_file_resume_no_validator(requests_mock, tmp_path):
+    url = "https://example.com/data.zip"
+    requests_mock.get(url, content=b"abcdefghij")
+    part_path = tmp_path / (hashlib.md5(url.encode()).hexdigest() + ".part")
+    part_path.write_bytes(b"0123")
+
+    path = download_file(url, str(tmp_path))
+
+    with open(path, "rb") as f:
+        assert f.read() == b"abcdefghij"
+    assert "Range" not in requests_mock.last_request.headers
+
+
+def test_download_file_retries(requests_mock, tmp_path):
+    url = "https://example.com/data.zip"
+    requests_mock.get(
+        url,
+        [
+            {"exc": requests.exceptions.ConnectionError},
+            {"content": b"0123456789"},
+        ],
+    )
+
+    path = download_file(url, str(tmp_path))
+
+    with open(path, "rb") as f:
+        assert f.read() == b"0123456789"
+    assert requests_mock.call_count == 2
+
+
+def test_download_file_not_modified(requests_mock, tmp_path):
+    url = "https://example.com/data.zip"
+    requests_mock.get(
+        url,
+        [
+            {"content": b"0123456789", "headers": {"ETag": '"v1"'}},
+            {"status_code": 304},
+        ],
+    )
+
+    path = download_file(url, str(tmp_path))
+    assert os.path.basename(path) == hashlib.sha256(b"0123456789").hexdigest()
+    assert "If-None-Match" not in requests_mock.last_request.headers
+
+    assert download_file(url, str(tmp_path)) == path
+    assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+
+
+def test_download_file_changed(requests_mock, tmp_path):
+    url = "https://example.com/data.zip"
+    requests_mock.get(
+        url,
+        [
+            {
+                "content": b"0123456789",
+                "headers": {"Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"},
+            },
+            {"content": b"9876543210"},
+        ],
+    )
+
+    first = download_file(url, str(tmp_path))
+    second = download_file(url, str(tmp_path))
+
+    assert (
+        requests_mock.last_request.headers["If-Modified-Since"]
+        == "Wed, 21 Oct 2015 07:28:00 GMT"
+    )
+    assert first != second
+    assert not os.path.exists(first)
+    with open(second, "rb") as f:
+        assert f.read() == b"9876543210"
+
+
+def test_download_file_shared(requests_mock, tmp_path):
+    # two URLs with the same contents share a file, which isn't removed when
+    # one of them changes
+    requests_mock.get(
+        "https://example.com/a.zip", [{"content": b"012"}, {"content": b"345"}]
+    )
+    requests_mock.get("https://example.com/b.zip", content=b"012")
+
+    first = download_file("https://example.com/a.zip", str(tmp_path))
+    assert download_file("https://example.com/b.zip", str(tmp_path)) == first
+    download_file("https://example.com/a.zip", str(tmp_path))
+
+    with open(first, "rb") as f:
+        assert f.read() == b"012"
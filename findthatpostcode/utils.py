@@ -1,10 +1,36 @@
+import csv
 import datetime
+import hashlib
+import io
+import json
+import os
+import queue
 import re
+import threading
+import time
+import zipfile
 from itertools import takewhile
-from typing import Any, Dict, Optional
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+)
 
-from elasticsearch.helpers import bulk
+import anyio
+import ijson
+import requests
+from elasticsearch.helpers import expand_action, streaming_bulk
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.types import Receive
+from tqdm import tqdm
 
 from findthatpostcode import settings
 
@@ -153,47 +179,515 @@ POSTCODE_AREAS = {
     "XM": "Christmas",
 }
 
+# put on the queue of a BulkImporter to tell each of its threads to finish
+_BULK_DONE = object()
+
+# compressed boundaries are stored with these suffixes, in order of preference
+BOUNDARY_ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
 
 class BulkImporter:
-    def __init__(self, es, name="records", limit=10000, **kwargs):
+    """
+    Send bulk actions to Elasticsearch from background threads
+
+    Actions are queued as they are added and sent by `concurrency` threads,
+    each running `streaming_bulk`, so records can keep being parsed while
+    Elasticsearch indexes them. Each request holds up to `limit` actions or
+    `max_bytes` of JSON, and actions rejected because the cluster is busy
+    (429) are retried with an exponential backoff starting at
+    `initial_backoff` seconds. Actions are serialized as they are taken off
+    the queue, so the size of the JSON sent can be reported.
+    """
+
+    def __init__(
+        self,
+        es,
+        name="records",
+        limit=10000,
+        max_bytes=None,
+        concurrency=None,
+        max_retries=None,
+        initial_backoff=None,
+        **kwargs,
+    ):
         self.es = es
         self.name = name
-        self.limit = limit
-        self._bulk_kwargs = kwargs
-        self._records = []
+        self.limit = limit or 500
+        self.concurrency = max(concurrency or settings.ES_BULK_CONCURRENCY, 1)
+        self._bulk_kwargs = {
+            "request_timeout": settings.ES_BULK_TIMEOUT,
+            "chunk_size": self.limit,
+            "max_chunk_bytes": max_bytes or settings.ES_BULK_MAX_BYTES,
+            "max_retries": settings.ES_BULK_MAX_RETRIES
+            if max_retries is None
+            else max_retries,
+            "initial_backoff": initial_backoff or settings.ES_BULK_INITIAL_BACKOFF,
+            **kwargs,
+        }
         self.errors = []
         self.error_count = 0
+        self.success_count = 0
+        self.bytes_sent = 0
+        self._error = None
         self._total_records = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        # enough actions for a full request from every thread, so the queue
+        # doesn't hold more in memory than is about to be sent
+        self._queue = queue.Queue(maxsize=self.limit * self.concurrency)
+        self._threads = []
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.commit()
+        self.close()
 
     def __len__(self) -> int:
-        return len(self._records)
+        return self._queue.qsize()
 
     def add(self, record) -> None:
-        self._records.append(record)
+        if not self._threads:
+            self._threads = [
+                threading.Thread(
+                    target=self._send,
+                    name="bulk-{}-{}".format(self.name, i),
+                    daemon=True,
+                )
+                for i in range(self.concurrency)
+            ]
+            for thread in self._threads:
+                thread.start()
+        while True:
+            # raise any errors from the threads rather than waiting forever
+            if self._error is not None:
+                raise self._error
+            try:
+                self._queue.put(record, timeout=0.1)
+                break
+            except queue.Full:
+                continue
         self._total_records += 1
-        if self.limit and (len(self._records) >= self.limit):
-            self.commit()
+        if self._total_records % self.limit == 0:
+            print(f"[elasticsearch] Processed {self._total_records:,.0f} {self.name}")
 
     def append(self, *args, **kwargs) -> None:
         self.add(*args, **kwargs)
 
-    def commit(self) -> None:
-        print(f"[elasticsearch] Processed {self._total_records:,.0f} {self.name}")
-        print(f"[elasticsearch] {len(self._records):,.0f} {self.name} to save")
-        success, errors = bulk(self.es, self._records, **self._bulk_kwargs)
-        error_count = errors if isinstance(errors, int) else len(errors)
-        print(f"[elasticsearch] saved {success:,.0f} {self.name}")
-        print(f"[elasticsearch] {error_count:,.0f} errors reported")
-        if isinstance(errors, list):
+    def _actions(self):
+        while True:
+            action = self._queue.get()
+            if action is _BULK_DONE:
+                return
+            yield action
+
+    def _send(self) -> None:
+        actions = self._actions()
+        success, errors, size = 0, [], 0
+
+        def expand(action):
+            # serialize the action here rather than in streaming_bulk (which
+            # leaves strings as they are) so its size can be counted
+            nonlocal size
+            dumps = self.es.transport.serializer.dumps
+            header, data = expand_action(action)
+            header = dumps(header)
+            size += len(header.encode("utf-8")) + 1
+            if data is not None:
+                data = dumps(data)
+                size += len(data.encode("utf-8")) + 1
+            return header, data
+
+        try:
+            for ok, item in streaming_bulk(
+                self.es, actions, expand_action_callback=expand, **self._bulk_kwargs
+            ):
+                if ok:
+                    success += 1
+                else:
+                    errors.append(item)
+        except Exception as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            # keep taking actions off the queue, so adding them never blocks
+            for _ in actions:
+                pass
+        with self._lock:
+            self.success_count += success
+            self.bytes_sent += size
             self.errors.extend(errors)
-        self.error_count += error_count
-        self._records = []
+            self.error_count += len(errors)
+
+    def close(self) -> None:
+        """
+        Wait for the actions still queued to be sent and report the indexing
+        rate (in documents and megabytes of JSON), raising any error from
+        sending them
+        """
+        for _ in self._threads:
+            self._queue.put(_BULK_DONE)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        print(
+            "[elasticsearch] saved {:,.0f} {}, {:,.0f} errors, "
+            "{:,.0f} docs/sec, {:,.1f} MB/sec".format(
+                self.success_count,
+                self.name,
+                self.error_count,
+                self.success_count / elapsed,
+                self.bytes_sent / elapsed / 1024 / 1024,
+            )
+        )
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def record_to_dict(record: Any, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Convert a schema record into JSON-compatible values, optionally limited
+    to a list of fields
+    """
+    values = jsonable_encoder(record)
+    if fields:
+        return {f: values.get(f) for f in fields}
+    return values
+
+
+class RequestReader:
+    """
+    File-like access to a request body as it arrives, for the streaming JSON
+    parser
+    """
+
+    def __init__(self, stream: AsyncIterator[bytes]):
+        self.stream = stream
+
+    async def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            # the parser reads nothing first, to check for bytes or text
+            return b""
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+
+async def request_lines(stream: AsyncIterator[bytes]) -> AsyncGenerator[str, None]:
+    """
+    Yield the non-empty lines of a text request body as they arrive
+    """
+    buffer = b""
+    async for chunk in stream:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line.decode("utf-8").strip()
+    if buffer.strip():
+        yield buffer.decode("utf-8").strip()
+
+
+async def request_json_strings(
+    stream: AsyncIterator[bytes],
+) -> AsyncGenerator[str, None]:
+    """
+    Yield the strings in a JSON array request body as they arrive, raising a
+    `ValueError` if the body is anything else
+    """
+    async for prefix, event, value in ijson.parse_async(RequestReader(stream)):
+        if prefix == "" and event in ("start_array", "end_array"):
+            continue
+        if prefix == "item" and event == "string":
+            yield value
+            continue
+        raise ValueError("Expected a JSON array of strings")
+
+
+def iterate_from_thread(
+    values: AsyncIterator[Any], first: Optional[List[Any]] = None
+) -> Generator[Any, None, None]:
+    """
+    Iterate over an async iterator from a worker thread, such as the one
+    a `StreamingResponse` reads a blocking generator in
+    """
+    yield from first or []
+    while True:
+        try:
+            yield anyio.from_thread.run(values.__anext__)
+        except StopAsyncIteration:
+            return
+
+
+class RequestStreamingResponse(StreamingResponse):
+    """
+    A streaming response that can be sent while the request body is still
+    being read
+
+    Starlette watches for the client disconnecting by reading from the
+    request, which would take the parts of the body not yet read, so here
+    the response is only stopped early if sending it fails.
+    """
+
+    async def listen_for_disconnect(self, receive: Receive) -> None:
+        await anyio.sleep_forever()
+
+
+def records_to_ndjson(
+    chunks: Iterable[Iterable[Any]], fields: Optional[List[str]] = None
+) -> Generator[str, None, None]:
+    """
+    Serialise chunks of records as newline-delimited JSON, one string per chunk
+    """
+    for chunk in chunks:
+        yield "".join(
+            json.dumps(record_to_dict(record, fields)) + "\n" for record in chunk
+        )
+
+
+def records_to_json(
+    chunks: Iterable[Iterable[Any]], fields: Optional[List[str]] = None
+) -> Generator[str, None, None]:
+    """
+    Serialise chunks of records as a single JSON array, one string per chunk
+    """
+    separator = "["
+    for chunk in chunks:
+        output = ""
+        for record in chunk:
+            output += separator + json.dumps(record_to_dict(record, fields))
+            separator = ","
+        if output:
+            yield output
+    yield "[]" if separator == "[" else "]"
+
+
+def records_to_csv(
+    chunks: Iterable[Iterable[Any]], fields: List[str]
+) -> Generator[str, None, None]:
+    """
+    Serialise chunks of records as CSV, one string per chunk after the header
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    writer.writeheader()
+    for chunk in chunks:
+        for record in chunk:
+            writer.writerow(record_to_dict(record, fields))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def download_file(url: str, download_dir: Optional[str] = None) -> str:
+    """
+    Download a file to disk in chunks, returning the path to it
+
+    Files are stored as `<download_dir>/<sha256 of contents>`, with the URL's
+    `ETag` and `Last-Modified` headers kept in `<hash of url>.json`. Once a
+    file has been downloaded the request is made conditional, so if it hasn't
+    changed upstream the cached copy is returned without downloading it again.
+
+    Downloads are written to `<hash of url>.part` and renamed once complete.
+    If a partial download is already there (or the connection drops) the
+    download is resumed with a range request, up to `settings.DOWNLOAD_RETRIES`
+    times. The range request has an `If-Range` header with the validator of
+    the partial download, so if the file has changed since then it is
+    downloaded again from the start rather than mixing the two versions.
+    """
+    download_dir = download_dir or settings.DOWNLOAD_DIR
+    os.makedirs(download_dir, exist_ok=True)
+    url_path = os.path.join(download_dir, hashlib.md5(url.encode()).hexdigest())
+    part_path = url_path + ".part"
+    part_meta_path = part_path + ".json"
+    meta_path = url_path + ".json"
+
+    cached: Dict[str, Optional[str]] = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cached = json.load(f)
+    cached_path = os.path.join(download_dir, cached.get("sha256") or "")
+    if not os.path.isfile(cached_path):
+        cached = {}
+
+    # the validator of the version held in the partial download
+    validator: Dict[str, Optional[str]] = {}
+    if os.path.exists(part_meta_path):
+        with open(part_meta_path) as f:
+            validator = json.load(f)
+    if os.path.exists(part_path) and not if_range(validator):
+        # without a validator there's no way to tell if it's the same version
+        os.remove(part_path)
+
+    for attempt in range(settings.DOWNLOAD_RETRIES + 1):
+        downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {}
+        if downloaded:
+            headers["Range"] = "bytes={}-".format(downloaded)
+            headers["If-Range"] = if_range(validator) or ""
+        elif cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        elif cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        try:
+            with requests.get(
+                url, headers=headers, stream=True, timeout=settings.DOWNLOAD_TIMEOUT
+            ) as r:
+                if r.status_code == 304:
+                    print(f"[download] {url} is unchanged, using the cached copy")
+                    return cached_path
+                if r.status_code == 416:
+                    # the partial file already holds the whole download
+                    break
+                r.raise_for_status()
+                if r.status_code != 206:
+                    downloaded = 0
+                    validator = {
+                        "etag": r.headers.get("ETag"),
+                        "last_modified": r.headers.get("Last-Modified"),
+                    }
+                    with open(part_meta_path, "w") as f:
+                        json.dump(validator, f)
+                total = r.headers.get("Content-Length")
+                with open(part_path, "ab" if downloaded else "wb") as f, tqdm(
+                    total=int(total) + downloaded if total else None,
+                    initial=downloaded,
+                    unit="B",
+                    unit_scale=True,
+                    desc=os.path.basename(url)[0:40],
+                ) as progress:
+                    for chunk in r.iter_content(
+                        chunk_size=settings.DOWNLOAD_CHUNK_SIZE
+                    ):
+                        f.write(chunk)
+                        progress.update(len(chunk))
+            break
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ):
+            if attempt == settings.DOWNLOAD_RETRIES:
+                raise
+            if not if_range(validator) and os.path.exists(part_path):
+                os.remove(part_path)
+            print(f"[download] Connection lost, resuming {url}")
+
+    sha256 = file_hash(part_path)
+    path = os.path.join(download_dir, sha256)
+    os.replace(part_path, path)
+    if os.path.exists(part_meta_path):
+        os.remove(part_meta_path)
+
+    with open(meta_path, "w") as f:
+        json.dump({"url": url, **validator, "sha256": sha256}, f)
+
+    # files are shared by every URL with the same contents, so the old file is
+    # only removed if no other URL still uses it
+    if cached and cached_path != path:
+        if not download_references(download_dir, cached["sha256"] or ""):
+            os.remove(cached_path)
+    return path
+
+
+def if_range(validator: Mapping[str, Optional[str]]) -> Optional[str]:
+    """
+    The value for an `If-Range` header from a download's `ETag` and
+    `Last-Modified` headers, if there is one that can be used
+
+    Weak ETags can't be used in `If-Range`, so `Last-Modified` is used instead.
+    """
+    etag = validator.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validator.get("last_modified")
+
+
+def download_references(download_dir: str, sha256: str) -> List[str]:
+    """
+    The URLs whose downloads are stored in the file with hash `sha256`
+    """
+    urls = []
+    for filename in os.listdir(download_dir):
+        if not filename.endswith(".json") or filename.endswith(".part.json"):
+            continue
+        try:
+            with open(os.path.join(download_dir, filename)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get("sha256") == sha256:
+            urls.append(meta.get("url"))
+    return urls
+
+
+def file_hash(path: str) -> str:
+    """
+    The SHA-256 hash of a file's contents
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(settings.DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def boundary_key(
+    areacode: str, resolution: str = "full", encoding: str = "identity"
+) -> str:
+    """
+    The S3 key for an area's boundary, with any simplified or compressed
+    versions stored alongside the full boundary
+    """
+    if resolution == "full":
+        key = "%s/%s.json" % (areacode[0:3], areacode)
+    else:
+        key = "%s/%s.%s.json" % (areacode[0:3], areacode, resolution)
+    return key + BOUNDARY_ENCODING_SUFFIXES.get(encoding, "")
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> List[str]:
+    """
+    The compressed boundary encodings a client accepts, from an
+    `Accept-Encoding` header, most preferred first
+
+    `identity` is always included last, as an uncompressed boundary can
+    always be sent.
+    """
+    weights: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if coding:
+            weights[coding.strip().lower()] = weight
+    encodings = [
+        e for e in BOUNDARY_ENCODING_SUFFIXES if weights.get(e, weights.get("*", 0)) > 0
+    ]
+    encodings.sort(key=lambda e: weights.get(e, weights.get("*", 0)), reverse=True)
+    return encodings + ["identity"]
+
+
+def zip_version(z: zipfile.ZipFile) -> str:
+    """
+    A short version string for a zip file, based on the name, date and
+    checksum of each file it contains
+    """
+    members = sorted(
+        "{}:{}:{}".format(f.filename, f.date_time, f.CRC) for f in z.infolist()
+    )
+    return hashlib.md5("|".join(members).encode()).hexdigest()[0:12]
 
 
 def process_date(
@@ -288,6 +782,9 @@ class PostcodeStr:
     def __eq__(self, other):
         return str(self) == other
 
+    def __hash__(self):
+        return hash(self.postcode)
+
     def __getattr__(self, __name: str) -> Any:
         if hasattr(self.postcode, __name):
             return getattr(self.postcode, __name)